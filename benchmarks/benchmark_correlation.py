@@ -0,0 +1,80 @@
+# benchmarks/benchmark_correlation.py
+
+"""
+Benchmark the batched correlation kernel used by decode_task against the previous
+per-subject np.corrcoef loop.
+
+Subject maps are synthetic and written to a temporary memmap, like the decode matrix
+on worker nodes, so large subject counts do not need to fit in memory.
+
+Usage (from the repository root):
+    python -m benchmarks.benchmark_correlation
+    python -m benchmarks.benchmark_correlation --subjects 100 1000 --n-voxels 50000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from pages.tasks.decode_stats import correlate_maps, map_statistics
+
+# Number of voxels inside the 2mm MNI152 brain mask
+N_MASK_VOXELS = 228483
+
+
+def make_subject_maps(path: str, n_subjects: int, n_voxels: int, rng: np.random.Generator) -> np.memmap:
+    maps = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_subjects, n_voxels))
+    shared = rng.standard_normal(n_voxels).astype(np.float32)
+    for start in range(0, n_subjects, 256):
+        stop = min(start + 256, n_subjects)
+        maps[start:stop] = rng.standard_normal((stop - start, n_voxels), dtype=np.float32) * 3 + shared
+    maps.flush()
+    return np.load(path, mmap_mode='r')
+
+
+def loop_correlations(query: np.ndarray, subject_maps: np.ndarray) -> np.ndarray:
+    """The per-subject loop decode_task used before the batched kernel."""
+    return np.array([np.corrcoef(query, subject_maps[i])[0, 1] for i in range(subject_maps.shape[0])])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subjects', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--n-voxels', type=int, default=N_MASK_VOXELS)
+    parser.add_argument('--n-queries', type=int, default=8, help="Query maps decoded together in the batched run.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'subjects':>9} {'loop (s)':>10} {'batched (s)':>12} {'speedup':>8} {'max |diff|':>11} "
+          f"{args.n_queries:>3} queries (s)")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_subjects in args.subjects:
+            subject_maps = make_subject_maps(os.path.join(tmp_dir, f'maps_{n_subjects}.npy'), n_subjects, args.n_voxels, rng)
+            means, stds = map_statistics(subject_maps)
+            queries = rng.standard_normal((args.n_queries, args.n_voxels))
+
+            start = time.perf_counter()
+            expected = loop_correlations(queries[0], subject_maps)
+            loop_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            actual = correlate_maps(queries[0], subject_maps, subject_means=means, subject_stds=stds)
+            batched_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            correlate_maps(queries, subject_maps, subject_means=means, subject_stds=stds)
+            multi_seconds = time.perf_counter() - start
+
+            print(f"{n_subjects:>9} {loop_seconds:>10.3f} {batched_seconds:>12.3f} "
+                  f"{loop_seconds / batched_seconds:>7.1f}x {np.nanmax(np.abs(expected - actual)):>11.2e} "
+                  f"{multi_seconds:>15.3f}")
+            del subject_maps
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# benchmarks/benchmark_parcel_preview.py
+
+"""
+Compare preview lesion network maps from the parcel connectome with exact pfctoolkit maps.
+
+Random spherical lesions are placed inside the 2mm MNI152 brain mask. For each one the
+preview map (compute_preview_map) and the exact map (generate_connectivity_map) are
+computed, and the spatial correlation between them is reported with both run times.
+
+Needs the parcel connectome to be built (pages.tasks.parcel_preview.build_parcel_connectome)
+and pfctoolkit access to the precomputed connectome.
+
+Usage (from the repository root):
+    python -m benchmarks.benchmark_parcel_preview
+    python -m benchmarks.benchmark_parcel_preview --lesions 50 --radius 3 6
+"""
+
+import argparse
+import os
+import time
+
+import django
+import numpy as np
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_project.settings')
+django.setup()
+
+import nibabel as nib  # noqa: E402
+
+from pages.tasks.analyze import generate_connectivity_map  # noqa: E402
+from pages.tasks.parcel_preview import compute_preview_map, load_parcel_connectome  # noqa: E402
+from sqlalchemy_utils.db_utils import (  # noqa: E402
+    MNI152_2MM_AFFINE,
+    MNI152_2MM_SHAPE,
+    get_2mm_mni152_masker,
+    mask_2mm_mni152,
+)
+
+
+def make_lesion(center, radius: float) -> nib.Nifti1Image:
+    grid = np.indices(MNI152_2MM_SHAPE)
+    distance = np.sqrt(sum((grid[axis] - center[axis]) ** 2 for axis in range(3)))
+    return nib.Nifti1Image((distance <= radius).astype(np.float32), MNI152_2MM_AFFINE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lesions', type=int, default=20, help="Random lesions per radius.")
+    parser.add_argument('--radius', type=float, nargs='+', default=[2, 4, 8], help="Lesion radii in voxels.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    parcel_connectome = load_parcel_connectome()
+    if parcel_connectome is None:
+        raise SystemExit("The parcel connectome has not been built; run build_parcel_connectome() first.")
+
+    rng = np.random.default_rng(args.seed)
+    mask_voxels = np.column_stack(np.unravel_index(get_2mm_mni152_masker().flat_indices, MNI152_2MM_SHAPE))
+
+    print(f"{'radius':>6} {'lesions':>8} {'r mean':>7} {'r min':>7} {'r median':>9} "
+          f"{'preview (s)':>12} {'exact (s)':>10}")
+    for radius in args.radius:
+        correlations, preview_seconds, exact_seconds = [], [], []
+        for _ in range(args.lesions):
+            lesion = make_lesion(mask_voxels[rng.integers(len(mask_voxels))], radius)
+
+            start = time.perf_counter()
+            preview = compute_preview_map(lesion, parcel_connectome)
+            preview_seconds.append(time.perf_counter() - start)
+            if preview is None:
+                continue
+
+            start = time.perf_counter()
+            exact = np.squeeze(mask_2mm_mni152(generate_connectivity_map(lesion, use_chunk_cache=False)))
+            exact_seconds.append(time.perf_counter() - start)
+
+            correlations.append(np.corrcoef(preview, exact)[0, 1])
+
+        correlations = np.asarray(correlations)
+        print(f"{radius:>6g} {len(correlations):>8} {correlations.mean():>7.3f} {correlations.min():>7.3f} "
+              f"{np.median(correlations):>9.3f} {np.median(preview_seconds):>12.4f} {np.median(exact_seconds):>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# benchmarks/benchmark_parcelwise_ingest.py
+
+"""
+Measure parcelwise ingest throughput in files/minute for each map type.
+
+For every map type, an existing file row is used as the template and synthetic
+parcelwise arrays for the 3209c91v atlas are inserted with insert_parcelwise_file
+(the database half of data_to_parcelwise_values_table). Everything runs in one
+transaction that is rolled back at the end, so nothing is written to the database.
+Parcellating the voxelwise map and uploading the .npy to S3 are not included unless
+--parcellate is given, which adds apply_parcellation on a random 2mm MNI152 map.
+
+--legacy also times the previous path (one get_parcel_id query per parcel and
+bulk_insert_mappings of per-row dicts) for comparison.
+
+Usage (from the repository root):
+    python -m benchmarks.benchmark_parcelwise_ingest
+    python -m benchmarks.benchmark_parcelwise_ingest --files 50 --legacy --parcellate
+"""
+
+import argparse
+import os
+import time
+
+import django
+import numpy as np
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_project.settings')
+django.setup()
+
+import nibabel as nib  # noqa: E402
+
+from sqlalchemy_utils.db_session import get_session  # noqa: E402
+from sqlalchemy_utils.db_utils import (  # noqa: E402
+    MNI152_2MM_AFFINE,
+    MNI152_2MM_SHAPE,
+    PARCELWISE_TABLES,
+    apply_parcellation,
+    fetch_atlas_3209c91v,
+    get_parcel_id,
+    get_parcel_id_lookup,
+    get_parcellation_id,
+    get_user_id,
+    insert_parcelwise_file,
+)
+
+
+def insert_legacy(file_in_db, map_type, parcelwise_array, region_ids, parcellation_id, path, session):
+    table, file_table = PARCELWISE_TABLES[map_type]
+    parcel_ids = [get_parcel_id(parcellation_id, float(value), session) for value in region_ids]
+    file_data = {column.key: getattr(file_in_db, column.key) for column in file_table.__table__.columns if column.key not in ('id', 'insert_date')}
+    file_data.update({'path': path, 'parcellation_id': parcellation_id, 'filetype': 'npy'})
+    new_file = file_table(**file_data)
+    session.add(new_file)
+    session.flush()
+    user_id = get_user_id(session)
+    records = [
+        {f'{map_type}_file_id': new_file.id, 'parcel_id': parcel_id, 'value': float(value), 'user_id': user_id}
+        for parcel_id, value in zip(parcel_ids, np.ravel(parcelwise_array)) if value != 0
+    ]
+    session.bulk_insert_mappings(table, records)
+    session.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=20, help="Files inserted per map type.")
+    parser.add_argument('--legacy', action='store_true', help="Also time the previous per-row insert path.")
+    parser.add_argument('--parcellate', action='store_true', help="Include apply_parcellation of a random map.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    parcellation = fetch_atlas_3209c91v()
+    rng = np.random.default_rng(args.seed)
+    session = get_session()
+    try:
+        parcellation_id = get_parcellation_id(parcellation.name, session)
+        region_ids, _ = get_parcel_id_lookup(parcellation_id, session)
+        region_ids = region_ids[region_ids > 0]
+
+        paths = {'copy': insert_parcelwise_file}
+        if args.legacy:
+            paths['legacy'] = insert_legacy
+
+        print(f"{'map type':>16} {'path':>8} {'files':>6} {'files/min':>10}")
+        for map_type, (_, file_table) in PARCELWISE_TABLES.items():
+            file_in_db = session.query(file_table).first()
+            if file_in_db is None:
+                print(f"{map_type:>16} no {file_table.__tablename__} rows to use as a template; skipped")
+                continue
+            for path_name, insert in paths.items():
+                start = time.perf_counter()
+                for i in range(args.files):
+                    if args.parcellate:
+                        voxelwise_map = nib.Nifti1Image(rng.standard_normal(MNI152_2MM_SHAPE).astype(np.float32), MNI152_2MM_AFFINE)
+                        parcelwise_array, file_region_ids = apply_parcellation(voxelwise_map, parcellation, return_region_ids=True)
+                    else:
+                        parcelwise_array, file_region_ids = rng.standard_normal(len(region_ids)), region_ids
+                    path = f"benchmark/{map_type}_{path_name}_{i}.npy"
+                    if path_name == 'copy':
+                        insert(file_in_db, map_type, parcelwise_array, file_region_ids, parcellation_id, path, session, commit=False)
+                    else:
+                        insert(file_in_db, map_type, parcelwise_array, file_region_ids, parcellation_id, path, session)
+                elapsed = time.perf_counter() - start
+                print(f"{map_type:>16} {path_name:>8} {args.files:>6} {args.files / elapsed * 60:>10.1f}")
+    finally:
+        session.rollback()
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
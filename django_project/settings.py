@@ -128,6 +128,14 @@ DATABASES = {
     }
 }
 
+# Shared between web and Celery worker processes so cache invalidation reaches both
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": env('CACHE_REDIS_URL', default='redis://127.0.0.1:6379/1'),
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/dev/ref/settings/#auth-password-validators
 AUTH_PASSWORD_VALIDATORS = [
@@ -257,6 +265,7 @@ AWS_S3_OBJECT_PARAMETERS = DO_S3_OBJECT_PARAMETERS
 AWS_LOCATION = DO_LOCATION
 AWS_DEFAULT_ACL = DO_DEFAULT_ACL
 AWS_S3_CUSTOM_DOMAIN = DO_S3_CUSTOM_DOMAIN
+# The botocore client config is set by django_project.storage.CustomS3Boto3Storage
 
 MESSAGE_TAGS = {
     messages.DEBUG: 'secondary',
@@ -271,4 +280,14 @@ CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TIMEZONE = 'UTC'
\ No newline at end of file
+CELERY_TIMEZONE = 'UTC'
+
+# Lesion mapping is CPU-heavy and slow; decoding is short and latency-sensitive. Each gets its
+# own queue so they can be served by workers with different concurrency (see README).
+CELERY_TASK_ROUTES = {
+    'pages.tasks.analyze.run_full_lesion_analysis': {'queue': 'mapping'},
+    'pages.tasks.analyze.decode_lesion_map': {'queue': 'decode'},
+    'pages.tasks.analyze.decode_task_wrapper': {'queue': 'decode'},
+    'pages.tasks.batch_decode.batch_decode_task': {'queue': 'decode'},
+    'pages.tasks.parcel_preview.lesion_preview_task': {'queue': 'decode'},
+}
@@ -1,7 +1,15 @@
 # django_project/storage.py
 from storages.backends.s3boto3 import S3Boto3Storage
 
+from sqlalchemy_utils.s3_client import get_s3_client_config
+
 class CustomS3Boto3Storage(S3Boto3Storage):
+    def __init__(self, **settings):
+        # Same pool size, keep-alive and retry policy as the shared client in sqlalchemy_utils/s3_client.py.
+        # Set here rather than in settings.py, so loading the settings does not import the S3 client.
+        settings.setdefault('client_config', get_s3_client_config())
+        super().__init__(**settings)
+
     def get_object_parameters(self, name):
         if name.endswith('.nii.gz'):
             # Without this, the browser will try to decompress the file when served
@@ -21,6 +21,8 @@ import nibabel as nib
 from sqlalchemy.sql import text
 from sqlalchemy_utils import db_utils
 from sqlalchemy_utils.db_session import get_session
+from sqlalchemy_utils.masked_vector import MASKED_VECTOR_EXTENSION, decode_masked_image
+from pages.tasks.decode_matrix import request_decode_matrix_update
 from django.core.exceptions import ValidationError
 from django.utils.text import slugify
 
@@ -616,6 +618,9 @@ class ConnectivityFileForm(forms.ModelForm):
                             map_type='connectivity',
                             voxelwise_map_name=instance.path.name
                         )
+
+                        # Append the new map to the decode matrix on every node
+                        request_decode_matrix_update()
                     except Exception:
                         # Handle processing error
                         pass
@@ -986,7 +991,7 @@ class NiftiUploadForm(forms.Form):
         required=True,
         label='Upload Brain Map (NIFTI format)',
         widget=forms.FileInput(attrs={
-            'accept': '.nii,.nii.gz,.gz',
+            'accept': f'.nii,.nii.gz,.gz,{MASKED_VECTOR_EXTENSION}',
             'class': 'form-control'
         })
     )
@@ -1004,8 +1009,8 @@ class NiftiUploadForm(forms.Form):
             raise forms.ValidationError('Please upload a file.')
 
         # Check file extension
-        if not file.name.lower().endswith(('.nii', '.nii.gz')):
-            raise forms.ValidationError('Only NIFTI files (.nii or .nii.gz) are allowed.')
+        if not file.name.lower().endswith(('.nii', '.nii.gz', MASKED_VECTOR_EXTENSION)):
+            raise forms.ValidationError(f'Only NIFTI files (.nii or .nii.gz) or masked vectors ({MASKED_VECTOR_EXTENSION}) are allowed.')
 
         # Check file size (10MB limit)
         if file.size > 10 * 1024 * 1024:
@@ -1040,6 +1045,10 @@ class NiftiUploadForm(forms.Form):
         # Read the file content into bytes
         file_content = file_obj.read()
 
+        # Masked vectors (see sqlalchemy_utils/masked_vector.py) hold only the in-mask voxels
+        if file_obj.name.lower().endswith(MASKED_VECTOR_EXTENSION):
+            return decode_masked_image(file_content)
+
         # Determine if the file is gzipped
         if file_obj.name.lower().endswith('.nii.gz'):
             # Wrap the bytes in a GzipFile
@@ -0,0 +1,78 @@
+# pages/signals.py
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import ConnectivityFile, GroupLevelMapFile, ROIFile, Subject, SubjectSymptom, Symptom
+from .tasks.decode_cache import invalidate_decode_results
+from .tasks.decode_matrix import mark_decode_matrix_stale
+from .tasks.parcel_subject_index import schedule_parcel_subject_index_refresh
+from .tasks.spatial_index import invalidate_spatial_index
+from .tasks.taxonomy_membership import invalidate_taxonomy_membership
+
+
+def invalidate_decode_caches():
+    invalidate_taxonomy_membership()
+    invalidate_decode_results()
+
+
+@receiver(post_save, sender=SubjectSymptom)
+@receiver(post_delete, sender=SubjectSymptom)
+@receiver(post_save, sender=Subject)
+@receiver(post_delete, sender=Subject)
+@receiver(post_save, sender=Symptom)
+@receiver(post_delete, sender=Symptom)
+@receiver(post_save, sender=ConnectivityFile)
+@receiver(post_delete, sender=ConnectivityFile)
+def invalidate_decode_caches_on_save(sender, **kwargs):
+    """
+    Subjects, their symptoms and their connectivity files determine the cached
+    taxonomy membership matrices and decode results.
+    """
+    invalidate_decode_caches()
+
+
+@receiver(m2m_changed, sender=Subject.symptoms.through)
+def invalidate_decode_caches_on_m2m_change(sender, action, **kwargs):
+    # SubjectForm clears a subject's symptoms in bulk, which does not send post_delete
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_decode_caches()
+
+
+@receiver(post_save, sender=ConnectivityFile)
+@receiver(post_delete, sender=ConnectivityFile)
+def mark_decode_matrix_stale_on_change(sender, **kwargs):
+    """
+    Every node rebuilds its decode matrix once the change is committed, so a rebuild
+    never runs against the data from before it.
+    """
+    transaction.on_commit(mark_decode_matrix_stale)
+
+
+@receiver(post_save, sender=ConnectivityFile)
+@receiver(post_delete, sender=ConnectivityFile)
+@receiver(post_save, sender=ROIFile)
+@receiver(post_delete, sender=ROIFile)
+@receiver(post_save, sender=GroupLevelMapFile)
+@receiver(post_delete, sender=GroupLevelMapFile)
+@receiver(post_delete, sender=Subject)
+def invalidate_spatial_index_on_save(sender, **kwargs):
+    """
+    Files and their subjects determine the spatial index behind the locations page.
+    Files added through sqlalchemy_utils show up after SPATIAL_INDEX_MAX_AGE.
+    """
+    invalidate_spatial_index()
+
+
+@receiver(post_save, sender=ConnectivityFile)
+@receiver(post_delete, sender=ConnectivityFile)
+@receiver(post_save, sender=ROIFile)
+@receiver(post_delete, sender=ROIFile)
+def refresh_parcel_subject_index_on_change(sender, created=False, **kwargs):
+    """
+    New files are merged into parcel_subject_index when their parcel values are inserted;
+    edited and deleted files need a rebuild.
+    """
+    if not created:
+        schedule_parcel_subject_index_refresh()
@@ -1 +1,7 @@
-from .analyze import run_full_lesion_analysis, decode_task_wrapper
\ No newline at end of file
+from .analyze import run_full_lesion_analysis, decode_task_wrapper, decode_lesion_map, upload_staged_nifti
+from .batch_decode import batch_decode_task
+from .decode_matrix import update_decode_matrix
+from .parcel_preview import lesion_preview_task
+from .parcel_subject_index import check_parcel_subject_index_task, refresh_parcel_subject_index_task
+from .staging import cleanup_staged_payloads_task
+from . import scheduling  # noqa: F401  (connects the scheduler's task signals)
@@ -1,112 +1,49 @@
 # pages/tasks/analyze.py
 
 
-import environ
+import multiprocessing
 import os
-import gzip
-import re
-from io import BytesIO
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
 
-import boto3
+import environ
 import numpy as np
 import pandas as pd
-from PIL import Image
-from botocore.client import Config
 from celery import shared_task
-from nilearn.maskers import NiftiMasker
 import nibabel as nib
-from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
-from tqdm import tqdm
-
-from sqlalchemy_utils.db_utils import determine_filetype, fetch_2mm_mni152_mask
-from sqlalchemy_utils.db_session import get_session
-from sqlalchemy_utils.models_sqlalchemy_orm import (
-    Subject,
-    Symptom,
-    Domain,
-    Subdomain,
-    ConnectivityFile,
+
+from sqlalchemy_utils.db_utils import fetch_from_s3, fetch_many_from_s3, mask_2mm_mni152
+from sqlalchemy_utils.masked_vector import decode_masked_vector, is_masked_vector
+from sqlalchemy_utils.nifti_stream import write_nifti_gz_stream
+from sqlalchemy_utils.s3_client import S3MultipartWriter
+
+from .chunk_cache import (
+    CHUNK_CACHE_ENABLED,
+    chunk_contribution_keys,
+    get_cached_contribution,
+    put_cached_contribution,
 )
-from scipy.stats import ttest_1samp
+from .decode_cache import decode_result_cache_key, set_cached_decode_result
+from .decode_matrix import get_decode_matrix_generation, get_decode_matrix_rows, load_decode_matrix
+from .decode_stats import correlate_maps, group_statistics
+from .scheduling import get_job_lane, lane_queue, task_queue
+from .staging import delete_staged_payload, load_staged_map, load_staged_nifti, stage_masked_vector, stage_nifti
+from .taxonomy_membership import get_taxonomy_membership
 
 from pfctoolkit import tools
 from pfctoolkit import config
 from pfctoolkit import mapping
-from pfctoolkit import datasets
 
 env = environ.Env()
 
-DO_ACCESS_KEY_ID = env('DO_SPACES_ACCESS_KEY_ID')
-DO_SECRET_ACCESS_KEY = env('DO_SPACES_SECRET_ACCESS_KEY')
-DO_STORAGE_BUCKET_NAME = env('DO_SPACES_BUCKET_NAME')
-DO_S3_ENDPOINT_URL = env('DO_SPACES_ENDPOINT_URL')
-DO_SPACES_LOCATION = env('DO_SPACES_LOCATION', default='nyc3')
-DO_LOCATION = env('DO_LOCATION')
-DO_S3_CUSTOM_DOMAIN = f'{DO_STORAGE_BUCKET_NAME}.{DO_SPACES_LOCATION}.digitaloceanspaces.com'
-
-
-def get_s3_client():
-    """
-    Create and return a boto3 client configured for DigitalOcean Spaces.
-
-    Returns:
-        boto3.client: Configured S3 client.
-    """
-    session = boto3.session.Session()
-    client = session.client(
-        's3',
-        config=Config(s3={'addressing_style': 'virtual'}),
-        region_name=DO_SPACES_LOCATION,
-        endpoint_url=DO_S3_ENDPOINT_URL,
-        aws_access_key_id=DO_ACCESS_KEY_ID,
-        aws_secret_access_key=DO_SECRET_ACCESS_KEY,
-    )
-    return client
-
-
-def fetch_from_s3(filepath):
-    """
-    Fetch and load files from DigitalOcean Spaces using boto3.
-
-    Parameters:
-        filepath (str): Path to the file within the bucket.
-
-    Returns:
-        Various: Loaded file data depending on the file type.
-
-    Raises:
-        Exception: If there is an error fetching the file from S3.
-        ValueError: If the file type is unsupported.
-    """
-    bucket_name = DO_STORAGE_BUCKET_NAME
-    s3_client = get_s3_client()
-
-    try:
-        response = s3_client.get_object(Bucket=bucket_name, Key=os.path.join(DO_LOCATION, filepath))
-        file_data = response['Body'].read()
-    except Exception as e:
-        raise Exception(f"Error fetching file from S3: {str(e)}")
-
-    extension = determine_filetype(filepath)
-
-    if extension == 'nii.gz':
-        fh = nib.FileHolder(fileobj=gzip.GzipFile(fileobj=BytesIO(file_data)))
-        return nib.Nifti1Image.from_file_map({'header': fh, 'image': fh})
-
-    elif extension == 'nii':
-        fh = nib.FileHolder(fileobj=BytesIO(file_data))
-        return nib.Nifti1Image.from_file_map({'header': fh, 'image': fh})
-
-    elif extension == 'npy':
-        return np.load(BytesIO(file_data), allow_pickle=True)
-
-    elif extension in ['png', 'jpg', 'jpeg']:
-        return Image.open(BytesIO(file_data))
-
-    else:
-        raise ValueError(f"Unsupported file type: {extension}")
+PCC_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'GSP1000_MF_91v_3209c.json')
+# Parallel workers for pfctoolkit chunks in compute_connectivity_map; 1 runs them serially.
+# Every Celery child process starts its own pool, so keep this at most CPUs / worker concurrency
+CONNECTIVITY_MAP_WORKERS = env.int('CONNECTIVITY_MAP_WORKERS', default=1)
+# Subject maps missing from the decode matrix that are fetched and correlated at a time
+MISSING_MAP_BLOCK = 64
 
 
 def get_taxonomy_files(is_staff, taxonomy_level: str = "symptom") -> pd.DataFrame:
@@ -124,97 +61,23 @@ def get_taxonomy_files(is_staff, taxonomy_level: str = "symptom") -> pd.DataFram
     Raises:
         ValueError: If taxonomy_level is not one of the specified options.
     """
-    if taxonomy_level not in ["symptom", "subdomain", "domain"]:
-        raise ValueError("taxonomy_level must be one of: symptom, subdomain, domain")
+    membership = get_taxonomy_membership(is_staff, taxonomy_level)
+    return taxonomy_membership_to_frame(membership, taxonomy_level)
 
-    session = get_session()
-
-    try:
-        # Retrieve subjects with relevant connectivity files
-        subjects_with_conn = (
-            session.query(Subject)
-            .join(Subject.connectivity_files)
-            .filter(ConnectivityFile.filetype.in_(['nii', 'nii.gz']))
-            .distinct()
-            .all()
-        )
-
-        if not is_staff:
-            subjects_with_conn = [s for s in subjects_with_conn if not s.internal_use_only]
-
-        # Prepare data for DataFrame
-        data = []
-        for subject in subjects_with_conn:
-            conn_file = next(
-                (cf.path for cf in subject.connectivity_files if cf.filetype in ['nii', 'nii.gz']),
-                None
-            )
-            if conn_file:
-                data.append({'subject_id': subject.id, 'conn': conn_file})
-
-        df = pd.DataFrame(data)
-        if df.empty:
-            return df
-
-        subject_ids = [s.id for s in subjects_with_conn]
-
-        if taxonomy_level == "symptom":
-            taxonomy_items = (
-                session.query(Symptom)
-                .join(Symptom.subjects)
-                .filter(Subject.id.in_(subject_ids))
-                .distinct()
-                .all()
-            )
-            if not is_staff:
-                taxonomy_items = [s for s in taxonomy_items if not s.internal_use_only]
-
-            for symptom in taxonomy_items:
-                df[f"symptom_{symptom.name}"] = df['subject_id'].apply(
-                    lambda x: 1 if symptom in session.query(Subject).get(x).symptoms else 0
-                )
-
-        elif taxonomy_level == "subdomain":
-            taxonomy_items = (
-                session.query(Subdomain)
-                .join(Subdomain.symptoms)
-                .join(Symptom.subjects)
-                .filter(Subject.id.in_(subject_ids))
-                .distinct()
-                .all()
-            )
-
-            for subdomain in taxonomy_items:
-                df[f"subdomain_{subdomain.name}"] = df['subject_id'].apply(
-                    lambda x: 1 if any(
-                        symptom in session.query(Subject).get(x).symptoms
-                        for symptom in subdomain.symptoms
-                    ) else 0
-                )
-
-        else:  # domain
-            taxonomy_items = (
-                session.query(Domain)
-                .join(Domain.subdomains)
-                .join(Subdomain.symptoms)
-                .join(Symptom.subjects)
-                .filter(Subject.id.in_(subject_ids))
-                .distinct()
-                .all()
-            )
 
-            for domain in taxonomy_items:
-                df[f"domain_{domain.name}"] = df['subject_id'].apply(
-                    lambda x: 1 if any(
-                        symptom in session.query(Subject).get(x).symptoms
-                        for subdomain in domain.subdomains
-                        for symptom in subdomain.symptoms
-                    ) else 0
-                )
-    finally:
-        session.close()
+def taxonomy_membership_to_frame(membership, taxonomy_level: str) -> pd.DataFrame:
+    """
+    Expand a taxonomy membership matrix into the subject DataFrame returned by get_taxonomy_files.
+    """
+    df = pd.DataFrame({'subject_id': membership.subject_ids, 'conn': membership.conn_paths})
+    if df.empty:
+        return df
 
-    return df
+    taxonomy_columns = pd.DataFrame(
+        membership.matrix.toarray().astype(int),
+        columns=[f"{taxonomy_level}_{name}" for name in membership.item_names],
+    )
+    return pd.concat([df, taxonomy_columns], axis=1)
 
 
 def get_taxonomy_columns(df: pd.DataFrame, taxonomy_level: str) -> list:
@@ -232,111 +95,173 @@ def get_taxonomy_columns(df: pd.DataFrame, taxonomy_level: str) -> list:
 
 
 def save_to_s3(nifti_image: nib.Nifti1Image, s3_path: str) -> str:
-    buffer = BytesIO()
-    nifti_image.to_file_map({'image': nib.FileHolder(fileobj=buffer)})
-    buffer.seek(0)
-    
-    # Compress the data using gzip
-    gzipped_buffer = BytesIO()
-    with gzip.GzipFile(fileobj=gzipped_buffer, mode='wb') as gz_file:
-        gz_file.write(buffer.getvalue())
-    gzipped_buffer.seek(0)
-    
-    # Save to S3 using Django's default storage
-    file_content = ContentFile(gzipped_buffer.read())
-    saved_path = default_storage.save(s3_path, file_content)
-    return saved_path
+    """
+    Save a NIfTI image to S3 as .nii.gz, gzipping in chunks straight into a multipart upload.
+
+    Uses the same object parameters default_storage gave .nii.gz files (public-read,
+    Content-Type application/gzip) without holding the raw or compressed file in memory.
+
+    Returns:
+        str: The path the image was saved under (relative to DO_LOCATION).
+    """
+    with S3MultipartWriter(s3_path, content_type='application/gzip') as s3_file:
+        write_nifti_gz_stream(nifti_image, s3_file)
+    return s3_path
 
 
 @shared_task(bind=True)
-def decode_task_wrapper(self, taxonomy_level, user_uploaded_nifti_data, is_staff):
+def decode_task_wrapper(self, taxonomy_level, staged_map_key, is_staff, map_hash=None):
     """
     Wrapper for decode_task to handle progress updates.
 
     Args:
         taxonomy_level (str): The taxonomy level to group by.
-        user_uploaded_nifti_data (bytes): The raw NIFTI data uploaded by the user.
+        staged_map_key (str): Staging key of the uploaded map, a masked vector or NIFTI (see pages/tasks/staging.py).
         is_staff (bool): Indicates if the user is a staff member.
+        map_hash (str, optional): hash_masked_map of the uploaded map, to cache the result under.
 
     Returns:
         dict: The result from decode_task.
     """
-    return decode_task(taxonomy_level, user_uploaded_nifti_data, is_staff, task_instance=self)
+    try:
+        user_uploaded_map = load_staged_map(staged_map_key)
+    except FileNotFoundError:
+        raise ValueError("The uploaded map has expired; please upload it again.")
+    # The result is cached under the generation of the matrix this node actually decodes with
+    decode_matrix = load_decode_matrix()
+    matrix_generation = decode_matrix.generation if decode_matrix is not None else get_decode_matrix_generation()
+    try:
+        result = decode_task(taxonomy_level, user_uploaded_map, is_staff, task_instance=self, decode_matrix=decode_matrix)
+    finally:
+        delete_staged_payload(staged_map_key)
+    if map_hash:
+        set_cached_decode_result(decode_result_cache_key(map_hash, taxonomy_level, is_staff, matrix_generation), result)
+    return result
+
+
+def correlate_with_subject_maps(query_maps, conn_paths, progress_callback=None, decode_matrix=None,
+                                conn_md5s=None) -> np.ndarray:
+    """
+    Correlate one or more masked query maps with the connectivity maps at conn_paths.
+
+    Subject maps come from the memory-mapped decode matrix instead of one S3 fetch per
+    subject; files added since it was last built are fetched from S3, MISSING_MAP_BLOCK
+    at a time.
+
+    Args:
+        query_maps (np.ndarray): Shape (n_mask_voxels,) or (n_queries, n_mask_voxels).
+        conn_paths (list): Connectivity file paths, one per subject.
+        progress_callback (callable, optional): Called as progress_callback(done, total).
+        decode_matrix (Bunch, optional): Decode matrix to use. Defaults to load_decode_matrix().
+        conn_md5s (list, optional): ConnectivityFile.md5 of each path, so fetched files are looked up
+            in the file cache without a HEAD request for their ETag.
+
+    Returns:
+        np.ndarray: Correlations of shape (n_subjects,) or (n_queries, n_subjects).
+    """
+    if decode_matrix is None:
+        decode_matrix = load_decode_matrix()
+    matrix_rows = get_decode_matrix_rows(decode_matrix, conn_paths)
+    in_matrix = matrix_rows >= 0
+    total = len(conn_paths)
+
+    # All correlations with blocked matrix products instead of one np.corrcoef per subject
+    spatial_correl = np.full(np.shape(query_maps)[:-1] + (total,), np.nan)
+    if in_matrix.any():
+        spatial_correl[..., in_matrix] = correlate_maps(
+            query_maps,
+            decode_matrix.matrix,
+            rows=matrix_rows[in_matrix],
+            subject_means=decode_matrix.row_means,
+            subject_stds=decode_matrix.row_stds,
+            progress_callback=progress_callback,
+        )
+    if not in_matrix.all():
+        # Connectivity files added since the decode matrix was last built
+        missing_columns = np.flatnonzero(~in_matrix)
+        missing_maps = fetch_many_from_s3(
+            [conn_paths[column] for column in missing_columns],
+            [conn_md5s[column] for column in missing_columns] if conn_md5s is not None else None,
+        )
+        n_done = int(in_matrix.sum())
+        for start in range(0, len(missing_columns), MISSING_MAP_BLOCK):
+            columns = missing_columns[start:start + MISSING_MAP_BLOCK]
+            block = np.empty((len(columns), np.shape(query_maps)[-1]), dtype=np.float32)
+            for row in range(len(columns)):
+                block[row] = np.squeeze(mask_2mm_mni152(next(missing_maps)))
+            spatial_correl[..., columns] = correlate_maps(query_maps, block)
+            n_done += len(columns)
+            if progress_callback:
+                progress_callback(n_done, total)
+    return spatial_correl
 
 
 @shared_task
-def decode_task(taxonomy_level, user_uploaded_nifti_data, is_staff, task_instance=None):
+def decode_task(taxonomy_level, user_uploaded_nifti_data, is_staff, task_instance=None, decode_matrix=None):
     """
     Decode a NIFTI image and group results by taxonomy level.
     This function runs asynchronously as a Celery task.
 
     Args:
         taxonomy_level (str): The taxonomy level to group by ("symptom", "subdomain", "domain").
-        user_uploaded_nifti_data (bytes): The raw NIFTI data uploaded by the user.
+        user_uploaded_nifti_data: The user's map as in-mask values (np.ndarray), masked vector
+            bytes (see sqlalchemy_utils/masked_vector.py), a Nifti1Image or raw NIFTI bytes.
         is_staff (bool): Indicates if the user is a staff member.
+        decode_matrix (Bunch, optional): Decode matrix to correlate against. Defaults to load_decode_matrix().
 
     Returns:
         dict: Contains grouped results and raw results, or error messages.
     """
-    # Reconstruct the in-memory NIFTI image
-    if not isinstance(user_uploaded_nifti_data, nib.Nifti1Image):
-        in_memory_nifti = nib.Nifti1Image.from_bytes(user_uploaded_nifti_data)
+    # Only the in-mask voxels are used; masked vectors skip the NIFTI entirely
+    if isinstance(user_uploaded_nifti_data, np.ndarray):
+        user_uploaded_nifti = np.ravel(user_uploaded_nifti_data)
+    elif is_masked_vector(user_uploaded_nifti_data):
+        user_uploaded_nifti = decode_masked_vector(user_uploaded_nifti_data)
     else:
-        in_memory_nifti = user_uploaded_nifti_data
+        if not isinstance(user_uploaded_nifti_data, nib.Nifti1Image):
+            user_uploaded_nifti_data = nib.Nifti1Image.from_bytes(user_uploaded_nifti_data)
+        user_uploaded_nifti = np.squeeze(mask_2mm_mni152(user_uploaded_nifti_data))
 
-    # Get the base dataframe with all taxonomy columns
-    df = get_taxonomy_files(is_staff, taxonomy_level)
+    # Subjects with connectivity maps and their (sparse) taxonomy memberships
+    membership = get_taxonomy_membership(is_staff, taxonomy_level)
+    df = taxonomy_membership_to_frame(membership, taxonomy_level)
     if df.empty:
         return {'error': 'No taxonomy files found.'}
 
-    # Set up the masker
-    masker = NiftiMasker(mask_img=fetch_2mm_mni152_mask())
-    masker.fit()
-
-    # Transform the user uploaded NIFTI
-    user_uploaded_nifti = np.squeeze(masker.transform(in_memory_nifti))
+    total = len(df)
 
-    df['spatial_correl'] = 0
-
-    # Calculate correlations, but instead of df.apply, df.iterrows()
-    for index, row in df.iterrows():
-        df.loc[index, 'spatial_correl'] = np.corrcoef(user_uploaded_nifti, np.squeeze(masker.transform(fetch_from_s3(row['conn']))))[0, 1]
+    def report_progress(done, _):
         if task_instance:
             task_instance.update_state(
                 state='PROGRESS',
                 meta={
-                    'current': index,
-                    'total': len(df),
-                    'progress': int((index / len(df)) * 100),
-                    'status': f'Calculating correlation for subject {index + 1} of {len(df)}'
+                    'current': done,
+                    'total': total,
+                    'progress': int((done / total) * 100),
+                    'status': f'Calculating correlation for subject {done} of {total}'
                 }
             )
 
-    # Get relevant taxonomy columns
-    taxonomy_cols = get_taxonomy_columns(df, taxonomy_level)
-    if not taxonomy_cols:
+    spatial_correl = correlate_with_subject_maps(
+        user_uploaded_nifti, membership.conn_paths, report_progress, decode_matrix, membership.conn_md5s
+    )
+    df['spatial_correl'] = spatial_correl
+
+    if not membership.item_names:
         return {'error': f'No columns found for taxonomy level: {taxonomy_level}'}
 
-    # Create results for each taxonomy item
-    results = []
-    for col in taxonomy_cols:
-        relevant_correlations = df[df[col] == 1]['spatial_correl']
-        if not relevant_correlations.empty:
-            # Do a one-sample t-test on the correlations to see if they are significantly different from 0
-            t_stat, p_val = ttest_1samp(relevant_correlations, 0)
-            taxonomy_name = col.replace(f"{taxonomy_level}_", "")  # Remove prefix
-            results.append({
-                'taxonomy_item': taxonomy_name,
-                'mean_correlation': relevant_correlations.mean(),
-                't_statistic': t_stat,
-                'std_correlation': relevant_correlations.std(),
-                'n_subjects': len(relevant_correlations),
-                'max_correlation': relevant_correlations.max(),
-                'min_correlation': relevant_correlations.min()
-            })
-
-    # Convert results to DataFrame and sort
-    results_df = pd.DataFrame(results)
+    # Mean, std, min, max, n and one-sample t-test against 0 for every taxonomy item at once
+    stats = group_statistics(spatial_correl, membership.matrix)
+    results_df = pd.DataFrame({
+        'taxonomy_item': membership.item_names,
+        'mean_correlation': stats['mean'],
+        't_statistic': stats['t'],
+        'std_correlation': stats['std'],
+        'n_subjects': stats['n'],
+        'max_correlation': stats['max'],
+        'min_correlation': stats['min'],
+    })
+    results_df = results_df[results_df['n_subjects'] > 0]
     if not results_df.empty:
         results_df = results_df.sort_values('mean_correlation', ascending=False)
 
@@ -363,23 +288,81 @@ def decode_from_generated_connectivity_map(paths_dict, taxonomy_level='symptom',
     return results
 
 
-def compute_connectivity_map(nifti_data_bytes, task_instance=None):
-    try:
-        roi_img = nib.Nifti1Image.from_bytes(nifti_data_bytes)
-        pcc_config = config.Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'GSP1000_MF_91v_3209c.json'), stat='t', use_default_dir=False)
-        brain_mask = datasets.get_img(pcc_config.get("mask"))
-        roi_paths = tools.load_roi(roi_img)
-        chunks = tools.get_chunks(roi_paths, pcc_config)
-        atlas = {}
-        current_timestamp_int = int(time.time())
-        roi_path = save_to_s3(roi_img, f"generated_content/{current_timestamp_int}_roi.nii.gz")
+@lru_cache(maxsize=None)
+def _get_pcc_config():
+    return config.Config(PCC_CONFIG_PATH, stat='t', use_default_dir=False)
+
+
+def _process_chunk(chunk, chunk_rois):
+    # Module-level so it can run in a pool process; each process loads the config once
+    return mapping.process_chunk(chunk, chunk_rois, _get_pcc_config(), 't')
+
+
+def _tree_reduce_atlas(levels: list, contribution):
+    """
+    Fold one chunk contribution into a binary-counter tree of partial atlases.
+
+    levels[i] is None or the merge of 2**i contributions, so every contribution takes
+    part in O(log n) merges of similarly sized partial sums rather than being added to
+    one ever-growing running total. Partial atlases have the same structure as chunk
+    contributions, so update_atlas merges both.
+    """
+    level = 0
+    while level < len(levels) and levels[level] is not None:
+        contribution = mapping.update_atlas(contribution, levels[level], 't')
+        levels[level] = None
+        level += 1
+    if level == len(levels):
+        levels.append(contribution)
+    else:
+        levels[level] = contribution
 
-        total_chunks = len(chunks)
-        processed_chunks = 0
-        progress = 0
 
-        print(f"Found {total_chunks} chunks to process.")
-        
+def _finish_tree_reduce(levels: list) -> dict:
+    atlas = {}
+    for partial in levels:
+        if partial is not None:
+            atlas = mapping.update_atlas(partial, atlas, 't')
+    return atlas
+
+
+def _chunk_executor(n_workers: int):
+    """
+    Process pool for the chunks, or a thread pool inside a daemonic process (e.g. a Celery
+    prefork child), which may not start children of its own. The numpy work in
+    process_chunk releases the GIL, so threads still run the chunks concurrently.
+    """
+    if multiprocessing.current_process().daemon:
+        return ThreadPoolExecutor(max_workers=n_workers)
+    return ProcessPoolExecutor(max_workers=n_workers)
+
+
+def generate_connectivity_map(roi_img: nib.Nifti1Image, task_instance=None, n_workers: int = None,
+                              use_chunk_cache: bool = True) -> nib.Nifti1Image:
+    """
+    Compute the lesion network map (T map) of an ROI with pfctoolkit.
+
+    Args:
+        roi_img (nib.Nifti1Image): The ROI.
+        task_instance (celery.Task, optional): Task to report chunk progress on.
+        n_workers (int, optional): Chunks processed in parallel. Defaults to CONNECTIVITY_MAP_WORKERS.
+        use_chunk_cache (bool): Read and write per-chunk contributions in the chunk cache.
+
+    Returns:
+        nib.Nifti1Image: The connectivity map.
+    """
+    pcc_config = _get_pcc_config()
+    roi_paths = tools.load_roi(roi_img)
+    chunks = tools.get_chunks(roi_paths, pcc_config)
+
+    total_chunks = len(chunks)
+    processed_chunks = 0
+    progress = 0
+    n_workers = n_workers or CONNECTIVITY_MAP_WORKERS
+
+    print(f"Found {total_chunks} chunks to process.")
+
+    def report_progress():
         if task_instance:
             task_instance.update_state(
                 state='PROGRESS',
@@ -391,43 +374,113 @@ def compute_connectivity_map(nifti_data_bytes, task_instance=None):
                 }
             )
 
-        for chunk in chunks:
-            contribution = mapping.process_chunk(chunk, chunks[chunk], pcc_config, 't')
-            atlas = mapping.update_atlas(contribution, atlas, 't')
+    report_progress()
+
+    # Chunks are independent; contributions are combined as they complete
+    levels = []
+
+    # With a single ROI, chunks whose ROI weights were seen before come from the chunk cache
+    chunk_keys = {}
+    if use_chunk_cache and CHUNK_CACHE_ENABLED and len(roi_paths) == 1:
+        try:
+            chunk_keys = chunk_contribution_keys(roi_img, chunks, pcc_config, PCC_CONFIG_PATH)
+        except Exception as e:
+            print(f"Chunk cache unavailable for this ROI: {str(e)}")
+    pending_chunks = []
+    for chunk in chunks:
+        cached = get_cached_contribution(chunk_keys[chunk]) if chunk in chunk_keys else None
+        if cached is None:
+            pending_chunks.append(chunk)
+            continue
+        _tree_reduce_atlas(levels, {roi_paths[0]: cached})
+        processed_chunks += 1
+    if chunk_keys:
+        print(f"{processed_chunks} of {total_chunks} chunks served from the chunk cache.")
+        progress = int((processed_chunks / total_chunks) * 100)
+        report_progress()
+
+    n_workers = max(1, min(n_workers, len(pending_chunks)))
+    if n_workers == 1:
+        contributions = (
+            (chunk, mapping.process_chunk(chunk, chunks[chunk], pcc_config, 't')) for chunk in pending_chunks
+        )
+    else:
+        executor = _chunk_executor(n_workers)
+        futures = {executor.submit(_process_chunk, chunk, chunks[chunk]): chunk for chunk in pending_chunks}
+        contributions = ((futures[future], future.result()) for future in as_completed(futures))
+    try:
+        for chunk, contribution in contributions:
+            if chunk in chunk_keys and len(contribution) == 1:
+                # Stored without the ROI name, which differs between requests
+                value = next(iter(contribution.values()))
+                put_cached_contribution(chunk_keys[chunk], value)
+                contribution = {roi_paths[0]: value}
+            _tree_reduce_atlas(levels, contribution)
             processed_chunks += 1
             progress = int((processed_chunks / total_chunks) * 100)
-            
+
             print(f"Processed {processed_chunks} chunks. Progress: {progress}%")
-            
-            if task_instance:
-                task_instance.update_state(
-                    state='PROGRESS',
-                    meta={
-                        'current': processed_chunks,
-                        'total': total_chunks,
-                        'progress': progress,
-                        'status': f'Processing chunk {processed_chunks} of {total_chunks}'
-                    }
-                )
-
-        maps = mapping.publish_atlas(atlas, "", pcc_config, 't', save_to_dir=False)
-
-        first_map = maps[0]
-        for key, value in first_map.items():
-            filename = f"generated_content/{current_timestamp_int}_connectivity.nii.gz"
-            connectivity_path = save_to_s3(value, filename)
-            return {'connectivity_path': connectivity_path, 'roi_path': roi_path}
-
-        raise ValueError("No connectivity maps were generated.")
-        
+            report_progress()
+    finally:
+        if n_workers > 1:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+    atlas = _finish_tree_reduce(levels)
+
+    maps = mapping.publish_atlas(atlas, "", pcc_config, 't', save_to_dir=False)
+
+    first_map = maps[0]
+    for key, value in first_map.items():
+        return value
+
+    raise ValueError("No connectivity maps were generated.")
+
+
+def compute_connectivity_map(roi_img, task_instance=None, n_workers: int = None):
+    """
+    Compute the lesion network map of an ROI with pfctoolkit and save the ROI and map to S3.
+
+    Args:
+        roi_img (nib.Nifti1Image or bytes): The ROI.
+        task_instance (celery.Task, optional): Task to report chunk progress on.
+        n_workers (int, optional): Chunks processed in parallel. Defaults to CONNECTIVITY_MAP_WORKERS.
+
+    Returns:
+        dict: `connectivity_path` and `roi_path` on S3.
+    """
+    try:
+        if not isinstance(roi_img, nib.Nifti1Image):
+            roi_img = nib.Nifti1Image.from_bytes(roi_img)
+        current_timestamp_int = int(time.time())
+        roi_path = save_to_s3(roi_img, f"generated_content/{current_timestamp_int}_roi.nii.gz")
+
+        connectivity_map = generate_connectivity_map(roi_img, task_instance=task_instance, n_workers=n_workers)
+        filename = f"generated_content/{current_timestamp_int}_connectivity.nii.gz"
+        connectivity_path = save_to_s3(connectivity_map, filename)
+        return {'connectivity_path': connectivity_path, 'roi_path': roi_path}
+
     except Exception as e:
         print(f"Error in compute_connectivity_map: {str(e)}")
         raise
 
 
 @shared_task(bind=True)
-def run_full_lesion_analysis(self, nifti_data_bytes, taxonomy_level='symptom', is_staff=False):
+def run_full_lesion_analysis(self, staged_roi_key, taxonomy_level='symptom', is_staff=False):
+    """
+    Stage 1 of lesion analysis (mapping queue): compute the connectivity map of a staged ROI.
+
+    The map is handed to decode_lesion_map through the staging volume, and this task is
+    replaced by it, so the client keeps polling the same task id. The ROI and map are
+    uploaded to S3 by upload_staged_nifti in the background, off the critical path.
+    """
     try:
+        try:
+            roi_img = load_staged_nifti(staged_roi_key)
+        except FileNotFoundError:
+            raise ValueError("The submitted lesion has expired; please submit it again.")
+        delete_staged_payload(staged_roi_key)
+
         # Step 1: Compute Connectivity Map
         self.update_state(
             state='PROGRESS',
@@ -438,7 +491,7 @@ def run_full_lesion_analysis(self, nifti_data_bytes, taxonomy_level='symptom', i
                 'status': 'Starting connectivity map computation...'
             }
         )
-        compute_result = compute_connectivity_map(nifti_data_bytes, task_instance=self)
+        connectivity_map = generate_connectivity_map(roi_img, task_instance=self)
         self.update_state(
             state='PROGRESS',
             meta={
@@ -449,29 +502,78 @@ def run_full_lesion_analysis(self, nifti_data_bytes, taxonomy_level='symptom', i
             }
         )
 
-        # Step 2: Decode from Generated Connectivity Map
-        self.update_state(
-            state='PROGRESS',
-            meta={
-                'current_step': 2,
-                'total_steps': 2,
-                'progress': 60,
-                'status': 'Starting decoding of connectivity map...'
-            }
-        )
-        paths_dict = compute_result
-        decode_result = decode_from_generated_connectivity_map(paths_dict, taxonomy_level, is_staff, task_instance=self)
-        self.update_state(
-            state='PROGRESS',
-            meta={
-                'current_step': 2,
-                'total_steps': 2,
-                'progress': 100,
-                'status': 'Decoding completed.'
-            }
-        )
-        return decode_result
+        current_timestamp_int = int(time.time())
+        paths_dict = {
+            'roi_path': f"generated_content/{current_timestamp_int}_roi.nii.gz",
+            'connectivity_path': f"generated_content/{current_timestamp_int}_connectivity.nii.gz",
+        }
+        upload_staged_nifti.delay(stage_nifti(roi_img), paths_dict['roi_path'])
+        upload_staged_nifti.delay(stage_nifti(connectivity_map), paths_dict['connectivity_path'])
+
+        # Step 2 runs on the decode queue, from the in-mask values only
+        staged_map_key = stage_masked_vector(mask_2mm_mni152(connectivity_map)[0])
 
     except Exception as e:
         print(f"Error in run_full_lesion_analysis: {str(e)}")
         raise
+
+    # The decode stage stays in the lane the job was submitted to
+    decode_queue = lane_queue(task_queue(decode_lesion_map.name), get_job_lane(self.request.id))
+    raise self.replace(
+        decode_lesion_map.s(staged_map_key, paths_dict, taxonomy_level, is_staff).set(queue=decode_queue)
+    )
+
+
+@shared_task(bind=True)
+def decode_lesion_map(self, staged_map_key, paths_dict, taxonomy_level='symptom', is_staff=False):
+    """
+    Stage 2 of lesion analysis (decode queue): decode the connectivity map staged by run_full_lesion_analysis.
+
+    Args:
+        staged_map_key (str): Staging key of the map's in-mask values.
+        paths_dict (dict): `connectivity_path` and `roi_path` the map and ROI are uploaded to.
+        taxonomy_level (str): The taxonomy level to group by.
+        is_staff (bool): Indicates if the user is a staff member.
+
+    Returns:
+        dict: The decode_task result plus `connectivity_map_url` and `lesion_mask_url`.
+    """
+    self.update_state(
+        state='PROGRESS',
+        meta={
+            'current_step': 2,
+            'total_steps': 2,
+            'progress': 60,
+            'status': 'Starting decoding of connectivity map...'
+        }
+    )
+    try:
+        connectivity_values = load_staged_map(staged_map_key)
+    except FileNotFoundError:
+        raise ValueError("The connectivity map has expired; please submit the lesion again.")
+    try:
+        results = decode_task(taxonomy_level, connectivity_values, is_staff, task_instance=self)
+    finally:
+        delete_staged_payload(staged_map_key)
+
+    # URLs are known up front; the uploads finish independently
+    results.update({
+        'connectivity_map_url': default_storage.url(paths_dict['connectivity_path']),
+        'lesion_mask_url': default_storage.url(paths_dict['roi_path'])
+    })
+    return results
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5)
+def upload_staged_nifti(staged_key, s3_path):
+    """
+    Upload a staged NIfTI to S3 and delete it from the staging volume.
+    """
+    try:
+        nifti_image = load_staged_nifti(staged_key)
+    except FileNotFoundError:
+        print(f"Staged upload for {s3_path} has expired; skipping.")
+        return None
+    save_to_s3(nifti_image, s3_path)
+    delete_staged_payload(staged_key)
+    return s3_path
@@ -0,0 +1,311 @@
+# pages/tasks/batch_decode.py
+
+"""
+Decode many maps in one task.
+
+The web process only checks the uploads (NIfTI files, masked vectors, or zip/tar archives
+of them, within BATCH_DECODE_MAX_MAP_BYTES per map and BATCH_DECODE_MAX_TOTAL_BYTES in
+all) and stages them as uploaded. The task masks every map straight into one staged
+(n_maps x n_mask_voxels) float32 array, then correlates blocks of BATCH_DECODE_QUERY_BLOCK maps against the decode matrix with one
+matrix product per block of subject maps, so each pass over the subject maps serves a
+whole block of queries, and groups all of a block's correlations with one sparse product.
+Grouped results stream to S3 as gzipped CSV (or Parquet when pyarrow is installed),
+one block at a time.
+"""
+
+import gzip
+import io
+import os
+import tarfile
+import time
+import zipfile
+import zlib
+
+import environ
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from celery import shared_task
+from django.core.files.storage import default_storage
+
+from sqlalchemy_utils.db_utils import get_2mm_mni152_masker, mask_2mm_mni152
+from sqlalchemy_utils.masked_vector import MASKED_VECTOR_EXTENSION, decode_masked_vector, is_masked_vector
+from sqlalchemy_utils.s3_client import S3MultipartWriter
+
+from .analyze import correlate_with_subject_maps
+from .decode_stats import group_statistics
+from .staging import delete_staged_payload, load_staged_array, open_staged_payload, stage_array
+from .taxonomy_membership import get_taxonomy_membership
+
+env = environ.Env()
+
+BATCH_DECODE_MAX_MAPS = 1000
+# Uncompressed size limits, so archives and .nii.gz files cannot expand without bound
+BATCH_DECODE_MAX_MAP_BYTES = env.int('BATCH_DECODE_MAX_MAP_BYTES', default=128 * 1024 ** 2)
+BATCH_DECODE_MAX_TOTAL_BYTES = env.int('BATCH_DECODE_MAX_TOTAL_BYTES', default=8 * 1024 ** 3)
+# Query maps correlated per pass over the subject maps
+BATCH_DECODE_QUERY_BLOCK = 128
+BATCH_DECODE_FORMATS = ['csv', 'parquet']
+MAP_EXTENSIONS = ('.nii', '.nii.gz', MASKED_VECTOR_EXTENSION)
+
+
+def _is_map_name(name: str) -> bool:
+    return name.lower().endswith(MAP_EXTENSIONS) and not os.path.basename(name).startswith('.')
+
+
+def _check_map_size(name: str, size: int, total: int) -> int:
+    if size > BATCH_DECODE_MAX_MAP_BYTES:
+        raise ValueError(f"{name} is larger than {BATCH_DECODE_MAX_MAP_BYTES // 1024 ** 2} MB.")
+    total += size
+    if total > BATCH_DECODE_MAX_TOTAL_BYTES:
+        raise ValueError(f"The maps are larger than {BATCH_DECODE_MAX_TOTAL_BYTES // 1024 ** 2} MB in total.")
+    return total
+
+
+def list_uploaded_maps(uploaded_files) -> list:
+    """
+    List the maps in uploaded files, looking inside .zip, .tar and .tar.gz archives.
+
+    Only archive directories are read, and every map is checked against BATCH_DECODE_MAX_MAP_BYTES
+    and BATCH_DECODE_MAX_TOTAL_BYTES using its (uncompressed) member size.
+
+    Args:
+        uploaded_files (list): (name, binary file object) pairs.
+
+    Returns:
+        list: (name, read) pairs, where read() returns the map's raw bytes. Archives are
+        read lazily, so they must stay open until the maps have been read.
+    """
+    maps = []
+    total = 0
+    for name, uploaded_file in uploaded_files:
+        lower_name = name.lower()
+        if lower_name.endswith('.zip'):
+            try:
+                archive = zipfile.ZipFile(uploaded_file)
+            except zipfile.BadZipFile:
+                raise ValueError(f"{name} is not a valid zip archive.")
+            for member in archive.infolist():
+                if not member.is_dir() and _is_map_name(member.filename):
+                    # ZipExtFile stops at the declared file_size, so the check holds for the read too
+                    total = _check_map_size(member.filename, member.file_size, total)
+                    maps.append((member.filename, lambda archive=archive, member=member: archive.read(member)))
+        elif lower_name.endswith(('.tar', '.tar.gz', '.tgz')):
+            try:
+                archive = tarfile.open(fileobj=uploaded_file, mode='r:*')
+                members = archive.getmembers()
+            except tarfile.TarError:
+                raise ValueError(f"{name} is not a valid tar archive.")
+            for member in members:
+                if member.isfile() and _is_map_name(member.name):
+                    total = _check_map_size(member.name, member.size, total)
+                    maps.append((member.name, lambda archive=archive, member=member: archive.extractfile(member).read()))
+        elif _is_map_name(name):
+            uploaded_file.seek(0, os.SEEK_END)
+            total = _check_map_size(name, uploaded_file.tell(), total)
+            uploaded_file.seek(0)
+            maps.append((name, lambda uploaded_file=uploaded_file: uploaded_file.read()))
+        else:
+            raise ValueError(f"Unsupported file: {name}. Upload NIfTI files, masked vectors or zip/tar archives of them.")
+    return maps
+
+
+def _gunzip_bounded(data: bytes, max_size: int) -> bytes:
+    """gzip.decompress that refuses to produce more than max_size bytes."""
+    chunks = []
+    remaining = max_size
+    while data:
+        if remaining <= 0:
+            raise ValueError(f"Decompressed map is larger than {max_size // 1024 ** 2} MB.")
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks.append(decompressor.decompress(data, remaining))
+        if decompressor.unconsumed_tail or (not decompressor.eof and len(chunks[-1]) == remaining):
+            raise ValueError(f"Decompressed map is larger than {max_size // 1024 ** 2} MB.")
+        if not decompressor.eof:
+            raise ValueError("Compressed map is truncated.")
+        remaining -= len(chunks[-1])
+        # Concatenated gzip members decompress to the concatenation of their contents
+        data = decompressor.unused_data
+    return b''.join(chunks)
+
+
+def mask_map_bytes(data: bytes) -> np.ndarray:
+    """
+    In-mask values (2mm MNI152 mask order) of one NIfTI, gzipped NIfTI or masked vector.
+    """
+    if is_masked_vector(data):
+        return decode_masked_vector(data)
+    if data[:2] == b'\x1f\x8b':
+        data = _gunzip_bounded(data, BATCH_DECODE_MAX_MAP_BYTES)
+    img = nib.Nifti1Image.from_bytes(data)
+    if len(img.shape) > 3 and img.shape[3] != 1:
+        raise ValueError("Only 3D maps can be batch decoded.")
+    return mask_2mm_mni152(img)[0]
+
+
+def fill_masked_maps(maps: list, progress_callback=None):
+    """
+    Returns a function that writes the in-mask values of maps (from list_uploaded_maps)
+    into consecutive rows of an array, for staging.stage_array.
+    progress_callback, if given, is called as progress_callback(done, total).
+    """
+    def fill(array):
+        for row, (name, read) in enumerate(maps):
+            try:
+                array[row] = mask_map_bytes(read())
+            except Exception as e:
+                raise ValueError(f"Could not read {name}: {str(e)}")
+            if progress_callback:
+                progress_callback(row + 1, len(maps))
+    return fill
+
+
+def check_output_format(output_format: str):
+    """Raise ValueError for unknown formats, or Parquet without the optional pyarrow."""
+    if output_format not in BATCH_DECODE_FORMATS:
+        raise ValueError(f"Format must be one of: {', '.join(BATCH_DECODE_FORMATS)}")
+    if output_format == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise ValueError("Parquet output needs pyarrow, which is not installed; use csv.")
+
+
+def batch_decode_shape(n_maps: int) -> tuple:
+    return n_maps, len(get_2mm_mni152_masker().flat_indices)
+
+
+class _ParquetBlockWriter:
+    """Writes one Parquet row group per block of results into a binary stream."""
+
+    def __init__(self, fileobj):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.fileobj = fileobj
+        self.writer = None
+
+    def write(self, frame: pd.DataFrame):
+        table = self.pyarrow.Table.from_pandas(frame, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.fileobj, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class _CsvBlockWriter:
+    """Writes blocks of results as one gzipped CSV into a binary stream."""
+
+    def __init__(self, fileobj):
+        self.gz_file = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6)
+        self.text = io.TextIOWrapper(self.gz_file, encoding='utf-8', newline='')
+        self.header = True
+
+    def write(self, frame: pd.DataFrame):
+        frame.to_csv(self.text, header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()
+        self.gz_file.close()
+
+
+@shared_task(bind=True)
+def batch_decode_task(self, staged_uploads, taxonomy_level='symptom', is_staff=False, output_format='csv'):
+    """
+    Mask and decode the maps of staged uploads and stream grouped results per map to S3.
+
+    Args:
+        staged_uploads (list): [staging key, uploaded file name] of each upload (see stage_uploaded_file).
+        taxonomy_level (str): The taxonomy level to group by ("symptom", "subdomain", "domain").
+        is_staff (bool): Indicates if the user is a staff member.
+        output_format (str): 'csv' (gzipped) or 'parquet'.
+
+    Returns:
+        dict: `results_path` and `results_url` of the results file, `n_maps` and `n_subjects`.
+    """
+    check_output_format(output_format)
+    uploads = []
+    staged_maps_key = None
+    try:
+        try:
+            for key, name in staged_uploads:
+                uploads.append((name, open_staged_payload(key)))
+        except FileNotFoundError:
+            raise ValueError("The uploaded maps have expired; please upload them again.")
+
+        # Mask every map into one staged array, so the maps are never all in memory
+        maps = list_uploaded_maps(uploads)
+        map_names = [name for name, _ in maps]
+        n_maps = len(maps)
+
+        def report_masking(done, total):
+            self.update_state(
+                state='PROGRESS',
+                meta={'current': 0, 'total': total, 'progress': 0, 'status': f'Read {done} of {total} maps'}
+            )
+
+        staged_maps_key = stage_array(batch_decode_shape(n_maps), np.float32, fill_masked_maps(maps, report_masking))
+        query_maps = load_staged_array(staged_maps_key)
+        for _, upload in uploads:
+            upload.close()
+
+        membership = get_taxonomy_membership(is_staff, taxonomy_level)
+        if not membership.subject_ids or not membership.item_names:
+            return {'error': 'No taxonomy files found.'}
+        item_names = np.asarray(membership.item_names, dtype=object)
+
+        extension = 'parquet' if output_format == 'parquet' else 'csv.gz'
+        results_path = f"generated_content/{int(time.time())}_{self.request.id}_batch_decode.{extension}"
+        content_type = 'application/octet-stream' if output_format == 'parquet' else 'application/gzip'
+        with S3MultipartWriter(results_path, content_type=content_type) as s3_file:
+            writer = _ParquetBlockWriter(s3_file) if output_format == 'parquet' else _CsvBlockWriter(s3_file)
+            for start in range(0, n_maps, BATCH_DECODE_QUERY_BLOCK):
+                stop = min(start + BATCH_DECODE_QUERY_BLOCK, n_maps)
+                correlations = correlate_with_subject_maps(
+                    np.asarray(query_maps[start:stop]), membership.conn_paths, conn_md5s=membership.conn_md5s
+                )
+                stats = group_statistics(correlations, membership.matrix)
+
+                # One row per (map, taxonomy item) with at least one subject
+                has_subjects = stats['n'] > 0
+                block_size = stop - start
+                writer.write(pd.DataFrame({
+                    'map': np.repeat(np.asarray(map_names[start:stop], dtype=object), has_subjects.sum()),
+                    'taxonomy_item': np.tile(item_names[has_subjects], block_size),
+                    'mean_correlation': stats['mean'][:, has_subjects].ravel(),
+                    't_statistic': stats['t'][:, has_subjects].ravel(),
+                    'std_correlation': stats['std'][:, has_subjects].ravel(),
+                    'n_subjects': np.tile(stats['n'][has_subjects], block_size),
+                    'max_correlation': stats['max'][:, has_subjects].ravel(),
+                    'min_correlation': stats['min'][:, has_subjects].ravel(),
+                }))
+
+                self.update_state(
+                    state='PROGRESS',
+                    meta={
+                        'current': stop,
+                        'total': n_maps,
+                        'progress': int((stop / n_maps) * 100),
+                        'status': f'Decoded {stop} of {n_maps} maps'
+                    }
+                )
+            writer.close()
+    finally:
+        for _, upload in uploads:
+            upload.close()
+        for key, _ in staged_uploads:
+            delete_staged_payload(key)
+        if staged_maps_key:
+            delete_staged_payload(staged_maps_key)
+
+    return {
+        'results_path': results_path,
+        'results_url': default_storage.url(results_path),
+        'n_maps': n_maps,
+        'n_subjects': len(membership.subject_ids),
+    }
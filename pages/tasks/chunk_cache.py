@@ -0,0 +1,209 @@
+# pages/tasks/chunk_cache.py
+
+"""
+Disk cache of per-chunk pfctoolkit contributions for lesion network mapping.
+
+A chunk's contribution to a lesion network map depends only on the connectome
+configuration and on the ROI's voxel weights inside that chunk. Lesions drawn in the
+browser are usually edited a few voxels at a time, so most chunks of a new ROI have
+exactly the weights they had in an earlier one. Contributions are keyed by
+
+    sha256(connectome config, chunk id, ROI weights at the chunk's voxels)
+
+and only chunks whose weights changed are sent to mapping.process_chunk.
+
+Entries are pickled to CHUNK_CACHE_DIR with an atomic rename, and the least recently
+used entries are evicted once the cache grows beyond CHUNK_CACHE_MAX_BYTES.
+"""
+
+import fcntl
+import gzip
+import hashlib
+import os
+import pickle
+import threading
+from functools import lru_cache
+
+import environ
+import nibabel as nib
+import numpy as np
+
+from sqlalchemy_utils.db_utils import LOCAL_DATA_DIR
+
+env = environ.Env()
+
+CHUNK_CACHE_ENABLED = env.bool('CHUNK_CACHE_ENABLED', default=True)
+CHUNK_CACHE_DIR = env('CHUNK_CACHE_DIR', default=os.path.join(LOCAL_DATA_DIR, 'chunk_cache'))
+CHUNK_CACHE_MAX_BYTES = env.int('CHUNK_CACHE_MAX_BYTES', default=10 * 1024 ** 3)
+# Evict down to this fraction of the limit so eviction does not run on every write
+CHUNK_CACHE_EVICT_TO = 0.9
+# Bytes this process may add before it rescans the cache for eviction
+CHUNK_CACHE_EVICT_CHECK_BYTES = CHUNK_CACHE_MAX_BYTES * 0.05
+
+_bytes_since_eviction_check = 0
+_eviction_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _config_digest(config_path: str, stat: str) -> bytes:
+    with open(config_path, 'rb') as f:
+        return hashlib.sha256(f.read() + b'\0' + stat.encode()).digest()
+
+
+def _fetch_chunk_index(chunk_idx_path: str) -> str:
+    """Local copy of the connectome's chunk index image, downloaded once per node."""
+    if not chunk_idx_path.startswith('s3://'):
+        return chunk_idx_path
+
+    local_path = os.path.join(
+        CHUNK_CACHE_DIR, 'chunk_idx', hashlib.sha256(chunk_idx_path.encode()).hexdigest()[:16] + '.nii.gz'
+    )
+    if not os.path.exists(local_path):
+        # The precomputed connectome lives in AWS S3, read with the default credentials like pfctoolkit does
+        import boto3
+        bucket, key = chunk_idx_path[len('s3://'):].split('/', 1)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp_path = f"{local_path}.{os.getpid()}.tmp"
+        boto3.client('s3').download_file(bucket, key, tmp_path)
+        os.replace(tmp_path, local_path)
+    return local_path
+
+
+@lru_cache(maxsize=None)
+def get_chunk_voxels(chunk_idx_path: str) -> dict:
+    """
+    Map each chunk id of a chunk index image to its flat (C-order) voxel indices.
+
+    Returns:
+        dict: chunk id (int) -> np.ndarray of voxel indices, plus the key 'shape'
+        with the grid shape of the chunk index.
+    """
+    img = nib.load(_fetch_chunk_index(chunk_idx_path))
+    labels = np.asarray(img.dataobj).astype(np.int64).reshape(-1)
+    order = np.argsort(labels, kind='stable')
+    chunk_ids, starts = np.unique(labels[order], return_index=True)
+    voxels = {
+        int(chunk_id): indices
+        for chunk_id, indices in zip(chunk_ids, np.split(order, starts[1:]))
+        if chunk_id > 0
+    }
+    voxels['shape'] = img.shape[:3]
+    return voxels
+
+
+def chunk_contribution_keys(roi_img, chunk_ids, pcc_config, config_path: str, stat: str = 't') -> dict:
+    """
+    Cache keys for the chunk contributions of a single ROI.
+
+    Args:
+        roi_img (nib.Nifti1Image): The ROI, on the connectome's grid.
+        chunk_ids (iterable): Chunks the ROI touches, as returned by tools.get_chunks.
+        pcc_config (pfctoolkit.config.Config): The connectome configuration.
+        config_path (str): Path of the configuration file, hashed into every key.
+        stat (str): The pfctoolkit statistic being computed.
+
+    Returns:
+        dict: chunk id -> key, for every chunk that can be cached. Empty if the ROI is
+        not on the chunk index grid.
+    """
+    voxels = get_chunk_voxels(pcc_config.get("chunk_idx"))
+    roi_data = np.asarray(roi_img.dataobj)
+    if roi_data.shape[:3] != voxels['shape']:
+        return {}
+    roi_weights = roi_data.reshape(-1)
+
+    config_digest = _config_digest(config_path, stat)
+    keys = {}
+    for chunk in chunk_ids:
+        chunk_voxels = voxels.get(int(chunk))
+        if chunk_voxels is None:
+            continue
+        digest = hashlib.sha256(config_digest)
+        digest.update(str(int(chunk)).encode() + b'\0')
+        digest.update(np.ascontiguousarray(roi_weights[chunk_voxels], dtype=np.float64).tobytes())
+        keys[chunk] = digest.hexdigest()
+    return keys
+
+
+def _entry_path(key: str) -> str:
+    return os.path.join(CHUNK_CACHE_DIR, key[:2], f'{key}.pkl.gz')
+
+
+def get_cached_contribution(key: str):
+    """
+    Return the cached contribution for key, or None.
+    """
+    path = _entry_path(key)
+    try:
+        with gzip.open(path, 'rb') as f:
+            contribution = pickle.load(f)
+        # Mark as recently used for LRU eviction
+        os.utime(path)
+    except (FileNotFoundError, EOFError, OSError, pickle.UnpicklingError):
+        return None
+    return contribution
+
+
+def put_cached_contribution(key: str, contribution):
+    path = _entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with gzip.open(tmp_path, 'wb', compresslevel=1) as f:
+            pickle.dump(contribution, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    global _bytes_since_eviction_check
+    with _eviction_lock:
+        _bytes_since_eviction_check += size
+        evict = _bytes_since_eviction_check >= CHUNK_CACHE_EVICT_CHECK_BYTES
+        if evict:
+            _bytes_since_eviction_check = 0
+    if evict:
+        evict_chunk_cache()
+
+
+def evict_chunk_cache(max_bytes: int = None):
+    """
+    Remove least recently used contributions until the cache fits in max_bytes.
+
+    Only one process evicts at a time; others skip eviction rather than wait.
+    """
+    max_bytes = CHUNK_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    os.makedirs(CHUNK_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CHUNK_CACHE_DIR, '.evict.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        entries = []
+        for directory in os.scandir(CHUNK_CACHE_DIR):
+            if not directory.is_dir() or directory.name == 'chunk_idx':
+                continue
+            for entry in os.scandir(directory.path):
+                if not entry.name.endswith('.pkl.gz'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        if total <= max_bytes:
+            return
+        target = max_bytes * CHUNK_CACHE_EVICT_TO
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,71 @@
+# pages/tasks/decode_cache.py
+
+"""
+Redis-backed cache of decode results, so re-submitting the same map skips the Celery task.
+
+Keys combine a hash of the masked voxel data with the taxonomy level, the staff flag,
+the generation of the decode matrix the result was computed with and a generation
+counter of their own. That counter is bumped whenever connectivity files or symptom
+assignments change (see pages/signals.py, and file_to_file_table and
+insert_parcelwise_file in sqlalchemy_utils/db_utils.py), which invalidates every
+cached result at once without scanning Redis.
+"""
+
+import hashlib
+
+import numpy as np
+from django.core.cache import cache
+
+from .decode_matrix import get_decode_matrix_generation
+
+DECODE_RESULT_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+DECODE_RESULT_GENERATION_KEY = 'decode_result:generation'
+
+
+def hash_masked_map(masked_map) -> str:
+    """
+    Hash a masked user map (in-mask voxels only) as float32.
+    """
+    return hashlib.sha256(np.ascontiguousarray(masked_map, dtype=np.float32).tobytes()).hexdigest()
+
+
+def decode_result_cache_key(map_hash: str, taxonomy_level: str, is_staff: bool, matrix_generation: int = None) -> str:
+    """
+    Cache key of a decode result.
+
+    Args:
+        matrix_generation (int, optional): Decode matrix generation the result was computed
+            with. Defaults to the current one, which is what lookups need; a result computed
+            on a node whose matrix is stale is stored under its older generation.
+    """
+    generation = cache.get(DECODE_RESULT_GENERATION_KEY, 0)
+    if matrix_generation is None:
+        matrix_generation = get_decode_matrix_generation()
+    return (
+        f"decode_result:{generation}:{matrix_generation}:{taxonomy_level}:"
+        f"{'staff' if is_staff else 'public'}:{map_hash}"
+    )
+
+
+def get_cached_decode_result(key: str):
+    """
+    Return the cached decode_task result for key, or None.
+    """
+    return cache.get(key)
+
+
+def set_cached_decode_result(key: str, result: dict):
+    # Errors are not cached so a transient failure is retried on the next submission
+    if result and 'error' not in result:
+        cache.set(key, result, DECODE_RESULT_CACHE_TIMEOUT)
+
+
+def invalidate_decode_results():
+    """
+    Invalidate every cached decode result by moving to a new key generation.
+    """
+    try:
+        cache.incr(DECODE_RESULT_GENERATION_KEY)
+    except ValueError:
+        # No generation stored yet (or it was evicted)
+        cache.set(DECODE_RESULT_GENERATION_KEY, 1, None)
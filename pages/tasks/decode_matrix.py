@@ -0,0 +1,416 @@
+# pages/tasks/decode_matrix.py
+
+"""
+Persistent, versioned "decode matrix" of subject connectivity maps.
+
+Every nii/nii.gz row in connectivity_files is masked with the 2mm MNI152 brain mask
+and stored as one float32 row of a (n_rows x n_mask_voxels) .npy array on local disk.
+Worker processes memory-map the current version, so decoding a user map no longer needs
+one S3 fetch per subject.
+
+Layout of DECODE_MATRIX_DIR:
+    decode_matrix_v000001.npy    float32 array with a row per connectivity file, plus
+                                 DECODE_MATRIX_SPARE_ROWS unused rows
+    decode_matrix_v000001.json   manifest: file ids, subject ids, paths, md5s and matrix row
+                                 of each file, and the matrix file the rows are in
+    current.json                 pointer to the active version
+
+Incremental updates write new files into the spare rows of the current matrix file, past
+every row a manifest refers to, and publish a new manifest for it; only when the spare
+rows run out (or the mask changes) is a new, compacted matrix file written.
+
+Each node keeps its own copy. Changes to connectivity files bump a generation counter in
+the shared cache (mark_decode_matrix_stale), and every manifest records the generation it
+was built for, so a process that loads an older matrix rebuilds its node's copy in a
+background thread. Cached decode results are keyed on the generation of the matrix that
+computed them.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+import environ
+import numpy as np
+from celery import shared_task
+from django.core.cache import cache
+from sklearn.utils import Bunch
+
+from sqlalchemy_utils.db_utils import LOCAL_DATA_DIR, fetch_many_from_s3, get_2mm_mni152_masker, mask_2mm_mni152
+from sqlalchemy_utils.db_session import get_session
+from sqlalchemy_utils.s3_client import get_s3_connection_stats
+from sqlalchemy_utils.models_sqlalchemy_orm import ConnectivityFile
+from .decode_stats import map_statistics
+
+env = environ.Env()
+
+DECODE_MATRIX_DIR = os.path.join(LOCAL_DATA_DIR, 'decode_matrix')
+DECODE_MATRIX_FILETYPES = ['nii', 'nii.gz']
+DECODE_MATRIX_VERSIONS_TO_KEEP = 2
+# Unused rows allocated with every new matrix file, for incremental updates to append into
+DECODE_MATRIX_SPARE_ROWS = env.int('DECODE_MATRIX_SPARE_ROWS', default=512)
+# Minimum seconds between background rebuilds of a stale matrix started by one process
+DECODE_MATRIX_REBUILD_INTERVAL = env.int('DECODE_MATRIX_REBUILD_INTERVAL', default=60)
+# Shared across nodes; bumped whenever the connectivity files change
+DECODE_MATRIX_GENERATION_KEY = 'decode_matrix:generation'
+
+# Memory-mapped matrices already opened by this process, keyed by version
+_loaded_decode_matrices = {}
+_rebuild_lock = threading.Lock()
+_rebuild_thread = None
+_last_rebuild_started = 0.0
+
+
+def _matrix_path(version: int) -> str:
+    return os.path.join(DECODE_MATRIX_DIR, f'decode_matrix_v{version:06d}.npy')
+
+
+def _manifest_path(version: int) -> str:
+    return os.path.join(DECODE_MATRIX_DIR, f'decode_matrix_v{version:06d}.json')
+
+
+def _current_pointer_path() -> str:
+    return os.path.join(DECODE_MATRIX_DIR, 'current.json')
+
+
+def _write_json_atomic(path: str, data: dict):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def get_current_decode_matrix_version():
+    """
+    Return the version number of the active decode matrix, or None if none has been built.
+    """
+    try:
+        with open(_current_pointer_path(), 'r') as f:
+            return json.load(f)['version']
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+
+
+def get_decode_matrix_generation() -> int:
+    """
+    Return the shared decode matrix generation; a matrix built for an older one is stale.
+    """
+    return cache.get(DECODE_MATRIX_GENERATION_KEY, 0)
+
+
+def mark_decode_matrix_stale():
+    """
+    Bump the shared generation, so every node rebuilds its decode matrix the next time it is used.
+    """
+    try:
+        cache.incr(DECODE_MATRIX_GENERATION_KEY)
+    except ValueError:
+        # No generation stored yet (or it was evicted)
+        cache.set(DECODE_MATRIX_GENERATION_KEY, 1, None)
+
+
+def load_decode_matrix(version=None):
+    """
+    Memory-map a decode matrix and its manifest.
+
+    Loading the current version also checks it against the shared generation, and starts a
+    background rebuild of this node's matrix if it is stale. The stale matrix is still
+    returned; files missing from it are fetched from S3 by the caller.
+
+    Args:
+        version (int, optional): Version to load. Defaults to the current version.
+
+    Returns:
+        Bunch or None: With attributes `version`, `generation`, `matrix` (read-only memmap
+        of shape (n_rows, n_mask_voxels)), `capacity` (rows in the matrix file), `file_ids`,
+        `subject_ids`, `paths`, `md5s`, `rows` (matrix row of each file), `row_means` and
+        `row_stds` (per matrix row) and `row_index` (path -> matrix row). None if no decode
+        matrix has been built yet.
+    """
+    if version is not None:
+        return _load_decode_matrix_version(version)
+
+    decode_matrix = _load_decode_matrix_version(get_current_decode_matrix_version())
+    if decode_matrix is not None and decode_matrix.generation < get_decode_matrix_generation():
+        _rebuild_in_background()
+    return decode_matrix
+
+
+def _load_decode_matrix_version(version):
+    if version is None:
+        return None
+
+    if version in _loaded_decode_matrices:
+        return _loaded_decode_matrices[version]
+
+    with open(_manifest_path(version), 'r') as f:
+        manifest = json.load(f)
+
+    # Manifests written before in-place appends hold rows 0..n-1 of their own matrix file
+    n_files = len(manifest['paths'])
+    rows = np.asarray(manifest.get('rows', range(n_files)), dtype=np.intp)
+    file_matrix = np.load(_matrix_path(manifest.get('matrix_version', version)), mmap_mode='r')
+    # Rows past n_rows are spare, or being written by a newer version
+    matrix = file_matrix[:manifest.get('n_rows', n_files)]
+    if 'row_means' not in manifest:
+        # Manifests written before row statistics were recorded
+        manifest['row_means'], manifest['row_stds'] = map_statistics(matrix)
+    row_means = np.full(len(matrix), np.nan)
+    row_stds = np.full(len(matrix), np.nan)
+    row_means[rows] = manifest['row_means']
+    row_stds[rows] = manifest['row_stds']
+    decode_matrix = Bunch(
+        version=version,
+        matrix_version=manifest.get('matrix_version', version),
+        generation=manifest.get('generation', 0),
+        matrix=matrix,
+        capacity=len(file_matrix),
+        n_voxels=manifest['n_voxels'],
+        file_ids=manifest['file_ids'],
+        subject_ids=manifest['subject_ids'],
+        paths=manifest['paths'],
+        md5s=manifest['md5s'],
+        rows=rows,
+        row_means=row_means,
+        row_stds=row_stds,
+        row_index=dict(zip(manifest['paths'], rows.tolist())),
+    )
+
+    # Only keep the most recent version open in this process
+    _loaded_decode_matrices.clear()
+    _loaded_decode_matrices[version] = decode_matrix
+    return decode_matrix
+
+
+def list_decode_matrix_files(session) -> list:
+    """
+    List every connectivity file that belongs in the decode matrix.
+
+    Returns:
+        list: Dicts with id, subject_id, path and md5, ordered by file id.
+    """
+    rows = (
+        session.query(ConnectivityFile.id, ConnectivityFile.subject_id, ConnectivityFile.path, ConnectivityFile.md5)
+        .filter(ConnectivityFile.filetype.in_(DECODE_MATRIX_FILETYPES))
+        .order_by(ConnectivityFile.id)
+        .all()
+    )
+    return [{'id': r.id, 'subject_id': r.subject_id, 'path': r.path, 'md5': r.md5} for r in rows]
+
+
+def _remove_old_versions(current_version: int):
+    kept_versions = range(current_version - DECODE_MATRIX_VERSIONS_TO_KEEP + 1, current_version + 1)
+    # Versions written by in-place appends keep their rows in an older version's matrix file
+    kept_matrices = set()
+    for version in kept_versions:
+        try:
+            with open(_manifest_path(version), 'r') as f:
+                kept_matrices.add(json.load(f).get('matrix_version', version))
+        except (FileNotFoundError, ValueError):
+            continue
+
+    for filename in os.listdir(DECODE_MATRIX_DIR):
+        if not filename.startswith('decode_matrix_v'):
+            continue
+        try:
+            version = int(filename[len('decode_matrix_v'):].split('.')[0])
+        except ValueError:
+            continue
+        if version in kept_matrices and filename == os.path.basename(_matrix_path(version)):
+            continue
+        if version <= current_version - DECODE_MATRIX_VERSIONS_TO_KEEP:
+            try:
+                os.remove(os.path.join(DECODE_MATRIX_DIR, filename))
+            except FileNotFoundError:
+                pass
+
+
+def build_decode_matrix(incremental: bool = True, wait: bool = True) -> int:
+    """
+    Build (or incrementally update) the decode matrix from all connectivity files.
+
+    Rows of the current version whose path and md5 are unchanged are reused; only new or
+    modified files are fetched from S3. When the current matrix file has enough spare rows,
+    the fetched files are written into them in place and only a new manifest is written;
+    otherwise the reused rows are copied into a new matrix file. Rows for files that no
+    longer exist are dropped from the manifest. A new version is only written if something
+    changed, or if the current one was built for an older generation.
+
+    Args:
+        incremental (bool): Reuse rows from the current version where possible.
+        wait (bool): Wait for a build already running on this node instead of returning
+            the current version.
+
+    Returns:
+        int: The version number of the decode matrix that is now current.
+    """
+    os.makedirs(DECODE_MATRIX_DIR, exist_ok=True)
+
+    # Serialize builds across worker processes on this node
+    with open(os.path.join(DECODE_MATRIX_DIR, '.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("A decode matrix build is already running on this node.")
+            return get_current_decode_matrix_version()
+
+        # Read before listing the files, so changes made during the build leave the new version stale
+        generation = get_decode_matrix_generation()
+        session = get_session()
+        try:
+            files = list_decode_matrix_files(session)
+        finally:
+            session.close()
+
+        n_voxels = len(get_2mm_mni152_masker().flat_indices)
+
+        current = _load_decode_matrix_version(get_current_decode_matrix_version()) if incremental else None
+        if current is not None and current.n_voxels != n_voxels:
+            print("Decode matrix mask has changed; rebuilding from scratch.")
+            current = None
+
+        reusable_rows = {}
+        if current is not None:
+            reusable_rows = {(path, md5): row for path, md5, row in zip(current.paths, current.md5s, current.rows.tolist())}
+        to_fetch = [f for f in files if (f['path'], f['md5']) not in reusable_rows]
+        if current is not None and not to_fetch and len(files) == len(current.paths) and current.generation >= generation:
+            print(f"Decode matrix v{current.version} is up to date.")
+            return current.version
+
+        version = (get_current_decode_matrix_version() or 0) + 1
+        # Rows past current.n_rows are not referenced by any manifest, so they can be written in place
+        in_place = current is not None and len(current.matrix) + len(to_fetch) <= current.capacity
+        if in_place:
+            matrix_version = current.matrix_version
+            matrix = np.load(_matrix_path(matrix_version), mmap_mode='r+')
+            next_row = len(current.matrix)
+        else:
+            matrix_version = version
+            tmp_path = f"{_matrix_path(version)}.{os.getpid()}.tmp"
+            matrix = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=np.float32, shape=(len(files) + DECODE_MATRIX_SPARE_ROWS, n_voxels)
+            )
+            next_row = 0
+
+        # New or modified files are downloaded concurrently, in the order they are consumed below
+        fetched = fetch_many_from_s3(
+            [f['path'] for f in to_fetch], [f['md5'] for f in to_fetch], return_exceptions=True
+        )
+
+        included, rows, row_means, row_stds = [], [], [], []
+        n_fetched = 0
+        start = time.time()
+        for f in files:
+            existing_row = reusable_rows.get((f['path'], f['md5']))
+            if existing_row is not None:
+                if in_place:
+                    row = existing_row
+                else:
+                    row = next_row
+                    matrix[row] = current.matrix[existing_row]
+                    next_row += 1
+                row_means.append(float(current.row_means[existing_row]))
+                row_stds.append(float(current.row_stds[existing_row]))
+            else:
+                row = next_row
+                try:
+                    img = next(fetched)
+                    if isinstance(img, Exception):
+                        raise img
+                    matrix[row] = np.squeeze(mask_2mm_mni152(img))
+                except Exception as e:
+                    # The row is left for the next file
+                    print(f"Skipping {f['path']} in decode matrix: {str(e)}")
+                    continue
+                next_row += 1
+                # Row statistics let the decode task z-score subject maps without another pass
+                row_values = np.asarray(matrix[row], dtype=np.float64)
+                row_means.append(float(row_values.mean()))
+                row_stds.append(float(row_values.std()))
+                n_fetched += 1
+            included.append(f)
+            rows.append(row)
+
+        matrix.flush()
+        del matrix
+
+        if not in_place:
+            os.replace(tmp_path, _matrix_path(version))
+        _write_json_atomic(_manifest_path(version), {
+            'version': version,
+            'matrix_version': matrix_version,
+            'generation': generation,
+            'n_voxels': n_voxels,
+            'n_rows': next_row,
+            'built_at': time.time(),
+            'file_ids': [f['id'] for f in included],
+            'subject_ids': [f['subject_id'] for f in included],
+            'paths': [f['path'] for f in included],
+            'md5s': [f['md5'] for f in included],
+            'rows': rows,
+            'row_means': row_means,
+            'row_stds': row_stds,
+        })
+        _write_json_atomic(_current_pointer_path(), {'version': version})
+        _remove_old_versions(version)
+
+        print(
+            f"Built decode matrix v{version}: {len(included)} rows "
+            f"({n_fetched} fetched, {len(included) - n_fetched} reused, "
+            f"{'appended in place' if in_place else 'new matrix file'}) in {time.time() - start:.1f}s. "
+            f"S3 connections: {get_s3_connection_stats()}"
+        )
+        return version
+
+
+def _rebuild_in_background():
+    """Start a rebuild of this node's stale decode matrix on a daemon thread, at most once per interval."""
+    global _rebuild_thread, _last_rebuild_started
+    with _rebuild_lock:
+        if _rebuild_thread is not None and _rebuild_thread.is_alive():
+            return
+        if time.time() - _last_rebuild_started < DECODE_MATRIX_REBUILD_INTERVAL:
+            return
+        _last_rebuild_started = time.time()
+        _rebuild_thread = threading.Thread(target=_rebuild_stale_decode_matrix, name='decode-matrix-rebuild', daemon=True)
+        _rebuild_thread.start()
+
+
+def _rebuild_stale_decode_matrix():
+    try:
+        # Other processes on this node may notice the same stale matrix; one build is enough
+        build_decode_matrix(incremental=True, wait=False)
+    except Exception as e:
+        print(f"Could not rebuild the stale decode matrix: {str(e)}")
+
+
+def get_decode_matrix_rows(decode_matrix, paths: list) -> np.ndarray:
+    """
+    Map connectivity file paths to rows of the decode matrix.
+
+    Returns:
+        np.ndarray: Row index for each path, or -1 for files added since the matrix
+        was last built (or for every path if no matrix has been built).
+    """
+    if decode_matrix is None:
+        return np.full(len(paths), -1, dtype=np.intp)
+    return np.array([decode_matrix.row_index.get(path, -1) for path in paths], dtype=np.intp)
+
+
+def request_decode_matrix_update():
+    """
+    Mark every node's decode matrix stale and start updating one worker's right away.
+    The other nodes rebuild theirs the next time they load it.
+    """
+    mark_decode_matrix_stale()
+    update_decode_matrix.delay()
+
+
+@shared_task
+def update_decode_matrix():
+    """
+    Celery task to incrementally bring this worker node's decode matrix up to date with connectivity_files.
+    """
+    return build_decode_matrix(incremental=True)
@@ -0,0 +1,164 @@
+# pages/tasks/decode_stats.py
+
+"""
+Vectorized statistics for decoding brain maps against the subject connectivity maps.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+def map_statistics(maps: np.ndarray, block_size: int = 128):
+    """
+    Compute the mean and (population) standard deviation of each row of a stack of maps.
+
+    Args:
+        maps (np.ndarray): Array or memmap of shape (n_maps, n_voxels).
+        block_size (int): Number of rows read into memory at a time.
+
+    Returns:
+        tuple: (means, stds), each a float64 array of shape (n_maps,).
+    """
+    n_maps = maps.shape[0]
+    means = np.empty(n_maps, dtype=np.float64)
+    stds = np.empty(n_maps, dtype=np.float64)
+    for start in range(0, n_maps, block_size):
+        block = np.asarray(maps[start:start + block_size], dtype=np.float64)
+        means[start:start + block_size] = block.mean(axis=1)
+        stds[start:start + block_size] = block.std(axis=1)
+    return means, stds
+
+
+def correlate_maps(query_maps, subject_maps, rows=None, subject_means=None, subject_stds=None,
+                   block_size: int = 128, progress_callback=None) -> np.ndarray:
+    """
+    Pearson correlation of one or more query maps with every subject map.
+
+    The queries are z-scored once and correlated against blocks of subject maps with a
+    single BLAS matrix product per block; subject means and standard deviations are
+    folded in afterwards. The subject stack can be a memory-mapped decode matrix that
+    never has to fit in memory at once.
+
+    Args:
+        query_maps (np.ndarray): Masked query map of shape (n_voxels,), or a stack of
+            query maps of shape (n_queries, n_voxels).
+        subject_maps (np.ndarray): Array or memmap of shape (n_subjects, n_voxels).
+        rows (array-like, optional): Row indices of subject_maps to correlate against.
+            Defaults to all rows.
+        subject_means (np.ndarray, optional): Precomputed per-row means of subject_maps.
+        subject_stds (np.ndarray, optional): Precomputed per-row population standard
+            deviations of subject_maps. Both are computed with an extra pass over
+            subject_maps when not given.
+        block_size (int): Number of subject maps processed per matrix product.
+        progress_callback (callable, optional): Called as progress_callback(done, total)
+            after every block.
+
+    Returns:
+        np.ndarray: Correlations of shape (n_rows,) for a single query map, or
+        (n_queries, n_rows) for a stack of query maps. Constant maps yield NaN,
+        as with np.corrcoef.
+    """
+    single_query = np.ndim(query_maps) == 1
+    queries = np.atleast_2d(np.asarray(query_maps, dtype=np.float64))
+    n_voxels = queries.shape[1]
+    if subject_maps.shape[1] != n_voxels:
+        raise ValueError(
+            f"Query maps have {n_voxels} voxels but subject maps have {subject_maps.shape[1]}."
+        )
+
+    n_subjects = subject_maps.shape[0]
+    rows = np.arange(n_subjects) if rows is None else np.asarray(rows, dtype=np.intp)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        queries_z = (queries - queries.mean(axis=1, keepdims=True)) / queries.std(axis=1, keepdims=True)
+    queries_z = queries_z.astype(np.float32)
+    # sum(x * q_z) = sum((x - mean_x) * q_z) + mean_x * sum(q_z), so subject maps never need centring
+    queries_z_sums = queries_z.sum(axis=1, dtype=np.float64)[:, None]
+
+    if subject_means is None or subject_stds is None:
+        subject_means, subject_stds = map_statistics(subject_maps, block_size=block_size)
+    subject_means = np.asarray(subject_means, dtype=np.float64)
+    subject_stds = np.asarray(subject_stds, dtype=np.float64)
+
+    # Visit rows in storage order so contiguous runs are read as memmap slices without a copy
+    order = np.argsort(rows, kind='stable')
+    sorted_rows = rows[order]
+    correlations = np.empty((queries.shape[0], len(rows)), dtype=np.float64)
+    for start in range(0, len(rows), block_size):
+        block_rows = sorted_rows[start:start + block_size]
+        if block_rows[-1] - block_rows[0] + 1 == len(block_rows):
+            block = subject_maps[block_rows[0]:block_rows[-1] + 1]
+        else:
+            block = subject_maps[block_rows]
+        products = queries_z @ np.asarray(block, dtype=np.float32).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlations[:, order[start:start + block_size]] = (
+                (products - subject_means[block_rows] * queries_z_sums)
+                / (n_voxels * subject_stds[block_rows])
+            )
+
+        if progress_callback:
+            progress_callback(start + len(block_rows), len(rows))
+
+    # Rounding leaves a constant map's centred products slightly off zero, which would divide to +-inf
+    correlations[:, subject_stds[rows] == 0] = np.nan
+    return correlations[0] if single_query else correlations
+
+
+def group_statistics(values, membership) -> dict:
+    """
+    Summary statistics and one-sample t statistics of values for every group at once.
+
+    Equivalent to running ttest_1samp(values[membership[:, j] == 1], 0) and taking the
+    mean, std (ddof=1), min and max for each column j, but computed with sparse matrix
+    products instead of a Python loop over groups. NaN values are left out of every
+    statistic, but still counted in `n`.
+
+    Args:
+        values (np.ndarray): Values of shape (n_members,), e.g. spatial correlations, or
+            (n_queries, n_members) to summarize several sets of values at once.
+        membership (scipy.sparse matrix): 0/1 matrix of shape (n_members, n_groups).
+
+    Returns:
+        dict: Arrays of shape (n_groups,), or (n_queries, n_groups) for 2D values, under
+        the keys `n`, `mean`, `std`, `t`, `min` and `max`. Statistics of groups without
+        valid values are NaN. `n` always has shape (n_groups,).
+    """
+    single_query = np.ndim(values) == 1
+    values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    membership = sparse.csc_matrix(membership, dtype=np.float64, copy=True)
+    membership.eliminate_zeros()
+    valid = ~np.isnan(values)
+    finite_values = np.where(valid, values, 0.0)
+
+    # (membership.T @ x.T).T keeps every product a sparse-times-dense one
+    n = np.asarray(membership.sum(axis=0)).ravel()
+    n_valid = np.asarray(membership.T @ valid.T.astype(np.float64)).T
+    sums = np.asarray(membership.T @ finite_values.T).T
+    sums_of_squares = np.asarray(membership.T @ (finite_values ** 2).T).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(n_valid > 0, sums / n_valid, np.nan)
+        squared_deviations = np.maximum(sums_of_squares - n_valid * mean ** 2, 0.0)
+        std = np.where(n_valid > 1, np.sqrt(squared_deviations / (n_valid - 1)), np.nan)
+        t = mean / (std / np.sqrt(n_valid))
+
+    # Min and max over each column's stored entries of the CSC matrix
+    minimum = np.full(mean.shape, np.nan)
+    maximum = np.full(mean.shape, np.nan)
+    member_values = values[:, membership.indices]
+    has_members = np.diff(membership.indptr) > 0
+    if has_members.any():
+        starts = membership.indptr[:-1][has_members]
+        minimum[:, has_members] = np.minimum.reduceat(
+            np.where(np.isnan(member_values), np.inf, member_values), starts, axis=1
+        )
+        maximum[:, has_members] = np.maximum.reduceat(
+            np.where(np.isnan(member_values), -np.inf, member_values), starts, axis=1
+        )
+    minimum[n_valid == 0] = np.nan
+    maximum[n_valid == 0] = np.nan
+
+    if single_query:
+        mean, std, t, minimum, maximum = mean[0], std[0], t[0], minimum[0], maximum[0]
+    return {'n': n.astype(np.int64), 'mean': mean, 'std': std, 't': t, 'min': minimum, 'max': maximum}
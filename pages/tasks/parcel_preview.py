@@ -0,0 +1,247 @@
+# pages/tasks/parcel_preview.py
+
+"""
+Approximate lesion network maps from a precomputed parcel-level connectome.
+
+For every parcel of the 3209c91v atlas (fetch_atlas_3209c91v) the exact pfctoolkit
+connectivity map is computed once, masked with the 2mm MNI152 mask and stored as one
+float32 row of a memory-mapped (n_parcels x n_mask_voxels) array. A lesion's preview
+map is then the average of the maps of the parcels it overlaps, weighted by the ROI
+weight inside each parcel, which takes a few reads and one small matrix product
+instead of the full voxelwise computation.
+
+Layout of PARCEL_CONNECTOME_DIR:
+    parcel_maps.npy     float32 array, one row per parcel
+    manifest.json       parcel labels per row, n_voxels, connectome config name
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import nibabel as nib
+import numpy as np
+from celery import shared_task
+from django.core.cache import cache
+from sklearn.utils import Bunch
+
+from sqlalchemy_utils.db_utils import LOCAL_DATA_DIR, fetch_atlas_3209c91v, get_2mm_mni152_masker, mask_2mm_mni152
+from .analyze import CONNECTIVITY_MAP_WORKERS, PCC_CONFIG_PATH, decode_task, generate_connectivity_map
+from .decode_matrix import get_decode_matrix_rows, load_decode_matrix
+from .staging import delete_staged_payload, load_staged_nifti
+from .taxonomy_membership import get_taxonomy_membership
+
+PARCEL_CONNECTOME_DIR = os.path.join(LOCAL_DATA_DIR, 'parcel_connectome')
+# Taxonomy items returned with a preview, and how long it is kept for the progress page
+LESION_PREVIEW_RESULTS = 10
+LESION_PREVIEW_CACHE_TIMEOUT = 60 * 60
+# Preview tasks still queued after this many seconds are dropped; the exact result is close by then
+LESION_PREVIEW_TASK_EXPIRES = 60 * 5
+
+_loaded_parcel_connectome = None
+
+
+def _maps_path() -> str:
+    return os.path.join(PARCEL_CONNECTOME_DIR, 'parcel_maps.npy')
+
+
+def _manifest_path() -> str:
+    return os.path.join(PARCEL_CONNECTOME_DIR, 'manifest.json')
+
+
+@lru_cache(maxsize=None)
+def _get_parcel_labels():
+    """Flat (C-order) parcel label of every voxel, and the atlas grid shape and affine."""
+    atlas = fetch_atlas_3209c91v()
+    labels = np.asarray(atlas.maps.dataobj).astype(np.int64)
+    return labels.reshape(-1), labels.shape[:3], atlas.maps.affine
+
+
+def _parcel_map(label: int) -> np.ndarray:
+    # Module-level so it can run in a pool process
+    flat_labels, shape, affine = _get_parcel_labels()
+    roi_img = nib.Nifti1Image((flat_labels == label).astype(np.float32).reshape(shape), affine)
+    connectivity_map = generate_connectivity_map(roi_img, n_workers=1, use_chunk_cache=False)
+    return np.squeeze(mask_2mm_mni152(connectivity_map)).astype(np.float32)
+
+
+def build_parcel_connectome(n_workers: int = None):
+    """
+    Compute the connectivity map of every 3209c91v parcel and store them for previews.
+
+    This runs the full pfctoolkit computation once per parcel, so it is meant to be run
+    once per worker node (like build_decode_matrix), not per request.
+
+    Args:
+        n_workers (int, optional): Parcels computed in parallel. Defaults to CONNECTIVITY_MAP_WORKERS.
+    """
+    os.makedirs(PARCEL_CONNECTOME_DIR, exist_ok=True)
+    flat_labels, _, _ = _get_parcel_labels()
+    parcel_labels = np.unique(flat_labels)
+    parcel_labels = parcel_labels[parcel_labels > 0]
+    n_voxels = len(get_2mm_mni152_masker().flat_indices)
+
+    tmp_path = f"{_maps_path()}.{os.getpid()}.tmp"
+    maps = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(parcel_labels), n_voxels))
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers or CONNECTIVITY_MAP_WORKERS) as executor:
+            for row, values in enumerate(executor.map(_parcel_map, parcel_labels.tolist(), chunksize=4)):
+                maps[row] = values
+                if (row + 1) % 100 == 0:
+                    print(f"Computed {row + 1} of {len(parcel_labels)} parcel maps ({time.time() - start:.0f}s).")
+        maps.flush()
+        del maps
+        os.replace(tmp_path, _maps_path())
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    manifest = {
+        'labels': parcel_labels.tolist(),
+        'n_voxels': n_voxels,
+        'config': os.path.basename(PCC_CONFIG_PATH),
+        'built_at': time.time(),
+    }
+    tmp_manifest_path = f"{_manifest_path()}.{os.getpid()}.tmp"
+    with open(tmp_manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest_path, _manifest_path())
+    print(f"Parcel connectome built with {len(parcel_labels)} parcels in {time.time() - start:.0f}s.")
+
+
+def load_parcel_connectome():
+    """
+    Memory-map the parcel connectome, reloading it if it was rebuilt.
+
+    Returns:
+        Bunch or None: With attributes `maps` (read-only memmap of shape
+        (n_parcels, n_mask_voxels)), `labels` and `label_rows` (parcel label -> row,
+        -1 for labels without a map). None if it has not been built.
+    """
+    global _loaded_parcel_connectome
+    try:
+        manifest_mtime = os.stat(_manifest_path()).st_mtime
+    except FileNotFoundError:
+        return None
+    if _loaded_parcel_connectome is not None and _loaded_parcel_connectome.manifest_mtime == manifest_mtime:
+        return _loaded_parcel_connectome
+
+    with open(_manifest_path(), 'r') as f:
+        manifest = json.load(f)
+    labels = np.asarray(manifest['labels'], dtype=np.int64)
+    label_rows = np.full(labels.max() + 1 if len(labels) else 1, -1, dtype=np.int64)
+    label_rows[labels] = np.arange(len(labels))
+    _loaded_parcel_connectome = Bunch(
+        maps=np.load(_maps_path(), mmap_mode='r'),
+        labels=labels,
+        label_rows=label_rows,
+        n_voxels=manifest['n_voxels'],
+        manifest_mtime=manifest_mtime,
+    )
+    return _loaded_parcel_connectome
+
+
+def compute_preview_map(roi_img: nib.Nifti1Image, parcel_connectome=None):
+    """
+    Approximate the connectivity map of an ROI from the parcel connectome.
+
+    Args:
+        roi_img (nib.Nifti1Image): The ROI, on the 3209c91v atlas grid.
+        parcel_connectome (Bunch, optional): From load_parcel_connectome.
+
+    Returns:
+        np.ndarray or None: float32 in-mask values of the preview map (2mm MNI152 mask
+        order), or None if the parcel connectome is not built or the ROI touches no parcel.
+    """
+    if parcel_connectome is None:
+        parcel_connectome = load_parcel_connectome()
+    if parcel_connectome is None:
+        return None
+
+    flat_labels, shape, affine = _get_parcel_labels()
+    roi = np.asarray(roi_img.dataobj)
+    if roi.shape[:3] != shape:
+        raise ValueError(f"ROI shape {roi.shape[:3]} does not match the parcel atlas {shape}.")
+    if not np.allclose(roi_img.affine, affine):
+        raise ValueError("ROI affine does not match the parcel atlas.")
+    roi = roi.reshape(-1)
+
+    # ROI weight inside each parcel
+    in_roi = np.flatnonzero(roi)
+    weights = np.bincount(flat_labels[in_roi], weights=np.abs(roi[in_roi]), minlength=len(parcel_connectome.label_rows))
+    weights = weights[:len(parcel_connectome.label_rows)]
+    weights[0] = 0
+    labels = np.flatnonzero(weights)
+    rows = parcel_connectome.label_rows[labels]
+    labels, rows = labels[rows >= 0], rows[rows >= 0]
+    if len(rows) == 0:
+        return None
+
+    # Sorted rows read the memmap front to back
+    order = np.argsort(rows)
+    parcel_weights = weights[labels[order]]
+    parcel_weights /= parcel_weights.sum()
+    return parcel_weights.astype(np.float32) @ np.asarray(parcel_connectome.maps[rows[order]])
+
+
+def lesion_preview_cache_key(task_id: str) -> str:
+    return f"lesion_preview:{task_id}"
+
+
+def preview_lesion_decode(roi_img: nib.Nifti1Image, taxonomy_level: str = 'symptom', is_staff: bool = False):
+    """
+    Decode the preview map of an ROI, for display while the exact analysis runs.
+
+    Returns:
+        list or None: The top LESION_PREVIEW_RESULTS grouped results as plain dicts
+        (`taxonomy_item`, `mean_correlation`, `n_subjects`), or None if no preview is available.
+        A preview is only worth having if it is quick, so there is none unless every subject map
+        is in this node's decode matrix; missing maps would otherwise be fetched from S3.
+    """
+    membership = get_taxonomy_membership(is_staff, taxonomy_level)
+    decode_matrix = load_decode_matrix()
+    if not membership.conn_paths or np.any(get_decode_matrix_rows(decode_matrix, membership.conn_paths) < 0):
+        return None
+    preview_map = compute_preview_map(roi_img)
+    if preview_map is None:
+        return None
+    result = decode_task(taxonomy_level, preview_map, is_staff, decode_matrix=decode_matrix)
+    if 'grouped_results' not in result:
+        return None
+    return [
+        {
+            'taxonomy_item': str(row['taxonomy_item']),
+            'mean_correlation': float(row['mean_correlation']),
+            'n_subjects': int(row['n_subjects']),
+        }
+        for row in result['grouped_results'][:LESION_PREVIEW_RESULTS]
+    ]
+
+
+@shared_task
+def lesion_preview_task(staged_roi_key, taxonomy_level, is_staff, analysis_task_id):
+    """
+    Decode the preview of a lesion on a decode worker and cache it for the analysis progress page.
+
+    Args:
+        staged_roi_key (str): Staging key of the ROI NIfTI (see pages/tasks/staging.py).
+        taxonomy_level (str): The taxonomy level to group by.
+        is_staff (bool): Indicates if the user is a staff member.
+        analysis_task_id (str): Id of the run_full_lesion_analysis task the preview belongs to.
+    """
+    try:
+        roi_img = load_staged_nifti(staged_roi_key)
+    except FileNotFoundError:
+        return
+    try:
+        preview = preview_lesion_decode(roi_img, taxonomy_level, is_staff)
+    except Exception as e:
+        print(f"Lesion preview unavailable: {str(e)}")
+        preview = None
+    finally:
+        delete_staged_payload(staged_roi_key)
+    if preview:
+        cache.set(lesion_preview_cache_key(analysis_task_id), preview, LESION_PREVIEW_CACHE_TIMEOUT)
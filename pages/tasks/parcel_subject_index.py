@@ -0,0 +1,106 @@
+# pages/tasks/parcel_subject_index.py
+
+"""
+Upkeep of parcel_subject_index, the (map_type, parcel_id) -> sorted (subject_id, max value)
+table behind get_files_at_xyz and the locations page's spatial index.
+
+New files are merged into it as they are inserted (insert_parcelwise_file). Deleting a
+file or moving it to another subject cannot be merged, so those schedule a full refresh,
+debounced by PARCEL_SUBJECT_INDEX_REFRESH_DELAY seconds so bulk edits trigger one rebuild.
+check_parcel_subject_index_task compares the table with a recomputation, and can repair it.
+"""
+
+import environ
+from celery import shared_task
+from django.core.cache import cache
+from django.db import transaction
+
+from sqlalchemy_utils.db_session import get_session
+from sqlalchemy_utils.parcelwise_arrays import SUBJECT_MAP_TYPES, check_parcel_subject_index, rebuild_parcel_subject_index
+
+from .spatial_index import invalidate_spatial_index
+
+env = environ.Env()
+
+PARCEL_SUBJECT_INDEX_REFRESH_DELAY = env.int('PARCEL_SUBJECT_INDEX_REFRESH_DELAY', default=60)
+REFRESH_QUEUED_KEY = 'parcel_subject_index:refresh_queued'
+
+
+def schedule_parcel_subject_index_refresh():
+    """
+    Queue refresh_parcel_subject_index_task after the current transaction commits, unless one
+    is already waiting.
+    """
+    if cache.add(REFRESH_QUEUED_KEY, True, PARCEL_SUBJECT_INDEX_REFRESH_DELAY * 2):
+        transaction.on_commit(
+            lambda: refresh_parcel_subject_index_task.apply_async(countdown=PARCEL_SUBJECT_INDEX_REFRESH_DELAY)
+        )
+
+
+def refresh_parcel_subject_index(map_types=None) -> dict:
+    """
+    Rebuild parcel_subject_index from the stored parcelwise values.
+
+    Args:
+        map_types (list): Map types to rebuild; defaults to every map type with subjects.
+
+    Returns:
+        dict: Number of parcels indexed per map type.
+    """
+    map_types = list(map_types or SUBJECT_MAP_TYPES)
+    session = get_session()
+    try:
+        n_parcels = {map_type: rebuild_parcel_subject_index(map_type, session) for map_type in map_types}
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    invalidate_spatial_index()
+    return n_parcels
+
+
+@shared_task
+def refresh_parcel_subject_index_task(map_types=None):
+    """
+    Celery task to rebuild parcel_subject_index (see refresh_parcel_subject_index).
+    """
+    # Cleared first, so changes made during the rebuild queue another one
+    cache.delete(REFRESH_QUEUED_KEY)
+    n_parcels = refresh_parcel_subject_index(map_types)
+    print(f"Rebuilt parcel_subject_index: {n_parcels}")
+    return n_parcels
+
+
+@shared_task
+def check_parcel_subject_index_task(repair=False):
+    """
+    Celery task comparing parcel_subject_index with the stored parcelwise values.
+
+    Args:
+        repair (bool): Rebuild the map types that have mismatched parcels.
+
+    Returns:
+        dict: Per map type, `n_parcels`, `n_mismatched` and up to 20 `mismatched_parcel_ids`.
+    """
+    session = get_session()
+    try:
+        reports = {map_type: check_parcel_subject_index(map_type, session) for map_type in SUBJECT_MAP_TYPES}
+    finally:
+        session.close()
+
+    results = {}
+    for map_type, report in reports.items():
+        results[map_type] = {
+            'n_parcels': report['n_parcels'],
+            'n_mismatched': len(report['mismatched_parcel_ids']),
+            'mismatched_parcel_ids': report['mismatched_parcel_ids'][:20],
+        }
+        print(f"parcel_subject_index {map_type}: {results[map_type]['n_mismatched']} of {report['n_parcels']} parcels mismatched.")
+
+    stale = [map_type for map_type, result in results.items() if result['n_mismatched']]
+    if repair and stale:
+        refresh_parcel_subject_index(stale)
+        print(f"Rebuilt parcel_subject_index for {', '.join(stale)}.")
+    return results
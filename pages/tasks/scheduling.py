@@ -0,0 +1,237 @@
+# pages/tasks/scheduling.py
+
+"""
+Lanes, per-user caps and queue statistics for analysis tasks.
+
+Analysis jobs are submitted with submit_task instead of .delay()/.apply_async(). Every
+job belongs to a lane:
+
+    interactive   the decode and lesion analysis pages; the stage queues in
+                  CELERY_TASK_ROUTES ('mapping', 'decode')
+    batch         bulk jobs; the same queues with a '_batch' suffix
+
+Workers choose lanes by the queues they consume (see README), so batch work can never
+occupy the workers that serve interactive users. Each user may have at most
+SCHEDULER_MAX_IN_FLIGHT[lane] jobs queued or running per lane.
+
+Scheduler state lives in the broker's Redis database:
+
+    scheduler:job:<task_id>           hash with user, lane, enqueued_at, started_at
+    scheduler:inflight:<lane>:<user>  sorted set of the user's job ids by submit time
+    scheduler:inflight:<lane>         sorted set of all job ids in the lane
+    scheduler:wait:<lane>             recent queue wait times in seconds (newest first)
+    scheduler:owner:<task_id>         submitting user id, kept SCHEDULER_OWNER_TTL after release
+
+Jobs are released when their final task finishes, including tasks that replaced the
+submitted one, which keep its id. Jobs whose worker died are dropped after
+SCHEDULER_JOB_TTL.
+"""
+
+import time
+import uuid
+
+import environ
+import numpy as np
+import redis
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+
+env = environ.Env()
+
+SCHEDULER_LANES = ('interactive', 'batch')
+SCHEDULER_MAX_IN_FLIGHT = {
+    'interactive': env.int('SCHEDULER_MAX_IN_FLIGHT_INTERACTIVE', default=3),
+    'batch': env.int('SCHEDULER_MAX_IN_FLIGHT_BATCH', default=1),
+}
+SCHEDULER_JOB_TTL = env.int('SCHEDULER_JOB_TTL', default=60 * 60 * 6)
+# How long the submitter of a job is remembered; Celery keeps results for a day by default
+SCHEDULER_OWNER_TTL = env.int('SCHEDULER_OWNER_TTL', default=60 * 60 * 24)
+# Wait time samples kept per lane for the statistics
+SCHEDULER_WAIT_SAMPLES = 1000
+DEFAULT_QUEUE = 'celery'
+
+_redis_client = None
+
+
+class SchedulerLimitExceeded(Exception):
+    """Raised by submit_task when a user already has the maximum number of jobs in a lane."""
+
+
+def get_scheduler_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(settings.CELERY_BROKER_URL, decode_responses=True)
+    return _redis_client
+
+
+def _job_key(task_id: str) -> str:
+    return f"scheduler:job:{task_id}"
+
+
+def _user_inflight_key(lane: str, user_id) -> str:
+    return f"scheduler:inflight:{lane}:{user_id}"
+
+
+def _lane_inflight_key(lane: str) -> str:
+    return f"scheduler:inflight:{lane}"
+
+
+def _wait_key(lane: str) -> str:
+    return f"scheduler:wait:{lane}"
+
+
+def _owner_key(task_id: str) -> str:
+    return f"scheduler:owner:{task_id}"
+
+
+def task_queue(task_name: str) -> str:
+    """Interactive queue of a task, from CELERY_TASK_ROUTES."""
+    route = getattr(settings, 'CELERY_TASK_ROUTES', {}).get(task_name, {})
+    return route.get('queue', DEFAULT_QUEUE)
+
+
+def lane_queue(queue: str, lane: str) -> str:
+    """Queue serving a lane of a stage queue."""
+    if lane not in SCHEDULER_LANES:
+        raise ValueError(f"lane must be one of: {', '.join(SCHEDULER_LANES)}")
+    return queue if lane == 'interactive' else f"{queue}_{lane}"
+
+
+def lane_queues() -> dict:
+    """Every queue of every lane: lane -> list of queue names."""
+    queues = sorted({DEFAULT_QUEUE, *(route['queue'] for route in getattr(settings, 'CELERY_TASK_ROUTES', {}).values())})
+    return {lane: [lane_queue(queue, lane) for queue in queues] for lane in SCHEDULER_LANES}
+
+
+def get_job_lane(task_id: str) -> str:
+    """Lane of a submitted job, or 'interactive' for tasks not submitted through submit_task."""
+    return get_scheduler_redis().hget(_job_key(task_id), 'lane') or 'interactive'
+
+
+def get_task_owner(task_id: str):
+    """Id of the user who submitted a job through submit_task, or None if unknown or expired."""
+    user_id = get_scheduler_redis().get(_owner_key(task_id))
+    return int(user_id) if user_id is not None else None
+
+
+def submit_task(task, args, user_id, lane: str = 'interactive'):
+    """
+    Queue an analysis task in a lane, enforcing the per-user in-flight cap.
+
+    Args:
+        task (celery.Task): The task, e.g. decode_task_wrapper.
+        args (tuple): Positional arguments for the task.
+        user_id (int): The submitting user.
+        lane (str): One of SCHEDULER_LANES.
+
+    Returns:
+        celery.result.AsyncResult: The queued task.
+
+    Raises:
+        SchedulerLimitExceeded: If the user already has SCHEDULER_MAX_IN_FLIGHT[lane] jobs.
+    """
+    queue = lane_queue(task_queue(task.name), lane)
+    client = get_scheduler_redis()
+    task_id = str(uuid.uuid4())
+    now = time.time()
+    user_key = _user_inflight_key(lane, user_id)
+
+    # Reserve a slot first and give it back if over the cap, so concurrent submissions cannot both pass
+    pipe = client.pipeline()
+    pipe.zremrangebyscore(user_key, 0, now - SCHEDULER_JOB_TTL)
+    pipe.zadd(user_key, {task_id: now})
+    pipe.expire(user_key, SCHEDULER_JOB_TTL)
+    pipe.zcard(user_key)
+    in_flight = pipe.execute()[-1]
+    if in_flight > SCHEDULER_MAX_IN_FLIGHT[lane]:
+        client.zrem(user_key, task_id)
+        raise SchedulerLimitExceeded(
+            f"You already have {in_flight - 1} analyses in progress. "
+            "Please wait for one to finish before starting another."
+        )
+
+    pipe = client.pipeline()
+    pipe.hset(_job_key(task_id), mapping={'user_id': user_id, 'lane': lane, 'queue': queue, 'enqueued_at': now})
+    pipe.expire(_job_key(task_id), SCHEDULER_JOB_TTL)
+    pipe.set(_owner_key(task_id), user_id, ex=SCHEDULER_OWNER_TTL)
+    pipe.zadd(_lane_inflight_key(lane), {task_id: now})
+    pipe.execute()
+
+    try:
+        return task.apply_async(args=args, task_id=task_id, queue=queue)
+    except Exception:
+        _release_job(task_id)
+        raise
+
+
+def _release_job(task_id: str):
+    client = get_scheduler_redis()
+    job = client.hgetall(_job_key(task_id))
+    if not job:
+        return
+    pipe = client.pipeline()
+    pipe.zrem(_user_inflight_key(job['lane'], job['user_id']), task_id)
+    pipe.zrem(_lane_inflight_key(job['lane']), task_id)
+    pipe.delete(_job_key(task_id))
+    pipe.execute()
+
+
+@task_prerun.connect
+def record_queue_wait(task_id=None, **kwargs):
+    client = get_scheduler_redis()
+    job_key = _job_key(task_id)
+    job = client.hgetall(job_key)
+    # Tasks not submitted through submit_task have no job; replacement tasks reuse a started job's id
+    if 'enqueued_at' not in job or 'started_at' in job:
+        return
+    started_at = time.time()
+    if not client.hsetnx(job_key, 'started_at', started_at):
+        return
+    wait = started_at - float(job['enqueued_at'])
+    pipe = client.pipeline()
+    pipe.lpush(_wait_key(job['lane']), round(wait, 3))
+    pipe.ltrim(_wait_key(job['lane']), 0, SCHEDULER_WAIT_SAMPLES - 1)
+    pipe.execute()
+
+
+@task_postrun.connect
+def release_finished_job(task_id=None, state=None, **kwargs):
+    # A task that replaced itself (raises Ignore) hands the job to its replacement
+    if state == 'IGNORED':
+        return
+    _release_job(task_id)
+
+
+def get_scheduler_stats() -> dict:
+    """
+    Queue depth, jobs in flight and recent queue wait times per lane.
+
+    Returns:
+        dict: lane -> {'queues': {queue: waiting messages}, 'in_flight': int,
+        'wait_seconds': {'samples', 'p50', 'p95', 'max'}}. Messages already
+        prefetched by a worker are not counted as waiting.
+    """
+    client = get_scheduler_redis()
+    now = time.time()
+    stats = {}
+    for lane, queues in lane_queues().items():
+        pipe = client.pipeline()
+        for queue in queues:
+            pipe.llen(queue)
+        pipe.zremrangebyscore(_lane_inflight_key(lane), 0, now - SCHEDULER_JOB_TTL)
+        pipe.zcard(_lane_inflight_key(lane))
+        pipe.lrange(_wait_key(lane), 0, -1)
+        results = pipe.execute()
+
+        waits = np.asarray(results[-1], dtype=float)
+        stats[lane] = {
+            'queues': dict(zip(queues, results[:len(queues)])),
+            'in_flight': results[-2],
+            'wait_seconds': {
+                'samples': int(waits.size),
+                'p50': float(np.percentile(waits, 50)) if waits.size else None,
+                'p95': float(np.percentile(waits, 95)) if waits.size else None,
+                'max': float(waits.max()) if waits.size else None,
+            },
+        }
+    return stats
@@ -0,0 +1,204 @@
+# pages/tasks/spatial_index.py
+
+"""
+In-memory spatial lookup of subjects by MNI152 coordinate, for the locations page.
+
+Two structures replace the per-voxel, per-parcel and per-file queries of get_files_at_xyz:
+
+    coordinate lookup   int32 array of shape (n_parcellations, 91, 109, 91) holding the
+                        parcel id of every 2mm MNI152 voxel in each parcellation (0 outside
+                        the mask), built from voxelwise_values
+    parcel index        per map type, a CSR index from parcel id to the (subject_id,
+                        max value) pairs of that parcel, built from parcel_subject_index
+                        (see sqlalchemy_utils.parcelwise_arrays)
+
+Both are built with one query each and kept per process. They are rebuilt after
+SPATIAL_INDEX_MAX_AGE seconds, or sooner when invalidate_spatial_index bumps the shared
+version in the Django cache (see pages/signals.py).
+"""
+
+import threading
+import time
+
+import environ
+import numpy as np
+from django.core.cache import cache
+from sklearn.utils import Bunch
+from sqlalchemy import select
+
+from sqlalchemy_utils.db_session import get_session
+from sqlalchemy_utils.db_utils import MNI152_2MM_AFFINE, MNI152_2MM_SHAPE
+from sqlalchemy_utils.models_sqlalchemy_orm import Parcel, ParcelSubjectIndex, VoxelwiseValue
+from sqlalchemy_utils.parcelwise_arrays import PARCELWISE_ARRAY_TABLES, SUBJECT_MAP_TYPES
+
+env = environ.Env()
+
+SPATIAL_INDEX_MAX_AGE = env.int('SPATIAL_INDEX_MAX_AGE', default=60 * 15)
+SPATIAL_INDEX_VERSION_KEY = 'spatial_index:version'
+# Rows fetched per round trip while building
+SPATIAL_INDEX_FETCH_SIZE = 100_000
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+def _fetch_columns(session, statement, dtypes) -> list:
+    """Run a query and return each selected column as one NumPy array."""
+    chunks = [[] for _ in dtypes]
+    result = session.execute(statement.execution_options(yield_per=SPATIAL_INDEX_FETCH_SIZE))
+    for partition in result.partitions():
+        rows = np.asarray(partition, dtype=np.float64).reshape(-1, len(dtypes))
+        for column, chunk in enumerate(chunks):
+            chunk.append(rows[:, column])
+    return [
+        np.concatenate(chunk).astype(dtype) if chunk else np.empty(0, dtype=dtype)
+        for chunk, dtype in zip(chunks, dtypes)
+    ]
+
+
+def build_coordinate_lookup(session):
+    """
+    Build the voxel -> parcel id lookup from voxelwise_values.
+
+    Returns:
+        Bunch: `parcel_ids`, int32 of shape (n_parcellations, 91, 109, 91), and
+        `parcellation_ids`, the parcellation of each slice.
+    """
+    x, y, z, parcel_ids, parcellation_ids = _fetch_columns(
+        session,
+        select(
+            VoxelwiseValue.mni152_x, VoxelwiseValue.mni152_y, VoxelwiseValue.mni152_z,
+            VoxelwiseValue.parcel_id, Parcel.parcellation_id,
+        ).join(Parcel, Parcel.id == VoxelwiseValue.parcel_id),
+        [np.float64, np.float64, np.float64, np.int32, np.int64],
+    )
+    slice_ids, slices = np.unique(parcellation_ids, return_inverse=True)
+    voxels = _mni_to_voxel(np.column_stack((x, y, z)))
+    on_grid = voxels[:, 0] >= 0
+
+    lookup = np.zeros((len(slice_ids),) + MNI152_2MM_SHAPE, dtype=np.int32)
+    lookup[slices[on_grid], voxels[on_grid, 0], voxels[on_grid, 1], voxels[on_grid, 2]] = parcel_ids[on_grid]
+    return Bunch(parcel_ids=lookup, parcellation_ids=slice_ids)
+
+
+def build_parcel_index(map_type: str, session):
+    """
+    Build the parcel id -> (subject_id, value) CSR index of one map type from parcel_subject_index,
+    which already holds each parcel's subjects, sorted, with their maximum value.
+
+    Returns:
+        Bunch: `indptr` (int64, indexed by parcel id), `subject_ids` (int32) and
+        `max_values` (float32); the pairs of parcel p are at indptr[p]:indptr[p + 1].
+        Empty for group-level maps, which have no subjects.
+    """
+    if map_type not in PARCELWISE_ARRAY_TABLES:
+        raise ValueError(f"Unknown map_type: {map_type}. Valid types are 'connectivity', 'roi', 'group_level_map'.")
+    if map_type not in SUBJECT_MAP_TYPES:
+        return _csr_parcel_index(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+
+    rows = session.execute(
+        select(ParcelSubjectIndex.parcel_id, ParcelSubjectIndex.subject_ids, ParcelSubjectIndex.max_values)
+        .where(ParcelSubjectIndex.map_type == map_type)
+        .order_by(ParcelSubjectIndex.parcel_id)
+        .execution_options(yield_per=SPATIAL_INDEX_FETCH_SIZE)
+    ).all()
+    lengths = np.array([len(subject_ids) for _, subject_ids, _ in rows], dtype=np.int64)
+    return _csr_parcel_index(
+        np.repeat(np.array([parcel_id for parcel_id, _, _ in rows], dtype=np.int64), lengths),
+        np.array([subject_id for _, subject_ids, _ in rows for subject_id in subject_ids], dtype=np.int32),
+        np.array([value for _, _, max_values in rows for value in max_values], dtype=np.float32),
+    )
+
+
+def _csr_parcel_index(parcel_ids, subject_ids, values):
+    """CSR parcel index from (parcel_id, subject_id, value) arrays sorted by parcel id."""
+    n_parcels = int(parcel_ids.max()) + 1 if len(parcel_ids) else 1
+    indptr = np.zeros(n_parcels + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parcel_ids, minlength=n_parcels), out=indptr[1:])
+    return Bunch(indptr=indptr, subject_ids=subject_ids, max_values=values)
+
+
+def _mni_to_voxel(coords) -> np.ndarray:
+    """
+    Voxel indices of MNI152 coordinates on the 2mm grid; rows not exactly on the grid are -1.
+    """
+    coords = np.atleast_2d(np.asarray(coords, dtype=np.float64))
+    voxels = (coords - MNI152_2MM_AFFINE[:3, 3]) / np.diag(MNI152_2MM_AFFINE)[:3]
+    indices = np.round(voxels).astype(np.int64)
+    valid = np.all(np.isclose(voxels, indices) & (indices >= 0) & (indices < MNI152_2MM_SHAPE), axis=1)
+    indices[~valid] = -1
+    return indices
+
+
+def invalidate_spatial_index():
+    """
+    Make every process rebuild its spatial index on next use, e.g. after files are added.
+    """
+    try:
+        cache.incr(SPATIAL_INDEX_VERSION_KEY)
+    except ValueError:
+        cache.set(SPATIAL_INDEX_VERSION_KEY, 1, None)
+
+
+def _get_index(name: str, build):
+    version = cache.get(SPATIAL_INDEX_VERSION_KEY, 0)
+    index = _indexes.get(name)
+    if index is not None and index.version == version and time.time() - index.built_at < SPATIAL_INDEX_MAX_AGE:
+        return index.data
+
+    with _index_lock:
+        index = _indexes.get(name)
+        if index is None or index.version != version or time.time() - index.built_at >= SPATIAL_INDEX_MAX_AGE:
+            start = time.time()
+            session = get_session()
+            try:
+                data = build(session)
+            finally:
+                session.close()
+            index = Bunch(data=data, version=version, built_at=time.time())
+            _indexes[name] = index
+            print(f"Built spatial index {name} in {time.time() - start:.1f}s.")
+    return index.data
+
+
+def get_coordinate_lookup():
+    """Cached version of build_coordinate_lookup."""
+    return _get_index('coordinates', build_coordinate_lookup)
+
+
+def get_parcel_index(map_type: str):
+    """Cached version of build_parcel_index."""
+    if map_type not in PARCELWISE_ARRAY_TABLES:
+        raise ValueError(f"Unknown map_type: {map_type}. Valid types are 'connectivity', 'roi', 'group_level_map'.")
+    return _get_index(f'parcels:{map_type}', lambda session: build_parcel_index(map_type, session))
+
+
+def get_subject_values_at_xyz(x: int, y: int, z: int, map_type: str) -> dict:
+    """
+    Same result as get_files_at_xyz, from the in-memory spatial index.
+
+    Returns:
+        dict: subject_id -> maximum value (rounded to 2 decimals) over the parcels
+        containing the coordinate, in every parcellation. Empty outside the mask.
+    """
+    parcel_index = get_parcel_index(map_type)
+    coordinate_lookup = get_coordinate_lookup()
+
+    voxel = _mni_to_voxel((x, y, z))[0]
+    if voxel[0] < 0:
+        return {}
+    parcel_ids = coordinate_lookup.parcel_ids[:, voxel[0], voxel[1], voxel[2]]
+    parcel_ids = parcel_ids[(parcel_ids > 0) & (parcel_ids < len(parcel_index.indptr) - 1)]
+    if len(parcel_ids) == 0:
+        return {}
+
+    slices = [slice(parcel_index.indptr[p], parcel_index.indptr[p + 1]) for p in parcel_ids]
+    subject_ids = np.concatenate([parcel_index.subject_ids[s] for s in slices])
+    values = np.concatenate([parcel_index.max_values[s] for s in slices])
+    if len(parcel_ids) > 1:
+        # Several parcellations can list the same subject; keep its maximum value
+        order = np.lexsort((values, subject_ids))
+        subject_ids, values = subject_ids[order], values[order]
+        last = np.append(subject_ids[1:] != subject_ids[:-1], True)
+        subject_ids, values = subject_ids[last], values[last]
+    return dict(zip(subject_ids.tolist(), np.round(values.astype(np.float64), 2).tolist()))
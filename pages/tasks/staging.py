@@ -0,0 +1,220 @@
+# pages/tasks/staging.py
+
+"""
+Hand-off of uploaded maps from the web process to Celery workers.
+
+Instead of sending several MB of NIfTI bytes through Redis as a JSON task argument,
+views stage the upload as a file in STAGING_DIR and pass only its key. STAGING_DIR
+must be a volume shared by the web server and the workers (it is, by default, when
+both run on the same host). Staged payloads are deleted by the task that consumes
+them; anything left behind (failed or never-started tasks) is removed once it is
+older than STAGED_PAYLOAD_TTL.
+"""
+
+import os
+import re
+import time
+import uuid
+
+import environ
+import nibabel as nib
+import numpy as np
+from celery import shared_task
+
+from sqlalchemy_utils.db_utils import LOCAL_DATA_DIR
+from sqlalchemy_utils.masked_vector import MASKED_VECTOR_EXTENSION, decode_masked_vector, encode_masked_vector
+from sqlalchemy_utils.nifti_stream import read_nifti_stream, write_nifti_gz_stream
+
+env = environ.Env()
+
+STAGING_DIR = env('STAGING_DIR', default=os.path.join(LOCAL_DATA_DIR, 'staging'))
+STAGED_PAYLOAD_TTL = env.int('STAGED_PAYLOAD_TTL', default=60 * 60 * 24)
+# How often a process sweeps expired payloads while staging new ones
+STAGING_CLEANUP_INTERVAL = 60 * 10
+
+_STAGING_KEY_RE = re.compile(r'^[0-9a-f]{32}(\.[a-z0-9]+)*$')
+_last_cleanup = 0.0
+
+
+def _staged_path(key: str) -> str:
+    # Keys come back from task arguments; never let them point outside STAGING_DIR
+    if not _STAGING_KEY_RE.match(key):
+        raise ValueError(f"Invalid staging key: {key!r}")
+    return os.path.join(STAGING_DIR, key)
+
+
+def _new_key(suffix: str) -> str:
+    os.makedirs(STAGING_DIR, exist_ok=True)
+
+    global _last_cleanup
+    if time.time() - _last_cleanup > STAGING_CLEANUP_INTERVAL:
+        _last_cleanup = time.time()
+        cleanup_staged_payloads()
+
+    return f"{uuid.uuid4().hex}{suffix}"
+
+
+def _write_staged(key: str, write) -> str:
+    path = _staged_path(key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return key
+
+
+def stage_payload(data: bytes, suffix: str = '') -> str:
+    """
+    Stage raw bytes for a task.
+
+    Returns:
+        str: The staging key to pass to the task.
+    """
+    return _write_staged(_new_key(suffix), lambda f: f.write(data))
+
+
+def stage_uploaded_file(uploaded_file) -> str:
+    """
+    Stage a Django uploaded file as is, chunk by chunk, without reading it into memory.
+
+    Returns:
+        str: The staging key to pass to the task.
+    """
+    def write(f):
+        for chunk in uploaded_file.chunks():
+            f.write(chunk)
+    return _write_staged(_new_key('.upload'), write)
+
+
+def stage_nifti(nifti_image: nib.Nifti1Image) -> str:
+    """
+    Stage a NIfTI image (gzip-compressed) for a task.
+
+    Returns:
+        str: The staging key to pass to the task.
+    """
+    return _write_staged(_new_key('.nii.gz'), lambda f: write_nifti_gz_stream(nifti_image, f, compresslevel=1))
+
+
+def stage_masked_vector(values) -> str:
+    """
+    Stage the in-mask values of a map in the masked vector format (~10x smaller than a NIfTI).
+
+    Returns:
+        str: The staging key to pass to the task.
+    """
+    return stage_payload(encode_masked_vector(values), suffix=MASKED_VECTOR_EXTENSION)
+
+
+def stage_array(shape, dtype, fill) -> str:
+    """
+    Stage an array as .npy, filled in place so it never has to be held in memory.
+
+    Args:
+        shape (tuple): Shape of the array.
+        dtype: Data type of the array.
+        fill (callable): Called with the writable memmap to fill it.
+
+    Returns:
+        str: The staging key to pass to the task.
+    """
+    key = _new_key('.npy')
+    path = _staged_path(key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+        fill(array)
+        array.flush()
+        del array
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return key
+
+
+def load_staged_array(key: str) -> np.ndarray:
+    """
+    Memory-map an array staged with stage_array. Raises FileNotFoundError if it expired or was already consumed.
+    """
+    return np.load(_staged_path(key), mmap_mode='r')
+
+
+def load_staged_payload(key: str) -> bytes:
+    """
+    Read a staged payload. Raises FileNotFoundError if it expired or was already consumed.
+    """
+    with open(_staged_path(key), 'rb') as f:
+        return f.read()
+
+
+def open_staged_payload(key: str):
+    """
+    Open a staged payload for binary reading. Raises FileNotFoundError if it expired or was already consumed.
+    """
+    return open(_staged_path(key), 'rb')
+
+
+def load_staged_nifti(key: str) -> nib.Nifti1Image:
+    """
+    Read an image staged with stage_nifti. Raises FileNotFoundError if it expired or was already consumed.
+    """
+    with open(_staged_path(key), 'rb') as f:
+        return read_nifti_stream(f, gzipped=True)
+
+
+def load_staged_map(key: str):
+    """
+    Read a map staged with stage_masked_vector or stage_nifti.
+
+    Returns:
+        np.ndarray or nib.Nifti1Image: The float32 in-mask values for a masked vector,
+        otherwise the image.
+    """
+    if key.endswith(MASKED_VECTOR_EXTENSION):
+        return decode_masked_vector(load_staged_payload(key))
+    return load_staged_nifti(key)
+
+
+def delete_staged_payload(key: str):
+    try:
+        os.remove(_staged_path(key))
+    except FileNotFoundError:
+        pass
+
+
+def cleanup_staged_payloads(max_age: int = None) -> int:
+    """
+    Delete staged payloads (and abandoned temporary files) older than max_age seconds.
+
+    Returns:
+        int: Number of files removed.
+    """
+    max_age = STAGED_PAYLOAD_TTL if max_age is None else max_age
+    if not os.path.isdir(STAGING_DIR):
+        return 0
+
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(STAGING_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+@shared_task
+def cleanup_staged_payloads_task():
+    """
+    Celery task to garbage-collect expired staged payloads.
+    """
+    removed = cleanup_staged_payloads()
+    print(f"Removed {removed} expired staged payloads.")
+    return removed
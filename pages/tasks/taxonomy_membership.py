@@ -0,0 +1,149 @@
+# pages/tasks/taxonomy_membership.py
+
+"""
+Sparse subject x taxonomy item membership matrices used to group decode results.
+
+One matrix is built per (is_staff, taxonomy_level) from a single join over
+subjects_symptoms, symptoms, subdomains and domains, and kept in the Django cache
+until a subject's symptoms, a subject, a symptom or a connectivity file changes
+(see pages/signals.py; connectivity files inserted through sqlalchemy_utils/db_utils.py
+invalidate it when their transaction commits).
+"""
+
+import numpy as np
+from django.core.cache import cache
+from scipy import sparse
+from sklearn.utils import Bunch
+from sqlalchemy import func
+
+from sqlalchemy_utils.db_session import get_session
+from sqlalchemy_utils.models_sqlalchemy_orm import (
+    Subject,
+    Symptom,
+    Domain,
+    Subdomain,
+    SubjectSymptom,
+    ConnectivityFile,
+)
+
+TAXONOMY_LEVELS = ["symptom", "subdomain", "domain"]
+TAXONOMY_MEMBERSHIP_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _cache_key(is_staff: bool, taxonomy_level: str) -> str:
+    return f"taxonomy_membership:v2:{'staff' if is_staff else 'public'}:{taxonomy_level}"
+
+
+def build_taxonomy_membership(is_staff: bool, taxonomy_level: str = "symptom"):
+    """
+    Query the subjects with connectivity maps and their taxonomy items.
+
+    Args:
+        is_staff (bool): Include subjects and symptoms marked internal_use_only.
+        taxonomy_level (str): One of ["symptom", "subdomain", "domain"].
+
+    Returns:
+        Bunch: With attributes `subject_ids`, `conn_paths` and `conn_md5s` (one entry per row),
+        `item_ids` and `item_names` (one entry per column) and `matrix`, a
+        (n_subjects, n_items) scipy.sparse CSR matrix of 0/1 int8 memberships.
+    """
+    if taxonomy_level not in TAXONOMY_LEVELS:
+        raise ValueError("taxonomy_level must be one of: symptom, subdomain, domain")
+
+    session = get_session()
+    try:
+        # One connectivity map per subject: the first nii/nii.gz file by id
+        first_file = (
+            session.query(ConnectivityFile.subject_id, func.min(ConnectivityFile.id).label('file_id'))
+            .filter(ConnectivityFile.filetype.in_(['nii', 'nii.gz']))
+            .group_by(ConnectivityFile.subject_id)
+            .subquery()
+        )
+        subjects_query = (
+            session.query(Subject.id, ConnectivityFile.path, ConnectivityFile.md5)
+            .join(first_file, first_file.c.subject_id == Subject.id)
+            .join(ConnectivityFile, ConnectivityFile.id == first_file.c.file_id)
+        )
+        if not is_staff:
+            subjects_query = subjects_query.filter(Subject.internal_use_only.is_(False))
+        subjects = subjects_query.order_by(Subject.id).all()
+
+        if taxonomy_level == "symptom":
+            item = Symptom
+            membership_query = (
+                session.query(SubjectSymptom.subject_id, Symptom.id, Symptom.name)
+                .join(Symptom, Symptom.id == SubjectSymptom.symptom_id)
+            )
+            if not is_staff:
+                membership_query = membership_query.filter(Symptom.internal_use_only.is_(False))
+        elif taxonomy_level == "subdomain":
+            item = Subdomain
+            membership_query = (
+                session.query(SubjectSymptom.subject_id, Subdomain.id, Subdomain.name)
+                .join(Symptom, Symptom.id == SubjectSymptom.symptom_id)
+                .join(Subdomain, Subdomain.id == Symptom.subdomain_id)
+            )
+        else:  # domain
+            item = Domain
+            membership_query = (
+                session.query(SubjectSymptom.subject_id, Domain.id, Domain.name)
+                .join(Symptom, Symptom.id == SubjectSymptom.symptom_id)
+                .join(Subdomain, Subdomain.id == Symptom.subdomain_id)
+                .join(Domain, Domain.id == Subdomain.domain_id)
+            )
+        memberships = membership_query.distinct().order_by(item.name, item.id).all()
+    finally:
+        session.close()
+
+    subject_ids = [row[0] for row in subjects]
+    subject_rows = {subject_id: row for row, subject_id in enumerate(subject_ids)}
+
+    item_ids, item_names, item_columns = [], [], {}
+    rows, columns = [], []
+    for subject_id, item_id, item_name in memberships:
+        row = subject_rows.get(subject_id)
+        if row is None:
+            continue
+        if item_id not in item_columns:
+            item_columns[item_id] = len(item_ids)
+            item_ids.append(item_id)
+            item_names.append(item_name)
+        rows.append(row)
+        columns.append(item_columns[item_id])
+
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int8), (rows, columns)),
+        shape=(len(subject_ids), len(item_ids)),
+    )
+
+    return Bunch(
+        subject_ids=subject_ids,
+        conn_paths=[row[1] for row in subjects],
+        conn_md5s=[row[2] for row in subjects],
+        item_ids=item_ids,
+        item_names=item_names,
+        matrix=matrix,
+    )
+
+
+def get_taxonomy_membership(is_staff: bool, taxonomy_level: str = "symptom"):
+    """
+    Cached version of build_taxonomy_membership.
+    """
+    key = _cache_key(is_staff, taxonomy_level)
+    membership = cache.get(key)
+    if membership is None:
+        membership = build_taxonomy_membership(is_staff, taxonomy_level)
+        cache.set(key, membership, TAXONOMY_MEMBERSHIP_CACHE_TIMEOUT)
+    return membership
+
+
+def invalidate_taxonomy_membership():
+    """
+    Drop every cached membership matrix, e.g. after a subject's symptoms change.
+    """
+    cache.delete_many([
+        _cache_key(is_staff, taxonomy_level)
+        for is_staff in (True, False)
+        for taxonomy_level in TAXONOMY_LEVELS
+    ])
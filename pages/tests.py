@@ -1,3 +1,399 @@
-from django.test import TestCase
+import gzip
+import os
+import pickle
+import struct
+import tempfile
+import time
+import zlib
+from unittest import mock
 
-# Create your tests here.
+import nibabel as nib
+import numpy as np
+from django.test import SimpleTestCase
+from scipy import sparse
+from scipy.stats import ttest_1samp
+
+from pages.tasks import chunk_cache
+from pages.tasks.decode_stats import correlate_maps, group_statistics, map_statistics
+from sqlalchemy_utils import file_cache, masked_vector
+from sqlalchemy_utils.db_utils import get_2mm_mni152_masker
+from sqlalchemy_utils.pg_copy import BINARY_COPY_HEADER, _ChunkReader, iter_binary_chunks, iter_csv_chunks
+
+
+def corrcoef_loop(query_map, subject_maps):
+    """The per-subject np.corrcoef loop correlate_maps replaced."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.array([np.corrcoef(query_map, subject_map)[0, 1] for subject_map in subject_maps])
+
+
+class CorrelateMapsTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.queries = rng.normal(size=(3, 500))
+        self.subject_maps = rng.normal(size=(20, 500)).astype(np.float32) + np.arange(20, dtype=np.float32)[:, None]
+
+    def test_single_query_matches_corrcoef(self):
+        correlations = correlate_maps(self.queries[0], self.subject_maps, block_size=7)
+        self.assertEqual(correlations.shape, (20,))
+        np.testing.assert_allclose(correlations, corrcoef_loop(self.queries[0], self.subject_maps), atol=1e-5)
+
+    def test_query_stack_matches_corrcoef(self):
+        correlations = correlate_maps(self.queries, self.subject_maps, block_size=7)
+        self.assertEqual(correlations.shape, (3, 20))
+        for query, row in zip(self.queries, correlations):
+            np.testing.assert_allclose(row, corrcoef_loop(query, self.subject_maps), atol=1e-5)
+
+    def test_rows_and_precomputed_statistics(self):
+        rows = np.array([17, 2, 3, 4, 11, 0])
+        means, stds = map_statistics(self.subject_maps)
+        correlations = correlate_maps(
+            self.queries, self.subject_maps, rows=rows, subject_means=means, subject_stds=stds, block_size=4
+        )
+        np.testing.assert_allclose(
+            correlations, correlate_maps(self.queries, self.subject_maps[rows]), atol=1e-6
+        )
+
+    def test_constant_maps_are_nan(self):
+        subject_maps = self.subject_maps.copy()
+        subject_maps[5] = 1.0
+        correlations = correlate_maps(np.vstack([self.queries[0], np.full(500, 2.0)]), subject_maps)
+        self.assertTrue(np.isnan(correlations[0, 5]))
+        self.assertTrue(np.isnan(correlations[1]).all())
+        np.testing.assert_allclose(
+            np.delete(correlations[0], 5), np.delete(corrcoef_loop(self.queries[0], subject_maps), 5), atol=1e-5
+        )
+
+    def test_nan_voxels_propagate(self):
+        query = self.queries[0].copy()
+        query[10] = np.nan
+        self.assertTrue(np.isnan(correlate_maps(query, self.subject_maps)).all())
+
+    def test_voxel_count_mismatch(self):
+        with self.assertRaises(ValueError):
+            correlate_maps(self.queries[0][:-1], self.subject_maps)
+
+    def test_progress_callback(self):
+        calls = []
+        correlate_maps(self.queries[0], self.subject_maps, block_size=8, progress_callback=lambda *a: calls.append(a))
+        self.assertEqual(calls, [(8, 20), (16, 20), (20, 20)])
+
+
+class GroupStatisticsTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.values = rng.normal(0.1, 0.2, size=(4, 30))
+        self.values[0, [3, 7]] = np.nan
+        membership = (rng.random((30, 6)) < 0.4).astype(int)
+        membership[:, 4] = 0  # empty group
+        membership[:, 5] = 0
+        membership[12, 5] = 1  # single member
+        self.membership = membership
+
+    def assert_matches_loop(self, values, stats):
+        for j in range(self.membership.shape[1]):
+            members = values[self.membership[:, j] == 1]
+            self.assertEqual(stats['n'][j], len(members))
+            members = members[~np.isnan(members)]
+            if len(members) == 0:
+                for key in ('mean', 'std', 't', 'min', 'max'):
+                    self.assertTrue(np.isnan(stats[key][j]), (key, j))
+                continue
+            np.testing.assert_allclose(stats['mean'][j], members.mean())
+            np.testing.assert_allclose(stats['min'][j], members.min())
+            np.testing.assert_allclose(stats['max'][j], members.max())
+            if len(members) == 1:
+                self.assertTrue(np.isnan(stats['std'][j]))
+                self.assertTrue(np.isnan(stats['t'][j]))
+            else:
+                np.testing.assert_allclose(stats['std'][j], members.std(ddof=1))
+                np.testing.assert_allclose(stats['t'][j], ttest_1samp(members, 0).statistic)
+
+    def test_1d_values_match_ttest_loop(self):
+        for values in self.values:
+            self.assert_matches_loop(values, group_statistics(values, sparse.csr_matrix(self.membership)))
+
+    def test_2d_values_match_1d(self):
+        stats = group_statistics(self.values, sparse.csr_matrix(self.membership))
+        self.assertEqual(stats['mean'].shape, (4, 6))
+        self.assertEqual(stats['n'].shape, (6,))
+        for row, values in enumerate(self.values):
+            single = group_statistics(values, self.membership)
+            for key in ('mean', 'std', 't', 'min', 'max'):
+                np.testing.assert_allclose(stats[key][row], single[key], equal_nan=True)
+
+    def test_empty_and_single_member_groups(self):
+        stats = group_statistics(self.values[1], self.membership)
+        self.assertEqual(stats['n'][4], 0)
+        self.assertTrue(np.isnan(stats['mean'][4]))
+        self.assertEqual(stats['n'][5], 1)
+        self.assertEqual(stats['mean'][5], self.values[1, 12])
+        self.assertEqual(stats['min'][5], stats['max'][5])
+        self.assertTrue(np.isnan(stats['t'][5]))
+
+    def test_all_nan_group(self):
+        values = self.values[1].copy()
+        values[12] = np.nan
+        stats = group_statistics(values, self.membership)
+        self.assertEqual(stats['n'][5], 1)
+        for key in ('mean', 'std', 't', 'min', 'max'):
+            self.assertTrue(np.isnan(stats[key][5]))
+
+
+class MaskedVectorTests(SimpleTestCase):
+    def setUp(self):
+        n_voxels = len(get_2mm_mni152_masker().flat_indices)
+        self.values = np.random.default_rng(2).normal(size=n_voxels).astype(np.float32)
+
+    def codecs(self):
+        return ['none', 'zlib'] + (['zstd'] if masked_vector.zstandard is not None else [])
+
+    def test_round_trip(self):
+        for codec in self.codecs():
+            data = masked_vector.encode_masked_vector(self.values, codec=codec)
+            self.assertTrue(masked_vector.is_masked_vector(data))
+            np.testing.assert_array_equal(masked_vector.decode_masked_vector(data), self.values)
+
+    def test_float16_round_trip(self):
+        data = masked_vector.encode_masked_vector(self.values, dtype='float16', codec='zlib')
+        np.testing.assert_allclose(masked_vector.decode_masked_vector(data), self.values, rtol=1e-3, atol=1e-3)
+
+    def test_rejects_wrong_length_on_encode(self):
+        with self.assertRaises(ValueError):
+            masked_vector.encode_masked_vector(self.values[:-1])
+
+    def test_rejects_other_mask(self):
+        data = bytearray(masked_vector.encode_masked_vector(self.values, codec='zlib'))
+        data[8:16] = bytes(8)
+        with self.assertRaisesRegex(ValueError, 'different brain mask'):
+            masked_vector.decode_masked_vector(bytes(data))
+
+    def test_rejects_corrupt_input(self):
+        for codec in self.codecs():
+            data = masked_vector.encode_masked_vector(self.values, codec=codec)
+            for corrupt in (data[:10], data[:-5], data + b'extra', b'XXXX' + data[4:]):
+                with self.assertRaises(ValueError, msg=codec):
+                    masked_vector.decode_masked_vector(corrupt)
+
+    def test_rejects_wrong_value_count(self):
+        data = masked_vector.encode_masked_vector(self.values, codec='none')
+        header = bytearray(data[:20])
+        header[16:20] = struct.pack('<I', len(self.values) - 1)
+        with self.assertRaises(ValueError):
+            masked_vector.decode_masked_vector(bytes(header) + data[20:-4])
+
+    def test_rejects_oversized_payload(self):
+        # A small payload that would decompress far beyond the declared length
+        data = masked_vector.encode_masked_vector(self.values, codec='zlib')
+        bomb = data[:20] + zlib.compress(bytes(len(self.values) * 4 * 100))
+        with self.assertRaises(ValueError):
+            masked_vector.decode_masked_vector(bomb)
+
+
+def parse_binary_copy(data: bytes, formats: list) -> list:
+    """Reference decoder for PostgreSQL binary COPY data with fixed-size, non-NULL fields."""
+    assert data.startswith(BINARY_COPY_HEADER)
+    offset = len(BINARY_COPY_HEADER)
+    rows = []
+    while True:
+        (n_fields,) = struct.unpack_from('>h', data, offset)
+        offset += 2
+        if n_fields == -1:
+            break
+        assert n_fields == len(formats)
+        row = []
+        for fmt in formats:
+            (length,) = struct.unpack_from('>i', data, offset)
+            assert length == struct.calcsize(fmt)
+            row.append(struct.unpack_from(fmt, data, offset + 4)[0])
+            offset += 4 + length
+        rows.append(tuple(row))
+    assert offset == len(data)
+    return rows
+
+
+class PgCopyTests(SimpleTestCase):
+    def setUp(self):
+        self.parcel_ids = np.array([1, 2, 3, 40000, 7], dtype=np.int64)
+        self.file_ids = np.array([9, 9, 9, 9, 10], dtype=np.int32)
+        self.values = np.array([0.5, -1.25, np.float32(1 / 3), 1e20, 0.0], dtype=np.float32)
+
+    def test_binary_round_trip(self):
+        for chunk_rows in (1, 2, 5, 100):
+            chunks = list(iter_binary_chunks(
+                [self.parcel_ids, self.file_ids, self.values], ['int8', 'int4', 'float4'], chunk_rows=chunk_rows
+            ))
+            rows = parse_binary_copy(b''.join(chunks), ['>q', '>i', '>f'])
+            self.assertEqual(rows, list(zip(self.parcel_ids.tolist(), self.file_ids.tolist(), self.values.tolist())))
+            # Header, one chunk per chunk_rows rows, trailer
+            self.assertEqual(len(chunks), 2 + -(-len(self.values) // chunk_rows))
+
+    def test_binary_empty(self):
+        data = b''.join(iter_binary_chunks([np.array([], dtype=np.int32)], ['int4']))
+        self.assertEqual(parse_binary_copy(data, ['>i']), [])
+
+    def test_csv_chunks(self):
+        chunks = list(iter_csv_chunks([self.parcel_ids, self.values], ['%d', '%.9g'], chunk_rows=2))
+        self.assertEqual(len(chunks), 3)
+        lines = b''.join(chunks).decode().splitlines()
+        self.assertEqual([int(line.split(',')[0]) for line in lines], self.parcel_ids.tolist())
+        np.testing.assert_array_equal(np.array([float(line.split(',')[1]) for line in lines], dtype=np.float32), self.values)
+
+    def test_chunk_reader(self):
+        reader = _ChunkReader([b'abc', b'', b'defg', b'h'])
+        self.assertEqual(reader.read(2), b'ab')
+        self.assertEqual(reader.read(5), b'cdefg')
+        self.assertEqual(reader.read(), b'h')
+        self.assertEqual(reader.read(4), b'')
+
+
+def assert_evicts_least_recently_used(test, get_entry, entry_files, evict):
+    """
+    Shared LRU check for the file and chunk caches, given three cached entries.
+
+    The entries are aged oldest first and the oldest is then read, so evicting down to room
+    for two and a half entries must remove only the middle one.
+
+    Args:
+        get_entry (callable): Entry index -> cached value or None.
+        entry_files (list): Files of each entry; the mtime of the first is its last use.
+        evict (callable): Called with max_bytes.
+    """
+    for age, files in zip((300, 200, 100), entry_files):
+        timestamp = time.time() - age
+        os.utime(files[0], (timestamp, timestamp))
+    test.assertIsNotNone(get_entry(0))
+
+    entry_size = sum(os.path.getsize(path) for path in entry_files[0])
+    evict(int(entry_size * 2.5))
+    test.assertIsNotNone(get_entry(0))
+    test.assertIsNone(get_entry(1))
+    test.assertFalse(any(os.path.exists(path) for path in entry_files[1]))
+    test.assertIsNotNone(get_entry(2))
+
+
+class FileCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher = mock.patch.object(file_cache, 'FILE_CACHE_DIR', cache_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.img = nib.Nifti1Image(np.arange(24, dtype=np.float32).reshape(2, 3, 4), np.diag([2, 2, 2, 1]))
+
+    def test_nifti_hit(self):
+        self.assertIsNone(file_cache.get_cached_file('maps/a.nii.gz', 'v1'))
+        file_cache.put_cached_file('maps/a.nii.gz', 'v1', self.img)
+        cached = file_cache.get_cached_file('maps/a.nii.gz', 'v1')
+        self.assertIsInstance(cached, nib.Nifti1Image)
+        np.testing.assert_array_equal(cached.get_fdata(), self.img.get_fdata())
+        np.testing.assert_array_equal(cached.affine, self.img.affine)
+
+    def test_other_version_is_a_miss(self):
+        file_cache.put_cached_file('maps/a.nii.gz', 'v1', self.img)
+        self.assertIsNone(file_cache.get_cached_file('maps/a.nii.gz', 'v2'))
+
+    def test_array_hit(self):
+        array = np.arange(10, dtype=np.int16)
+        returned = file_cache.put_cached_file('arrays/a.npy', 'v1', array)
+        np.testing.assert_array_equal(returned, array)
+        np.testing.assert_array_equal(file_cache.get_cached_file('arrays/a.npy', 'v1'), array)
+
+    def test_object_arrays_are_not_cached(self):
+        array = np.array([{'a': 1}], dtype=object)
+        self.assertIs(file_cache.put_cached_file('arrays/b.npy', 'v1', array), array)
+        self.assertIsNone(file_cache.get_cached_file('arrays/b.npy', 'v1'))
+
+    def test_nifti_without_header_is_a_miss(self):
+        file_cache.put_cached_file('maps/a.nii.gz', 'v1', self.img)
+        _, hdr_path = file_cache._entry_paths(file_cache.file_cache_key('maps/a.nii.gz', 'v1'))
+        os.remove(hdr_path)
+        self.assertIsNone(file_cache.get_cached_file('maps/a.nii.gz', 'v1'))
+
+    def test_eviction_removes_least_recently_used(self):
+        for i in range(3):
+            file_cache.put_cached_file(f'maps/{i}.nii', 'v1', self.img)
+        assert_evicts_least_recently_used(
+            self,
+            lambda i: file_cache.get_cached_file(f'maps/{i}.nii', 'v1'),
+            [file_cache._entry_paths(file_cache.file_cache_key(f'maps/{i}.nii', 'v1')) for i in range(3)],
+            lambda max_bytes: file_cache.evict_file_cache(max_bytes=max_bytes),
+        )
+
+
+class ChunkCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher = mock.patch.object(chunk_cache, 'CHUNK_CACHE_DIR', cache_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.contribution = {'sum': np.linspace(0, 1, 50), 'count': 3}
+
+        # Two chunks on a 4x4x4 grid: x < 2 is chunk 1, the rest chunk 2
+        chunk_idx = np.ones((4, 4, 4), dtype=np.int16)
+        chunk_idx[2:] = 2
+        self.affine = np.diag([2, 2, 2, 1])
+        self.pcc_config = {'chunk_idx': os.path.join(cache_dir.name, 'chunk_idx.nii.gz')}
+        nib.save(nib.Nifti1Image(chunk_idx, self.affine), self.pcc_config['chunk_idx'])
+        self.config_path = os.path.join(cache_dir.name, 'config.json')
+        with open(self.config_path, 'w') as f:
+            f.write('{}')
+
+    def key(self, i: int) -> str:
+        return f'{i:02x}' + 'ab' * 31
+
+    def roi_keys(self, roi: np.ndarray) -> dict:
+        return chunk_cache.chunk_contribution_keys(
+            nib.Nifti1Image(roi, self.affine), [1, 2], self.pcc_config, self.config_path
+        )
+
+    def test_key_follows_weights_at_chunk_voxels(self):
+        roi = np.zeros((4, 4, 4), dtype=np.float32)
+        roi[0, 0, 0] = roi[3, 3, 3] = 1
+        keys = self.roi_keys(roi)
+        self.assertEqual(set(keys), {1, 2})
+        self.assertEqual(self.roi_keys(roi.copy()), keys)
+
+        # A new voxel and a new weight inside chunk 2 leave chunk 1's key alone
+        for edit in ((3, 0, 0, 1), (3, 3, 3, 0.5)):
+            edited = roi.copy()
+            edited[edit[:3]] = edit[3]
+            edited_keys = self.roi_keys(edited)
+            self.assertEqual(edited_keys[1], keys[1])
+            self.assertNotEqual(edited_keys[2], keys[2])
+
+        # Other statistics are cached separately
+        r_keys = chunk_cache.chunk_contribution_keys(
+            nib.Nifti1Image(roi, self.affine), [1, 2], self.pcc_config, self.config_path, stat='r'
+        )
+        self.assertNotEqual(r_keys[1], keys[1])
+
+    def test_roi_off_the_chunk_grid_has_no_keys(self):
+        self.assertEqual(self.roi_keys(np.zeros((4, 4, 5), dtype=np.float32)), {})
+
+    def test_corrupt_or_partial_entries_are_misses(self):
+        chunk_cache.put_cached_contribution(self.key(1), self.contribution)
+        path = chunk_cache._entry_path(self.key(1))
+        with open(path, 'rb') as f:
+            entry = f.read()
+        corrupt_entries = {
+            'truncated gzip': entry[:len(entry) // 2],
+            'gzip header only': entry[:10],
+            'not gzip': b'not a gzip file',
+            'not a pickle': gzip.compress(b'not a pickle'),
+            'truncated pickle': gzip.compress(pickle.dumps(self.contribution)[:-20]),
+        }
+        for name, data in corrupt_entries.items():
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.assertIsNone(chunk_cache.get_cached_contribution(self.key(1)), name)
+
+    def test_eviction_removes_least_recently_used(self):
+        for i in range(3):
+            chunk_cache.put_cached_contribution(self.key(i), self.contribution)
+        assert_evicts_least_recently_used(
+            self,
+            lambda i: chunk_cache.get_cached_contribution(self.key(i)),
+            [[chunk_cache._entry_path(self.key(i))] for i in range(3)],
+            lambda max_bytes: chunk_cache.evict_chunk_cache(max_bytes=max_bytes),
+        )
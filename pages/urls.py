@@ -19,10 +19,10 @@ from .views.lesion_subject_views import edit_subject_view, add_subject_to_case_r
 from .views.symptom_views import symptom_library_view, symptom_detail_view, domain_detail_view, subdomain_detail_view, get_symptoms_json, import_group_level_map_to_symptom, import_group_level_map_to_subdomain, import_group_level_map_to_domain, edit_symptom, edit_subdomain, edit_domain, manage_group_level_maps_symptom, manage_group_level_maps_subdomain, manage_group_level_maps_domain, add_new_symptom, get_subdomains
 
 # Location views
-from .views.locations_views import locations_view
+from .views.locations_views import locations_view, get_atlas_labels_json
 
 # Analyze views
-from .views.analyze_views import analyze_view, decode_task_status, decode_results_view, voxel_to_nifti_view, analyze_voxels_view, analyze_progress_view, analyze_task_status, analyze_results_view
+from .views.analyze_views import analyze_view, decode_task_status, decode_results_view, voxel_to_nifti_view, analyze_voxels_view, analyze_progress_view, analyze_task_status, analyze_results_view, analysis_queue_stats_view, batch_decode_view, batch_decode_status
 
 urlpatterns = [
     # Home and general pages
@@ -75,13 +75,17 @@ urlpatterns = [
 
     # Location and decode paths
     path("locations/", locations_view, name="locations"),
+    path('api/atlas-labels/', get_atlas_labels_json, name='get_atlas_labels_json'),
     path("analyze/", analyze_view, name="analyze"),
     path('analyze_voxels/', analyze_voxels_view, name='analyze_voxels'),
     path('analyze_progress/', analyze_progress_view, name='analyze_progress'),
     path('analyze_task_status/<str:task_id>/', analyze_task_status, name='analyze_task_status'),
     path('analyze_results/', analyze_results_view, name='analyze_results'),
+    path('analyze/queue_stats/', analysis_queue_stats_view, name='analysis_queue_stats'),
     path('decode/status/<task_id>/', decode_task_status, name='decode_task_status'),
     path('decode/results/', decode_results_view, name='decode_results'),
+    path('decode/batch/', batch_decode_view, name='batch_decode'),
+    path('decode/batch/status/<str:task_id>/', batch_decode_status, name='batch_decode_status'),
     path('voxel_to_nifti/', voxel_to_nifti_view, name='voxel_to_nifti'),
 
 ]
\ No newline at end of file
@@ -1,8 +1,8 @@
 from django.shortcuts import render
 from django.contrib import messages
-import environ
 import os
-from sqlalchemy_utils.db_utils import determine_filetype, fetch_2mm_mni152_mask
+from functools import lru_cache
+from sqlalchemy_utils.db_utils import fetch_2mm_mni152_mask, fetch_from_s3, mask_2mm_mni152
 from sqlalchemy_utils.db_session import get_session
 from sqlalchemy_utils.models_sqlalchemy_orm import Subject, Symptom, Domain, Subdomain, ConnectivityFile
 import numpy as np
@@ -10,12 +10,17 @@ import nibabel as nib
 from PIL import Image
 import gzip
 from io import BytesIO
-import boto3
-from botocore.client import Config
-from nilearn.maskers import NiftiMasker
 import pandas as pd
 from pages.forms import NiftiUploadForm
-from pages.tasks import decode_task_wrapper, run_full_lesion_analysis
+from pages.tasks import batch_decode_task, decode_task_wrapper, run_full_lesion_analysis
+from pages.tasks.batch_decode import (
+    BATCH_DECODE_MAX_MAPS, check_output_format, list_uploaded_maps
+)
+from pages.tasks.decode_cache import decode_result_cache_key, get_cached_decode_result, hash_masked_map
+from pages.tasks.parcel_preview import LESION_PREVIEW_TASK_EXPIRES, lesion_preview_cache_key, lesion_preview_task
+from pages.tasks.scheduling import SchedulerLimitExceeded, get_scheduler_stats, get_task_owner, submit_task
+from pages.tasks.staging import delete_staged_payload, stage_masked_vector, stage_nifti, stage_uploaded_file
+from django.core.cache import cache
 from celery.result import AsyncResult
 from django.http import JsonResponse
 from django.shortcuts import redirect
@@ -28,65 +33,20 @@ from django.views.decorators.csrf import csrf_protect
 from celery import chain
 from pages.models import UsageLog
 
-env = environ.Env()
 
-# --- Configuration (omitted for brevity, remains unchanged) ---
-DO_ACCESS_KEY_ID = env('DO_SPACES_ACCESS_KEY_ID')
-DO_SECRET_ACCESS_KEY = env('DO_SPACES_SECRET_ACCESS_KEY')
-DO_STORAGE_BUCKET_NAME = env('DO_SPACES_BUCKET_NAME')
-DO_S3_ENDPOINT_URL = env('DO_SPACES_ENDPOINT_URL')
-DO_SPACES_LOCATION = env('DO_SPACES_LOCATION', default='nyc3')
-DO_LOCATION = env('DO_LOCATION')
-DO_S3_CUSTOM_DOMAIN = f'{DO_STORAGE_BUCKET_NAME}.{DO_SPACES_LOCATION}.digitaloceanspaces.com'
-
-
-def get_s3_client():
-    env = environ.Env()
-    
-    session = boto3.session.Session()
-    client = session.client('s3',
-        config=Config(s3={'addressing_style': 'virtual'}),
-        region_name=env('DO_SPACES_LOCATION', default='nyc3'),
-        endpoint_url=env('DO_SPACES_ENDPOINT_URL'),
-        aws_access_key_id=env('DO_SPACES_ACCESS_KEY_ID'),
-        aws_secret_access_key=env('DO_SPACES_SECRET_ACCESS_KEY'),
-    )
-    
-    return client
+@lru_cache(maxsize=None)
+def _load_voxel_template():
+    """
+    Loads the static 2mm MNI152 brain mask once per process.
 
-def fetch_from_s3(filepath):
-    env = environ.Env()
-    bucket_name = env('DO_SPACES_BUCKET_NAME')
-    
-    # Get S3 client
-    s3_client = get_s3_client()
-    
-    # Get the file from S3
-    try:
-        response = s3_client.get_object(Bucket=bucket_name, Key=os.path.join(DO_LOCATION, filepath))
-        file_data = response['Body'].read()
-    except Exception as e:
-        raise Exception(f"Error fetching file from S3: {str(e)}")
-    
-    # Determine file type and process accordingly
-    extension = determine_filetype(filepath)
-    
-    if extension == 'nii.gz':
-        fh = nib.FileHolder(fileobj=gzip.GzipFile(fileobj=BytesIO(file_data)))
-        return nib.Nifti1Image.from_file_map({'header': fh, 'image': fh})
-    
-    elif extension == 'nii':
-        fh = nib.FileHolder(fileobj=BytesIO(file_data))
-        return nib.Nifti1Image.from_file_map({'header': fh, 'image': fh})
-    
-    elif extension == 'npy':
-        return np.load(BytesIO(file_data), allow_pickle=True)
-    
-    elif extension in ['png', 'jpg', 'jpeg']:
-        return Image.open(BytesIO(file_data))
-    
-    else:
-        raise ValueError(f"Unsupported file type: {extension}")
+    Returns:
+        tuple: (affine, inverse affine, shape, boolean mask array), all treated as read-only.
+    """
+    mask_path = os.path.join('static', 'images', 'MNI152_T1_2mm_brain_mask.nii.gz')
+    mask_img = nib.load(mask_path)
+    mask = np.asarray(mask_img.dataobj) != 0
+    mask.flags.writeable = False
+    return mask_img.affine, np.linalg.inv(mask_img.affine), mask_img.shape, mask
 
 
 def _create_nifti_from_voxels(request_body_unicode: str) -> nib.Nifti1Image:
@@ -99,18 +59,14 @@ def _create_nifti_from_voxels(request_body_unicode: str) -> nib.Nifti1Image:
     Returns:
         A nibabel Nifti1Image object.
     """
-    # Load the mask image to use as a template
-    mask_path = os.path.join('static', 'images', 'MNI152_T1_2mm_brain_mask.nii.gz')
-    mask_img = nib.load(mask_path)
-    affine = mask_img.affine
-    inverse_affine = np.linalg.inv(affine)
-    data_shape = mask_img.shape
+    # The cached mask image is the template
+    affine, inverse_affine, data_shape, mask = _load_voxel_template()
 
     # Get the JSON data from the request body
     voxel_list = json.loads(request_body_unicode)
 
     # Extract MNI coordinates and values
-    mni_coords = np.array([voxel[:3] for voxel in voxel_list])
+    mni_coords = np.array([voxel[:3] for voxel in voxel_list]).reshape(-1, 3)
     values = np.array([voxel[3] for voxel in voxel_list])
 
     # Convert MNI coordinates to voxel indices
@@ -120,24 +76,15 @@ def _create_nifti_from_voxels(request_body_unicode: str) -> nib.Nifti1Image:
     # Create an empty data array with the same shape as the mask
     data_array = np.zeros(data_shape)
 
-    # Set the values at the voxel indices
-    valid_indices = []
-    for idx, value in zip(voxel_indices, values):
-        x, y, z = idx
-        # Ensure indices are within bounds
-        if (0 <= x < data_shape[0]) and (0 <= y < data_shape[1]) and (0 <= z < data_shape[2]):
-            valid_indices.append(idx)
-
-    # Create a mask for valid indices to avoid errors
-    if valid_indices:
-        valid_indices = np.array(valid_indices).T
-        data_array[valid_indices[0], valid_indices[1], valid_indices[2]] = values
-
-    # Create a new NIfTI image and standardize it using the masker
-    new_img = nib.Nifti1Image(data_array, affine)
-    masker = NiftiMasker(mask_img=mask_img).fit()
-    
-    return masker.inverse_transform(np.squeeze(masker.transform(new_img)))
+    # Set the values at the voxel indices that are within bounds
+    in_bounds = np.all((voxel_indices >= 0) & (voxel_indices < np.array(data_shape)), axis=1)
+    valid_indices = voxel_indices[in_bounds].T
+    data_array[valid_indices[0], valid_indices[1], valid_indices[2]] = values[in_bounds]
+
+    # Zero everything outside the brain mask (what masker.inverse_transform(masker.transform(img)) did)
+    data_array[~mask] = 0
+
+    return nib.Nifti1Image(data_array, affine)
 
 @login_required
 def analyze_view(request):
@@ -151,19 +98,38 @@ def analyze_view(request):
             # Store taxonomy_level in session
             request.session['taxonomy_level'] = taxonomy_level
 
-            # Serialize the in-memory NIFTI image
-            user_map_data = user_map.to_bytes()
-
             is_staff = request.user.is_staff
 
-            # Start the Celery task
-            task = decode_task_wrapper.delay(taxonomy_level, user_map_data, is_staff)
-
-            context = {
-                'page_name': 'Decode',
-                'task_id': task.id,
-            }
-            return render(request, 'pages/decode_progress.html', context)
+            # Identical maps decoded against the same data are served from the result cache
+            masked_map = mask_2mm_mni152(user_map)[0]
+            map_hash = hash_masked_map(masked_map)
+            cached_result = get_cached_decode_result(decode_result_cache_key(map_hash, taxonomy_level, is_staff))
+            if cached_result is not None:
+                context = {
+                    'page_name': 'Decode_Results',
+                    'taxonomy_level': taxonomy_level,
+                    'grouped_results': cached_result.get('grouped_results', []),
+                    'raw_results': cached_result.get('raw_results', []),
+                }
+                return render(request, 'pages/decode_results.html', context)
+
+            # Stage the in-mask values on the shared volume; only its key goes through the broker
+            staged_map_key = stage_masked_vector(masked_map)
+
+            # Start the Celery task in the interactive lane, subject to the per-user cap
+            try:
+                task = submit_task(
+                    decode_task_wrapper, (taxonomy_level, staged_map_key, is_staff, map_hash), request.user.id
+                )
+            except SchedulerLimitExceeded as e:
+                delete_staged_payload(staged_map_key)
+                messages.error(request, str(e))
+            else:
+                context = {
+                    'page_name': 'Decode',
+                    'task_id': task.id,
+                }
+                return render(request, 'pages/decode_progress.html', context)
         else:
             messages.error(request, 'Form is invalid.')
     else:
@@ -200,6 +166,9 @@ def decode_task_status(request, task_id):
             }
         else:
             response = {'state': result.state}
+
+        if result.state not in ('SUCCESS', 'FAILURE'):
+            response['preview'] = cache.get(lesion_preview_cache_key(task_id))
         
         print(f"Response: {response}")  # Debug line
         return JsonResponse(response)
@@ -276,18 +245,32 @@ def analyze_voxels_view(request):
             # Step 1: Call the helper to create the NIfTI object
             new_img = _create_nifti_from_voxels(request.body.decode('utf-8'))
 
-            # Step 2: Save the image to a BytesIO object to get its byte representation
-            img_bytes = BytesIO()
-            new_img.to_file_map({'image': nib.FileHolder(fileobj=img_bytes)})
-            img_bytes.seek(0)
-            nifti_data_bytes = img_bytes.read()
+            # Step 2: Stage the image on the shared volume; only its key goes through the broker
+            staged_roi_key = stage_nifti(new_img)
 
             # Step 3: Get user info and run the analysis task
             is_staff = request.user.is_staff
             taxonomy_level = 'symptom'
-            task_result = run_full_lesion_analysis.apply_async(args=(nifti_data_bytes, taxonomy_level, is_staff))
-
-            # Step 4: Return the task ID to the client
+            try:
+                task_result = submit_task(
+                    run_full_lesion_analysis, (staged_roi_key, taxonomy_level, is_staff), request.user.id
+                )
+            except SchedulerLimitExceeded as e:
+                delete_staged_payload(staged_roi_key)
+                return JsonResponse({'error': str(e)}, status=429)
+
+            # Step 4: Decode an approximate map from the parcel connectome on a decode worker while the
+            # exact job runs; the progress page picks it up from the cache. The ROI is staged again because
+            # the analysis task deletes its copy once read.
+            try:
+                lesion_preview_task.apply_async(
+                    args=(stage_nifti(new_img), taxonomy_level, is_staff, task_result.id),
+                    expires=LESION_PREVIEW_TASK_EXPIRES,
+                )
+            except Exception as e:
+                print(f"Lesion preview unavailable: {str(e)}")
+
+            # Step 5: Return the task ID to the client
             return JsonResponse({'task_id': task_result.id})
 
         except Exception as e:
@@ -334,6 +317,9 @@ def analyze_task_status(request, task_id):
             }
         else:
             response = {'state': result.state}
+
+        if result.state not in ('SUCCESS', 'FAILURE'):
+            response['preview'] = cache.get(lesion_preview_cache_key(task_id))
         
         print(f"Response: {response}")  # Debug line
         return JsonResponse(response)
@@ -370,4 +356,84 @@ def analyze_results_view(request):
         'connectivity_map_url': task_result.get('connectivity_map_url'),
         'lesion_mask_url': task_result.get('lesion_mask_url'),
     }
-    return render(request, 'pages/analyze_results.html', context)
\ No newline at end of file
+    return render(request, 'pages/analyze_results.html', context)
+
+
+@login_required
+def analysis_queue_stats_view(request):
+    """
+    Queue depth, jobs in flight and queue wait times per scheduling lane (staff only).
+    """
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only.'}, status=403)
+    return JsonResponse(get_scheduler_stats())
+
+
+@login_required
+@csrf_protect
+def batch_decode_view(request):
+    """
+    Queue a batch decode of many maps in the batch lane.
+
+    POST fields: `maps` (one or more .nii, .nii.gz, .lbmv, .zip or .tar(.gz) files),
+    `taxonomy_level` and `format` ('csv' or 'parquet'). Returns the task ID; poll
+    batch_decode_status for progress and the results file URL.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'message': 'Only POST requests are allowed.'}, status=405)
+    UsageLog.objects.create(user=request.user, page_name='batch_decode')
+
+    taxonomy_level = request.POST.get('taxonomy_level', 'symptom')
+    output_format = request.POST.get('format', 'csv')
+    if taxonomy_level not in ('symptom', 'subdomain', 'domain'):
+        return JsonResponse({'error': 'taxonomy_level must be symptom, subdomain or domain.'}, status=400)
+    uploaded_files = request.FILES.getlist('maps')
+    try:
+        check_output_format(output_format)
+        # Only names, sizes and archive directories are checked here; the task reads and masks the maps
+        maps = list_uploaded_maps([(uploaded_file.name, uploaded_file) for uploaded_file in uploaded_files])
+        if not maps:
+            return JsonResponse({'error': 'No maps were uploaded.'}, status=400)
+        if len(maps) > BATCH_DECODE_MAX_MAPS:
+            return JsonResponse({'error': f'At most {BATCH_DECODE_MAX_MAPS} maps can be decoded at once.'}, status=400)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    # Stage the uploads as they are; only their keys go through the broker
+    staged_uploads = [[stage_uploaded_file(uploaded_file), uploaded_file.name] for uploaded_file in uploaded_files]
+    try:
+        task = submit_task(
+            batch_decode_task,
+            (staged_uploads, taxonomy_level, request.user.is_staff, output_format),
+            request.user.id,
+            lane='batch',
+        )
+    except SchedulerLimitExceeded as e:
+        for key, _ in staged_uploads:
+            delete_staged_payload(key)
+        return JsonResponse({'error': str(e)}, status=429)
+    return JsonResponse({'task_id': task.id, 'n_maps': len(maps)})
+
+
+@login_required
+def batch_decode_status(request, task_id):
+    # Results may be grouped by staff-only taxonomy, so only the submitter (or staff) may see them
+    if not request.user.is_staff and get_task_owner(task_id) != request.user.id:
+        return JsonResponse({'error': 'Task not found.'}, status=404)
+    result = AsyncResult(task_id)
+    if result.state == 'SUCCESS':
+        response = {'state': 'SUCCESS', **result.result}
+    elif result.state == 'FAILURE':
+        response = {'state': 'FAILURE', 'error': str(result.result)}
+    elif result.state == 'PROGRESS':
+        info = result.info or {}
+        response = {
+            'state': 'PROGRESS',
+            'current': info.get('current', 0),
+            'total': info.get('total', 1),
+            'progress': info.get('progress', 0),
+            'status': info.get('status', ''),
+        }
+    else:
+        response = {'state': result.state}
+    return JsonResponse(response)
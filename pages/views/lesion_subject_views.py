@@ -13,8 +13,7 @@ from urllib.parse import quote
 from pages.forms import SubjectForm
 from pages.models import CaseReport, Subject
 from accounts.models import CustomUser as User
-from sqlalchemy_utils.db_utils import get_files_at_xyz
-from sqlalchemy_utils.db_session import get_session
+from pages.tasks.spatial_index import get_subject_values_at_xyz
 from pages.decorators import user_can_edit_subject
 
 
@@ -99,32 +98,28 @@ def get_lesion_subjects_json(request):
     if not is_staff_user(request.user):
         queryset = queryset.filter(internal_use_only=False)
 
-    # Apply spatial filtering (existing logic)
+    # Apply spatial filtering from the in-memory spatial index
     if x and y and z:
         try:
             x_int, y_int, z_int = map(int, (x, y, z))
-            session = get_session()
-
-            try:
-                internal_map_type = map_type.lower()
-                roi_results = get_files_at_xyz(x_int, y_int, z_int, internal_map_type, session)
-                subject_ids = list(roi_results.keys())
-
-                if subject_ids:
-                    when_list = [When(id=subject_id, then=Value(value)) 
-                               for subject_id, value in roi_results.items()]
-                    queryset = queryset.filter(id__in=subject_ids).annotate(
-                        value=Case(*when_list, default=Value(0), output_field=FloatField())
-                    ).order_by('-value')
-                else:
-                    queryset = queryset.none()
-            except Exception as e:
-                return JsonResponse({'error': f'Error fetching files: {str(e)}'}, status=500)
-            finally:
-                session.close()
         except ValueError:
             return JsonResponse({'error': 'Invalid coordinate values'}, status=400)
 
+        try:
+            roi_results = get_subject_values_at_xyz(x_int, y_int, z_int, map_type.lower())
+        except Exception as e:
+            return JsonResponse({'error': f'Error fetching files: {str(e)}'}, status=500)
+        subject_ids = list(roi_results.keys())
+
+        if subject_ids:
+            when_list = [When(id=subject_id, then=Value(value))
+                         for subject_id, value in roi_results.items()]
+            queryset = queryset.filter(id__in=subject_ids).annotate(
+                value=Case(*when_list, default=Value(0), output_field=FloatField())
+            ).order_by('-value')
+        else:
+            queryset = queryset.none()
+
     # Apply filters and collect counts
     filter_counts = {}
     if sex_name:
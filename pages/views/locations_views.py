@@ -1,7 +1,11 @@
 # pages/views/locations_views.py
 
+from django.http import JsonResponse
 from django.shortcuts import render
 
+from sqlalchemy_utils.db_session import get_session
+from sqlalchemy_utils.db_utils import get_labels_at_xyz
+
 
 def locations_view(request):
     x = request.GET.get('x', '0')
@@ -17,4 +21,23 @@ def locations_view(request):
         'z': z,
         'map_type': map_type,
     }
-    return render(request, 'pages/locations.html', context)
\ No newline at end of file
+    return render(request, 'pages/locations.html', context)
+
+
+def get_atlas_labels_json(request):
+    """
+    Return the atlas labels at an MNI152 coordinate, for hover/click labeling in the viewer.
+    """
+    try:
+        x, y, z = (int(request.GET[axis]) for axis in ('x', 'y', 'z'))
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Invalid coordinate values'}, status=400)
+
+    session = get_session()
+    try:
+        labels = get_labels_at_xyz(x, y, z, session)
+    finally:
+        session.close()
+    return JsonResponse({
+        'labels': [{'label': label, 'parcellation': parcellation} for label, parcellation in labels],
+    })
@@ -1,7 +1,7 @@
 from sklearn.utils import Bunch
 from nilearn.datasets import load_mni152_brain_mask, fetch_atlas_juelich as fetch_atlas_juelich_nilearn, fetch_atlas_aal as fetch_atlas_aal_nilearn, fetch_atlas_harvard_oxford as fetch_atlas_harvard_oxford_nilearn
 from nilearn.maskers import NiftiMasker, NiftiLabelsMasker
-from nilearn.image import resample_img
+from nilearn.image import load_img, resample_img
 from nibabel.affines import apply_affine
 import os
 import numpy as np
@@ -14,7 +14,7 @@ from typing import List, Optional, Tuple, Union, Dict
 from sqlalchemy.exc import NoSuchTableError
 from sqlalchemy_utils.models_sqlalchemy_orm import User, Base, Parcellation, Parcel, VoxelwiseValue, ParcelwiseConnectivityValue, ParcelwiseROIValue, ParcelwiseGroupLevelMapValue, Domain, Subdomain, Symptom, Synonym, MeshTerm, ResearchPaper, Subject, Connectome, ConnectivityFile, ROIFile, GroupLevelMapFile, Cause, Sex, Handedness, StatisticType, Dimension, ImageModality, PatientCohort, CoordinateSpace, CaseReport, MapType, Level, CaseReportSymptom
 from sqlalchemy.orm import Session as _Session
-from sqlalchemy import  and_, select
+from sqlalchemy import  and_, event, select, text
 import warnings
 import gzip
 from io import BytesIO
@@ -26,12 +26,24 @@ from django.contrib.auth.hashers import make_password
 from datetime import datetime
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.core.cache import cache
 import re
 from sqlalchemy.exc import IntegrityError
 import os
-import boto3
 import environ
-from botocore.client import Config
+from sqlalchemy_utils.s3_client import get_s3_client, get_s3_object_bytes, get_s3_object_etag, get_s3_object_stream
+from sqlalchemy_utils.nifti_stream import read_nifti_stream
+from sqlalchemy_utils.pg_copy import copy_chunks, create_staging_table, iter_binary_chunks, iter_csv_chunks
+from sqlalchemy_utils.parcelwise_arrays import (
+    PARCELWISE_STORAGE, SUBJECT_MAP_TYPES, get_indexed_subject_values_at_xyz, insert_parcelwise_array,
+    merge_into_parcel_subject_index, pack_parcelwise_array, rebuild_parcel_subject_index, repack_parcelwise_arrays,
+)
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+from sqlalchemy_utils.file_cache import FILE_CACHE_ENABLED, get_cached_file, put_cached_file
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -56,6 +68,12 @@ DO_S3_ENDPOINT_URL = env('DO_SPACES_ENDPOINT_URL')
 DO_SPACES_LOCATION = env('DO_SPACES_LOCATION', default='nyc3')
 DO_LOCATION = env('DO_LOCATION')
 
+# Worker-local working storage (decode matrix, caches, staged payloads)
+LOCAL_DATA_DIR = env('LOCAL_DATA_DIR', default=str(BASE_DIR / 'local_data'))
+
+# Concurrent downloads in fetch_many_from_s3; keep at or below S3_MAX_POOL_CONNECTIONS
+S3_FETCH_WORKERS = env.int('S3_FETCH_WORKERS', default=16)
+
 """Random helper functions"""
 
 def numpy_to_python_type(value): return float(value) if hasattr(value, "dtype") and np.issubdtype(value.dtype, np.floating) else int(value) if hasattr(value, "dtype") and np.issubdtype(value.dtype, np.integer) else value
@@ -163,22 +181,48 @@ def save_to_s3(array: np.ndarray, s3_path: str) -> str:
     saved_path = default_storage.save(s3_path, file_content)
     return saved_path
     
-def fetch_from_s3(filepath):
-    extension = determine_filetype(filepath)
+def fetch_from_s3(filepath, md5=None):
+    """
+    Fetch and load a file from DigitalOcean Spaces.
 
-    with default_storage.open(filepath) as file:
-        file_data = file.read()
+    NIfTI and .npy files are served from the local file cache when the same version
+    was fetched before, and memory-mapped from it. The version is md5 if given
+    (e.g. ConnectivityFile.md5), otherwise the object's S3 ETag. NIfTI files are
+    streamed and decoded into float32 arrays.
+    """
+    extension = determine_filetype(filepath)
 
-    if extension == 'nii.gz':
-        fh = nib.FileHolder(fileobj=gzip.GzipFile(fileobj=BytesIO(file_data)))
-        return nib.Nifti1Image.from_file_map({'header': fh, 'image': fh})
+    cacheable = FILE_CACHE_ENABLED and extension in ['nii.gz', 'nii', 'npy']
+    if cacheable:
+        try:
+            version = md5 or get_s3_object_etag(filepath)
+        except Exception as e:
+            raise Exception(f"Error fetching file from S3: {str(e)}")
+        cached = get_cached_file(filepath, version)
+        if cached is not None:
+            return cached
+
+    if extension in ['nii.gz', 'nii']:
+        # Decompress the response body straight into the image array, without whole-file buffers
+        try:
+            body = get_s3_object_stream(filepath)
+        except Exception as e:
+            raise Exception(f"Error fetching file from S3: {str(e)}")
+        try:
+            loaded = read_nifti_stream(body, gzipped=(extension == 'nii.gz'))
+        finally:
+            body.close()
+        if cacheable:
+            loaded = put_cached_file(filepath, version, loaded)
+        return loaded
 
-    elif extension == 'nii':
-        fh = nib.FileHolder(fileobj=BytesIO(file_data))
-        return nib.Nifti1Image.from_file_map({'header': fh, 'image': fh})
+    try:
+        file_data = get_s3_object_bytes(filepath)
+    except Exception as e:
+        raise Exception(f"Error fetching file from S3: {str(e)}")
 
-    elif extension == 'npy':
-        return np.load(BytesIO(file_data), allow_pickle=True)
+    if extension == 'npy':
+        loaded = np.load(BytesIO(file_data), allow_pickle=True)
 
     elif extension in ['png', 'jpg', 'jpeg']:
         return Image.open(BytesIO(file_data))
@@ -186,22 +230,129 @@ def fetch_from_s3(filepath):
     else:
         raise ValueError(f"Unsupported file type: {extension}")
 
+    if cacheable:
+        loaded = put_cached_file(filepath, version, loaded)
+    return loaded
+
+def fetch_many_from_s3(filepaths, md5s=None, max_workers=None, max_in_flight=None, return_exceptions=False):
+    """
+    Fetch and load many files from DigitalOcean Spaces concurrently, yielding them in order.
+
+    Downloads and decompression run in a bounded thread pool on the shared S3 client.
+    At most max_in_flight files are fetched ahead of the consumer, which bounds memory
+    when the caller processes one image at a time.
+
+    Args:
+        filepaths (list): Paths of the files within DO_LOCATION.
+        md5s (list, optional): Content versions for the file cache, aligned with filepaths.
+        max_workers (int, optional): Concurrent fetches. Defaults to S3_FETCH_WORKERS.
+        max_in_flight (int, optional): Fetched-but-not-consumed limit. Defaults to 2 * max_workers.
+        return_exceptions (bool): Yield the exception for files that fail instead of raising.
+
+    Yields:
+        The loaded file for each path, as returned by fetch_from_s3.
+    """
+    max_workers = max_workers or S3_FETCH_WORKERS
+    max_in_flight = max(max_in_flight or 2 * max_workers, 1)
+    jobs = iter(zip(filepaths, md5s if md5s is not None else [None] * len(filepaths)))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(fetch_from_s3, path, md5) for path, md5 in islice(jobs, max_in_flight))
+        try:
+            while pending:
+                future = pending.popleft()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    result = e
+                for path, md5 in islice(jobs, 1):
+                    pending.append(executor.submit(fetch_from_s3, path, md5))
+                yield result
+        finally:
+            # Consumer stopped early or a fetch failed: drop queued work
+            for future in pending:
+                future.cancel()
+
 """Functions for manipulating imaging data itself"""
 
-def fetch_2mm_mni152_mask(resolution=2):
-    """Loads the MNI152 template in 2mm resolution with shape = (91, 109, 91)"""
-    target_shape = (91, 109, 91)
-    target_affine = np.array([[2, 0, 0, -90],
+# Grid of the 2mm MNI152 mask used throughout the project
+MNI152_2MM_SHAPE = (91, 109, 91)
+MNI152_2MM_AFFINE = np.array([[2, 0, 0, -90],
                               [0, 2, 0, -126],
                               [0, 0, 2, -72],
                               [0, 0, 0, 1]])
+
+_mni152_masker = None
+_mni152_masker_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _load_2mm_mni152_mask(resolution):
     return resample_img(
         load_mni152_brain_mask(resolution=resolution, threshold=0.10),
-        target_affine=target_affine,
-        target_shape=target_shape,
+        target_affine=MNI152_2MM_AFFINE,
+        target_shape=MNI152_2MM_SHAPE,
         interpolation='nearest'
     )
 
+def fetch_2mm_mni152_mask(resolution=2):
+    """Loads the MNI152 template in 2mm resolution with shape = (91, 109, 91). Resampled once per process."""
+    return _load_2mm_mni152_mask(resolution)
+
+def get_2mm_mni152_masker():
+    """
+    Returns a Bunch with the process-wide fitted NiftiMasker for the 2mm MNI152 mask (`masker`),
+    the mask image (`mask_img`) and the flat, C-order indices of the in-mask voxels (`flat_indices`).
+    Treat all of them as read-only; they are shared by every caller in the process.
+    """
+    global _mni152_masker
+    if _mni152_masker is None:
+        with _mni152_masker_lock:
+            if _mni152_masker is None:
+                mask_img = fetch_2mm_mni152_mask()
+                flat_indices = np.flatnonzero(np.asarray(mask_img.dataobj).astype(bool))
+                flat_indices.flags.writeable = False
+                _mni152_masker = Bunch(
+                    masker=NiftiMasker(mask_img=mask_img).fit(),
+                    mask_img=mask_img,
+                    flat_indices=flat_indices,
+                )
+    return _mni152_masker
+
+def is_2mm_mni152_grid(img) -> bool:
+    """True if img is already on the 91x109x91 2mm MNI152 grid, so no resampling is needed."""
+    return img.shape[:3] == MNI152_2MM_SHAPE and np.allclose(img.affine, MNI152_2MM_AFFINE)
+
+def mask_2mm_mni152(img) -> np.ndarray:
+    """
+    Extract the in-mask voxels of a 3D or 4D image, like NiftiMasker.transform with the 2mm MNI152 mask.
+
+    Images already on the 2mm MNI152 grid are masked by fancy indexing with the precomputed
+    voxel indices, skipping resampling. Anything else goes through the shared NiftiMasker.
+    img can be anything NiftiMasker.transform accepts, e.g. a filename or a list of 3D images.
+
+    Returns:
+        np.ndarray: Shape (n_images, n_mask_voxels); n_images is 1 for a 3D image.
+    """
+    mni152 = get_2mm_mni152_masker()
+    # Filenames and lists of images have no shape or affine until loaded; loaded images pass through as they are
+    img = load_img(img)
+    if not is_2mm_mni152_grid(img):
+        return np.atleast_2d(mni152.masker.transform(img))
+
+    data = np.asanyarray(img.dataobj)
+    if data.ndim == 3:
+        return data.reshape(-1)[mni152.flat_indices][np.newaxis, :]
+    return data.reshape(-1, data.shape[-1])[mni152.flat_indices].T
+
+def unmask_2mm_mni152(values) -> nib.Nifti1Image:
+    """Inverse of mask_2mm_mni152 for a single map: scatter masked values back onto the 2mm MNI152 grid."""
+    data = np.zeros(np.prod(MNI152_2MM_SHAPE), dtype=np.asarray(values).dtype)
+    data[get_2mm_mni152_masker().flat_indices] = np.ravel(values)
+    return nib.Nifti1Image(data.reshape(MNI152_2MM_SHAPE), MNI152_2MM_AFFINE)
+
 def add_name_attribute(name):
     def decorator(func):
         def wrapper(*args, **kwargs):
@@ -331,6 +482,11 @@ def apply_parcellation(voxelwise_map, parcellation, strategy='mean', return_regi
 
 """SQL helper functions"""
 
+# Process-local memo of parcellation name -> id. Parcellations are never renamed and reloading
+# one keeps its row, so unlike file, user and parcel ids these cannot go stale in another process.
+_parcellation_ids = {}
+_parcellation_ids_lock = threading.Lock()
+
 def get_user_id(session: _Session, username: str = "josephturner") -> int:
     user = session.query(User).filter_by(username=username).first()
     if not user:
@@ -360,7 +516,15 @@ def get_parcellation_id(parcellation_name, session):
     """
     Uses SQLAlchemy to get the id where parcellations.name = parcellation_name.
     """
-    return session.query(Parcellation.id).filter(Parcellation.name == parcellation_name).scalar()
+    with _parcellation_ids_lock:
+        if parcellation_name in _parcellation_ids:
+            return _parcellation_ids[parcellation_name]
+    parcellation_id = session.query(Parcellation.id).filter(Parcellation.name == parcellation_name).scalar()
+    # Only found ids are kept, so a parcellation loaded later is still picked up
+    if parcellation_id is not None:
+        with _parcellation_ids_lock:
+            _parcellation_ids[parcellation_name] = parcellation_id
+    return parcellation_id
 
 def get_parcel_id(parcellation_id, parcel_value, session):
     """
@@ -368,90 +532,126 @@ def get_parcel_id(parcellation_id, parcel_value, session):
     """
     return session.query(Parcel.id).filter(Parcel.parcellation_id == parcellation_id, Parcel.value == parcel_value).scalar()
 
-def get_labels_at_xyz(x: int, y: int, z: int, session: _Session) -> List[Tuple[Optional[str], Optional[str]]]:
-    """
-    Uses SQLAlchemy to get the labels of all parcels at the given MNI152 coordinates.
-    Returns a list of tuples, where each tuple contains the label and the parcellation name.
-    Note: Shouldn't there be a more efficient way to do this in one query? Regular SQL can do this with chained joins.
-    """
-    # Query to find all parcel_ids in VoxelwiseValue where the mni_x, mni_y, mni_z values match
-    voxels = session.query(VoxelwiseValue).filter(
-        and_(
-            VoxelwiseValue.mni152_x == x,
-            VoxelwiseValue.mni152_y == y,
-            VoxelwiseValue.mni152_z == z
-        )
-    ).all()
+# Shared version of every parcellation's parcels and voxelwise values, bumped by invalidate_parcel_lookups
+# when one is (re)loaded; process-local memos built from them are dropped once it changes
+PARCELS_VERSION_KEY = 'db_utils:parcels_version'
 
-    if not voxels:
-        return []
+# parcellation id -> (parcels version, sorted parcel values, parcel ids in the same order)
+_parcel_id_lookups = {}
+_parcel_id_lookups_lock = threading.Lock()
 
-    results = []
+def get_parcels_version() -> int:
+    """The shared parcels version from the Django cache."""
+    return cache.get(PARCELS_VERSION_KEY, 0)
 
-    for voxel in voxels:
-        parcel = session.query(Parcel).filter(Parcel.id == voxel.parcel_id).first()
-        if parcel is None:
-            continue
-        parcellation = session.query(Parcellation).filter(Parcellation.id == parcel.parcellation_id).first()
-        if parcellation is None:
-            continue
-        results.append((parcel.label, parcellation.name))
+def invalidate_parcel_lookups():
+    """
+    Make every process forget memoized parcel ids and atlas labels on next use, e.g. after parcels are inserted or replaced.
+    """
+    try:
+        cache.incr(PARCELS_VERSION_KEY)
+    except ValueError:
+        cache.set(PARCELS_VERSION_KEY, 1, None)
 
-    return results
+def get_parcel_id_lookup(parcellation_id, session):
+    """
+    Loads every (value, id) of a parcellation's parcels with one query, memoized per process until
+    the shared parcels version changes.
+    Returns a tuple (sorted parcel values, parcel ids in the same order) of NumPy arrays.
+    """
+    version = get_parcels_version()
+    with _parcel_id_lookups_lock:
+        cached = _parcel_id_lookups.get(parcellation_id)
+    if cached is not None and cached[0] == version:
+        return cached[1:]
+
+    parcels = session.query(Parcel.value, Parcel.id).filter(Parcel.parcellation_id == parcellation_id).all()
+    values = np.array([value for value, _ in parcels], dtype=np.float64)
+    ids = np.array([parcel_id for _, parcel_id in parcels], dtype=np.int64)
+    order = np.argsort(values, kind='stable')
+    lookup = (values[order], ids[order])
+    if len(parcels):
+        with _parcel_id_lookups_lock:
+            _parcel_id_lookups[parcellation_id] = (version,) + lookup
+    return lookup
+
+def get_parcel_ids(parcellation_id, parcel_values, session) -> np.ndarray:
+    """
+    Vectorized get_parcel_id: the parcel id of every value in parcel_values, or -1 where the parcellation has no such parcel.
+    """
+    sorted_values, ids = get_parcel_id_lookup(parcellation_id, session)
+    parcel_values = np.asarray(parcel_values, dtype=np.float64)
+    if len(sorted_values) == 0:
+        return np.full(parcel_values.shape, -1, dtype=np.int64)
+    positions = np.clip(np.searchsorted(sorted_values, parcel_values), 0, len(sorted_values) - 1)
+    return np.where(sorted_values[positions] == parcel_values, ids[positions], -1)
+
+# Atlas labels at a coordinate only change when a parcellation is (re)loaded, which bumps the parcels version
+LABELS_AT_XYZ_CACHE_SIZE = 250_000
+_labels_at_xyz_cache = OrderedDict()
+_labels_at_xyz_cache_version = None
+_labels_at_xyz_cache_lock = threading.Lock()
+
+def get_labels_at_xyz(x: int, y: int, z: int, session: _Session) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Uses SQLAlchemy to get the labels of all parcels at the given MNI152 coordinates.
+    Returns a list of tuples, where each tuple contains the label and the parcellation name.
+    One joined query over the (mni152_x, mni152_y, mni152_z) index, memoized per coordinate
+    until the shared parcels version changes.
+    """
+    global _labels_at_xyz_cache_version
+    key = (x, y, z)
+    version = get_parcels_version()
+    with _labels_at_xyz_cache_lock:
+        if _labels_at_xyz_cache_version != version:
+            _labels_at_xyz_cache.clear()
+            _labels_at_xyz_cache_version = version
+        if key in _labels_at_xyz_cache:
+            _labels_at_xyz_cache.move_to_end(key)
+            return list(_labels_at_xyz_cache[key])
+
+    rows = session.query(Parcel.label, Parcellation.name).join(
+        VoxelwiseValue, VoxelwiseValue.parcel_id == Parcel.id
+    ).join(
+        Parcellation, Parcellation.id == Parcel.parcellation_id
+    ).filter(
+        VoxelwiseValue.mni152_x == x,
+        VoxelwiseValue.mni152_y == y,
+        VoxelwiseValue.mni152_z == z,
+    ).order_by(VoxelwiseValue.id).all()
+    results = tuple((label, parcellation_name) for label, parcellation_name in rows)
+
+    with _labels_at_xyz_cache_lock:
+        # Skip results read under a version that has since been replaced
+        if _labels_at_xyz_cache_version != version:
+            return list(results)
+        _labels_at_xyz_cache[key] = results
+        if len(_labels_at_xyz_cache) > LABELS_AT_XYZ_CACHE_SIZE:
+            _labels_at_xyz_cache.popitem(last=False)
+    return list(results)
+
+# map_type -> (parcelwise values table, file table)
+PARCELWISE_TABLES = {
+    'connectivity': (ParcelwiseConnectivityValue, ConnectivityFile),
+    'roi': (ParcelwiseROIValue, ROIFile),
+    'group_level_map': (ParcelwiseGroupLevelMapValue, GroupLevelMapFile),
+}
 
 def get_files_at_xyz(x: int, y: int, z: int, map_type: str, session: _Session) -> Dict[int, float]:
     """
     Returns a dict mapping subject_id to maximum value at the specified coordinates and map_type.
+    One query over parcel_subject_index, which covers both parcelwise storages; the locations page
+    uses the in-memory pages.tasks.spatial_index instead.
+    Group-level maps have no subjects, so they always return an empty dict.
     """
-    # Query to find all parcel_ids in VoxelwiseValue where the mni_x, mni_y, mni_z values match
-    voxels = session.query(VoxelwiseValue).filter(
-        and_(
-            VoxelwiseValue.mni152_x == x,
-            VoxelwiseValue.mni152_y == y,
-            VoxelwiseValue.mni152_z == z
-        )
-    ).all()
-
-    if not voxels:
-        return {}
-
-    # Determine the correct table and file relationship based on map_type
-    if map_type == 'connectivity':
-        ArrayTable = ParcelwiseConnectivityValue
-        FileTable = ConnectivityFile
-        file_id_attr = 'connectivity_file_id'
-    elif map_type == 'roi':
-        ArrayTable = ParcelwiseROIValue
-        FileTable = ROIFile
-        file_id_attr = 'roi_file_id'
-    elif map_type == 'group_level_map':
-        ArrayTable = ParcelwiseGroupLevelMapValue
-        FileTable = GroupLevelMapFile
-        file_id_attr = 'group_level_map_file_id'
-    else:
+    if map_type not in PARCELWISE_TABLES:
         raise ValueError(f"Unknown map_type: {map_type}. Valid types are 'connectivity', 'roi', 'group_level_map'.")
 
-    subject_value_dict = {}
-
-    for voxel in voxels:
-        # Query the appropriate ArrayTable for the given parcel_id
-        arrays = session.query(ArrayTable).filter(ArrayTable.parcel_id == voxel.parcel_id).all()
-        for array in arrays:
-            # Query the FileTable for the given file ID
-            file_id = getattr(array, file_id_attr)
-            file = session.query(FileTable).filter(FileTable.id == file_id).first()
-            if file:
-                subject_id = file.subject_id
-                value = np.round(array.value,2)
-                # Update the subject's maximum value
-                if subject_id in subject_value_dict:
-                    subject_value_dict[subject_id] = max(subject_value_dict[subject_id], value)
-                else:
-                    subject_value_dict[subject_id] = value
+    rows = get_indexed_subject_values_at_xyz(x, y, z, map_type, session) if map_type in SUBJECT_MAP_TYPES else []
 
     print("Successfully retrieved files at coordinates.")
 
-    return subject_value_dict
+    return {subject_id: np.round(value, 2) for subject_id, value in rows if value is not None}
 
 """Functions for inserting data into SQL tables"""
 def data_to_voxelwise_values_table(parcellation, session):
@@ -459,50 +659,75 @@ def data_to_voxelwise_values_table(parcellation, session):
     Converts a parcellation to a data array in MNI152 template space (using the fetch_2mm_mni152_mask mask).
     Needs columns for parcel_id, mni152_x, mni152_y, mni152_z, and user_id. The primary key is an incremented integer
     assigned by SQL.
-    Use get_parcel_id to get the parcel_id, looking for the parcel with the same value and parcellation name.
 
         This is different from data_to_parcelwise_values_table because it is in MNI152 space, not in the parcellation space.
 
     Inserts into: `voxelwise_values` table in SQL.
-    Saves a npz file with the voxel data.
+    Parcel ids are resolved with one query, the rows are streamed with COPY into a temporary staging table,
+    and voxels already present are skipped by ON CONFLICT against uq_voxelwise_values_parcel_xyz
+    (apply sqlalchemy_utils.migrations first on databases created before it existed).
     """
-    mask_img = fetch_2mm_mni152_mask()
-    masker = NiftiMasker(mask_img=mask_img).fit()
-    
-    parcellation_values = masker.transform(parcellation.maps).ravel().astype(int) # These are the parcel values at each voxel;
-    mask_indices = np.nonzero(mask_img.get_fdata().astype(bool))
-    coords = apply_affine(mask_img.affine, np.column_stack(mask_indices))
-    parcel_id_map = {value: get_parcel_id(get_parcellation_id(parcellation.name, session), numpy_to_python_type(value), session) for value in np.unique(parcellation_values)}
-    parcel_ids = np.array([parcel_id_map[numpy_to_python_type(value)] for value in parcellation_values])
-    results = np.column_stack((parcel_ids, coords))
+    mni152 = get_2mm_mni152_masker()
+    mask_img = mni152.mask_img
+
+    parcellation_values = mask_2mm_mni152(parcellation.maps).ravel().astype(int) # These are the parcel values at each voxel;
+    mask_indices = np.unravel_index(mni152.flat_indices, MNI152_2MM_SHAPE)
+    coords = np.rint(apply_affine(mask_img.affine, np.column_stack(mask_indices))).astype(np.int32)
+
+    # Parcel value -> parcel id for the whole parcellation in one query
+    parcel_ids = get_parcel_ids(get_parcellation_id(parcellation.name, session), parcellation_values, session)
+    matched = parcel_ids >= 0
+    if not matched.any():
+        raise ValueError(f"No parcels found for parcellation {parcellation.name}; run parcellation_to_parcels_table first.")
+    if not matched.all():
+        warnings.warn(f"{np.count_nonzero(~matched)} voxels have parcel values without a parcel row; skipping them.")
+    parcel_ids = parcel_ids[matched]
+    coords = coords[matched]
 
     default_user_id = get_user_id(session)
-    
-    # Prepare a list of dictionaries for bulk insertion
-    records = [
-        {
-            'parcel_id': numpy_to_python_type(row[0]),
-            'mni152_x': numpy_to_python_type(row[1]),
-            'mni152_y': numpy_to_python_type(row[2]),
-            'mni152_z': numpy_to_python_type(row[3]),
-            'user_id': default_user_id  # Set the default user_id
-        }
-        for row in results
-    ]
-    
-    # Check for existing records and filter out the redundant ones
-    existing_records = set(
-        (v.parcel_id, v.mni152_x, v.mni152_y, v.mni152_z) for v in session.query(
-            VoxelwiseValue.parcel_id, VoxelwiseValue.mni152_x, VoxelwiseValue.mni152_y, VoxelwiseValue.mni152_z
-        ).all()
+
+    create_staging_table(
+        session, 'voxelwise_values_staging',
+        "parcel_id integer, mni152_x integer, mni152_y integer, mni152_z integer",
     )
-    
-    new_records = [record for record in records if (
-        record['parcel_id'], record['mni152_x'], record['mni152_y'], record['mni152_z']) not in existing_records]
-    
-    if new_records:
-        session.bulk_insert_mappings(VoxelwiseValue, new_records)
-        session.commit()
+    copy_chunks(
+        session, 'voxelwise_values_staging', ['parcel_id', 'mni152_x', 'mni152_y', 'mni152_z'],
+        iter_csv_chunks([parcel_ids, coords[:, 0], coords[:, 1], coords[:, 2]], ['%d', '%d', '%d', '%d']),
+    )
+    result = session.execute(text(
+        "INSERT INTO voxelwise_values (parcel_id, mni152_x, mni152_y, mni152_z, user_id, insert_date) "
+        "SELECT parcel_id, mni152_x, mni152_y, mni152_z, :user_id, now() FROM voxelwise_values_staging "
+        "ON CONFLICT (parcel_id, mni152_x, mni152_y, mni152_z) DO NOTHING"
+    ), {'user_id': default_user_id})
+    session.commit()
+    print(f"Inserted {result.rowcount} of {len(parcel_ids)} voxelwise values for {parcellation.name}.")
+
+    if result.rowcount:
+        invalidate_parcel_lookups()
+
+def _invalidate_decode_caches_after_commit(session, decode_matrix=False):
+    """
+    Once session commits, drop the cached taxonomy memberships and decode results (and, with
+    decode_matrix, mark every node's decode matrix stale), as pages/signals.py does for
+    connectivity files saved through Django. Runs once per transaction however many files it adds.
+    """
+    if not event.contains(session, 'after_commit', _invalidate_decode_caches):
+        event.listen(session, 'after_commit', _invalidate_decode_caches)
+    pending = session.info.setdefault('decode_cache_invalidation', {'decode_matrix': False})
+    pending['decode_matrix'] = pending['decode_matrix'] or decode_matrix
+
+def _invalidate_decode_caches(session):
+    pending = session.info.pop('decode_cache_invalidation', None)
+    if pending is None:
+        return
+    # Imported here because pages.tasks imports this module
+    from pages.tasks.decode_cache import invalidate_decode_results
+    from pages.tasks.decode_matrix import mark_decode_matrix_stale
+    from pages.tasks.taxonomy_membership import invalidate_taxonomy_membership
+    invalidate_taxonomy_membership()
+    invalidate_decode_results()
+    if pending.get('decode_matrix'):
+        mark_decode_matrix_stale()
 
 def file_to_file_table(filepath, parcellation, map_type, session, 
                        statistic_type=None, 
@@ -558,6 +783,8 @@ def file_to_file_table(filepath, parcellation, map_type, session,
 
         # Add the new record
         session.add(table(**record))
+        if map_type == 'connectivity':
+            _invalidate_decode_caches_after_commit(session, decode_matrix=True)
         session.commit()
         logger.info(f"File with path {filepath} added to the database.")
 
@@ -567,19 +794,82 @@ def file_to_file_table(filepath, parcellation, map_type, session,
         logger.error(f"An error occurred: {str(e)}")
         session.rollback()
 
+def insert_parcelwise_file(file_in_db, map_type, parcelwise_array, region_ids, parcellation_id, parcelwise_map_filepath, session, commit=True):
+    """
+    Adds the parcellated copy of file_in_db and its nonzero parcel values in one transaction.
+    Region ids are mapped to parcel ids with the cached lookup, and the values are written with binary COPY
+    into a staging table and inserted with one INSERT ... SELECT.
+    With PARCELWISE_STORAGE=arrays the values are stored as one packed array row instead.
+    Either way they are merged into parcel_subject_index (see sqlalchemy_utils.parcelwise_arrays).
+    Returns the new file row.
+    """
+    table, file_table = PARCELWISE_TABLES[map_type]
+    parcel_ids = get_parcel_ids(parcellation_id, region_ids, session)
+    if np.any(parcel_ids < 0):
+        raise ValueError(f"Region ids {np.asarray(region_ids)[parcel_ids < 0][:10].tolist()} have no parcel in parcellation {parcellation_id}.")
+    values = np.asarray(parcelwise_array, dtype=np.float64).ravel()
+    # Zero-valued parcels are not stored
+    keep = values != 0
+    parcel_ids, values = parcel_ids[keep], values[keep]
+
+    default_user_id = get_user_id(session)
+    file_data = {column.key: getattr(file_in_db, column.key) for column in file_table.__table__.columns if column.key not in ('id', 'insert_date')}
+    file_data.update({
+        'path': parcelwise_map_filepath,
+        'md5': md5_hash(parcelwise_array),
+        'parcellation_id': parcellation_id,
+        'filetype': 'npy',
+        'user_id': default_user_id,
+    })
+    new_file = file_table(**file_data)
+    session.add(new_file)
+    session.flush()
+
+    staging_table = f'{table.__tablename__}_staging'
+    create_staging_table(session, staging_table, "parcel_id integer, value double precision")
+    copy_chunks(session, staging_table, ['parcel_id', 'value'], iter_binary_chunks([parcel_ids, values], ['int4', 'float8']), copy_format='binary')
+    if PARCELWISE_STORAGE == 'arrays':
+        parcellation_parcel_ids = np.sort(get_parcel_id_lookup(parcellation_id, session)[1])
+        packed_values = pack_parcelwise_array(parcel_ids, values, parcellation_parcel_ids)
+        target = insert_parcelwise_array(session, map_type, new_file.id, parcellation_id, packed_values, default_user_id).__tablename__
+    else:
+        target = table.__tablename__
+        session.execute(text(
+            f"INSERT INTO {table.__tablename__} ({map_type}_file_id, parcel_id, value, user_id, insert_date) "
+            f"SELECT :file_id, parcel_id, value, :user_id, now() FROM {staging_table}"
+        ), {'file_id': new_file.id, 'user_id': default_user_id})
+    merge_into_parcel_subject_index(session, map_type, getattr(new_file, 'subject_id', None), staging_table)
+    # Dropped on commit anyway; dropped now so several files can share one transaction
+    session.execute(text(f"DROP TABLE {staging_table}"))
+    if map_type == 'connectivity':
+        # Parcelwise .npy copies are not in the decode matrix, so only the cached results are dropped
+        _invalidate_decode_caches_after_commit(session)
+
+    if commit:
+        session.commit()
+    print(f"Added {len(values)} values to the {target} table for file {new_file.id}.")
+    return new_file
+
 def data_to_parcelwise_values_table(voxelwise_map, parcellation, map_type, session, strategy='mean', voxelwise_map_name=None):
     """
     Converts a parcelwise data array from apply_parcellation to a dataframe.
     Inserts into: parcelwise_connectivity_values, parcelwise_roi_values, or group_level_map_arrays table in SQL.
+    The new file row and its values are written in one transaction (see insert_parcelwise_file).
     """
     print("Inserting data into the database...")
     try:
+        if map_type not in PARCELWISE_TABLES:
+            raise ValueError("map_type must be 'connectivity', 'roi', or 'group_level_map'.")
+        _, file_table = PARCELWISE_TABLES[map_type]
         if voxelwise_map_name is None:
             voxelwise_map_name = voxelwise_map
+
+        file_in_db = session.query(file_table).filter(file_table.path == voxelwise_map_name).first()
+        if not file_in_db:
+            raise ValueError(f"No {file_table.__name__} found with path '{voxelwise_map_name}'.")
+
         # Apply parcellation and get parcel IDs
         parcelwise_array, region_ids = apply_parcellation(voxelwise_map, parcellation, strategy=strategy, return_region_ids=True)
-        parcel_ids = np.array([get_parcel_id(get_parcellation_id(parcellation.name, session), numpy_to_python_type(value), session) for value in region_ids])
-        parcel_ids_values = np.column_stack((parcel_ids, parcelwise_array.ravel()))
 
         original_file_id = re.search(r"_file-(\d+)_", voxelwise_map_name).group(1) if re.search(r"_file-(\d+)_", voxelwise_map_name) else None
         new_file_id = int(original_file_id) + 1 if original_file_id else 1
@@ -589,76 +879,11 @@ def data_to_parcelwise_values_table(voxelwise_map, parcellation, map_type, sessi
             parcelwise_map_filepath = parcelwise_map_filepath.replace(f'_file-{original_file_id}', f'_file-{new_file_id}')
         save_to_s3(parcelwise_array.astype(np.float32), parcelwise_map_filepath)
 
-        # Determine the appropriate table and file table based on map_type
-        if map_type == 'connectivity':
-            table = ParcelwiseConnectivityValue
-            file_table = ConnectivityFile
-        elif map_type == 'roi':
-            table = ParcelwiseROIValue
-            file_table = ROIFile
-        elif map_type == 'group_level_map':
-            table = ParcelwiseGroupLevelMapValue
-            file_table = GroupLevelMapFile
-        else:
-            raise ValueError("map_type must be 'connectivity', 'roi', or 'group_level_map'.")
-
-        file_in_db = session.query(file_table).filter(file_table.path == voxelwise_map_name).first()
-        print(file_table, voxelwise_map_name)
-
-        if not file_in_db:
-            raise ValueError(f"No {file_table.__name__} found with path '{voxelwise_map_name}'.")
-
-        print(file_in_db.id)  # Now, this should not raise an error if file_in_db exists
-
-        default_user_id = get_user_id(session)
-        parcellation_id = get_parcellation_id(parcellation.name, session)
-        file_data = file_in_db.__dict__.copy()
-        file_data.pop('_sa_instance_state', None)
-        file_data.pop('id', None)
-        file_data.pop('insert_date', None)
-        file_data.update({
-            'path': parcelwise_map_filepath,
-            'md5': md5_hash(parcelwise_array),
-            'parcellation_id': parcellation_id,
-            'filetype': 'npy',
-            'user_id': default_user_id,
-        })
-        new_file = file_table(**file_data)
-        session.add(new_file)
-        session.flush()
-
-        # Prepare records for insertion
-        records = [
-            {
-                f'{map_type}_file_id': new_file.id,
-                'parcel_id': numpy_to_python_type(row[0]),
-                'value': numpy_to_python_type(row[1]),
-                'user_id': default_user_id  # Set the default user_id
-            }
-            for row in parcel_ids_values
-        ]
-
-        # Check for existing records
-        existing_records = set(
-            (r.parcel_id, r.value) for r in session.query(
-                table.parcel_id, table.value
-            ).filter_by(**{f'{map_type}_file_id': new_file.id}).all()
+        insert_parcelwise_file(
+            file_in_db, map_type, parcelwise_array, region_ids,
+            get_parcellation_id(parcellation.name, session), parcelwise_map_filepath, session,
         )
 
-        # Filter new records to insert
-        new_records = [record for record in records if (record['parcel_id'], record['value']) not in existing_records]
-
-        # Optional: Filter out where the value is 0
-        new_records = [record for record in new_records if record['value'] != 0]
-
-        # Insert new records if any
-        if new_records:
-            session.bulk_insert_mappings(table, new_records)
-            session.commit()
-            print(f"Data added to the {map_type}_arrays table in the database.")
-        else:
-            print("No new records to add")
-
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         session.rollback()
@@ -760,6 +985,7 @@ def delete_dependent_arrays_and_return_data(parcellation_id: int, session: _Sess
         session.query(ParcelwiseGroupLevelMapValue).filter(ParcelwiseGroupLevelMapValue.id.in_([g.id for g in group_level_map_arrays])).delete(synchronize_session=False)
         
         session.commit()
+        invalidate_parcel_lookups()
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         session.rollback()
@@ -835,10 +1061,18 @@ def parcellation_to_parcels_table(parcellation: Bunch, session: _Session, overri
         ]
 
         if override_existing:
+            old_parcels = session.query(Parcel.id, Parcel.value).filter_by(parcellation_id=parcellation_id).all()
             dependent_data = delete_dependent_arrays_and_return_data(parcellation_id, session)
             session.query(Parcel).filter_by(parcellation_id=parcellation_id).delete(synchronize_session=False)
             session.bulk_insert_mappings(Parcel, all_records)
+            # Packed arrays hold values by parcel position, so move them onto the new parcels
+            repack_parcelwise_arrays(
+                parcellation_id, [p.id for p in old_parcels], [p.value for p in old_parcels], session
+            )
             reinsert_dependent_arrays(dependent_data, session)
+            # Index rows of the old parcels were deleted with them
+            for map_type in SUBJECT_MAP_TYPES:
+                rebuild_parcel_subject_index(map_type, session)
         else:
             existing_parcels = set(
                 (p.parcellation_id, p.value) for p in session.query(Parcel.parcellation_id, Parcel.value)
@@ -858,6 +1092,8 @@ def parcellation_to_parcels_table(parcellation: Bunch, session: _Session, overri
         session.rollback()
     finally:
         session.close()
+        # Parcels may have changed even on error (reinsert_dependent_arrays commits on its own)
+        invalidate_parcel_lookups()
 
 """
 Functions to pre-populate certain tables with data from JSON files.
@@ -1380,19 +1616,6 @@ def insert_domains_from_json(json_file_path: str, db_session: _Session, override
         db_session.close()
 
 
-# Function to get S3 client
-def get_s3_client():
-    session = boto3.session.Session()
-    client = session.client('s3',
-        config=Config(s3={'addressing_style': 'virtual'}),
-        region_name=DO_SPACES_LOCATION,
-        endpoint_url=DO_S3_ENDPOINT_URL,
-        aws_access_key_id=DO_ACCESS_KEY_ID,
-        aws_secret_access_key=DO_SECRET_ACCESS_KEY,
-    )
-    return client
-
-
 # Function to upload file to S3
 def upload_to_s3(file_path, s3_key):
     s3_client = get_s3_client()
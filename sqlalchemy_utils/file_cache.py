@@ -0,0 +1,194 @@
+# file_cache.py
+
+"""
+Content-addressed disk cache for NIfTI and .npy objects fetched from DigitalOcean Spaces.
+
+Entries are keyed by object path plus a content version (ConnectivityFile.md5 or the
+S3 ETag), so a replaced object never serves stale data. Images are stored decompressed
+as .npy arrays that are memory-mapped on read, with the original NIfTI header in a
+sidecar file:
+
+    <key>.npy    voxel data (or the original array for .npy objects)
+    <key>.hdr    raw NIfTI header, only for NIfTI objects
+
+Writes go to a temporary file and are renamed into place, so concurrent Celery worker
+processes never see a partial entry. The cache is bounded by FILE_CACHE_MAX_BYTES and
+evicts the least recently used entries first.
+"""
+
+import fcntl
+import hashlib
+import os
+import threading
+from io import BytesIO
+from pathlib import Path
+
+import environ
+import nibabel as nib
+import numpy as np
+
+# Initialize environ
+env = environ.Env()
+
+# Build paths inside the project like this: BASE_DIR / 'subdir'.
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Read .env file
+environ.Env.read_env(str(BASE_DIR / '.env'))
+
+FILE_CACHE_ENABLED = env.bool('FILE_CACHE_ENABLED', default=True)
+FILE_CACHE_DIR = env(
+    'FILE_CACHE_DIR',
+    default=os.path.join(env('LOCAL_DATA_DIR', default=str(BASE_DIR / 'local_data')), 'file_cache'),
+)
+FILE_CACHE_MAX_BYTES = env.int('FILE_CACHE_MAX_BYTES', default=20 * 1024 ** 3)
+# Evict down to this fraction of the limit so eviction does not run on every write
+FILE_CACHE_EVICT_TO = 0.9
+# Bytes this process may add before it rescans the cache for eviction
+FILE_CACHE_EVICT_CHECK_BYTES = FILE_CACHE_MAX_BYTES * 0.05
+
+_bytes_since_eviction_check = 0
+_eviction_lock = threading.Lock()
+
+
+def file_cache_key(filepath: str, version: str) -> str:
+    """Cache key for one version of an object."""
+    return hashlib.sha256(f"{filepath}\0{version}".encode()).hexdigest()
+
+
+def _entry_paths(key: str):
+    # Two-level fan-out keeps directories small on large caches
+    directory = os.path.join(FILE_CACHE_DIR, key[:2])
+    return os.path.join(directory, f'{key}.npy'), os.path.join(directory, f'{key}.hdr')
+
+
+def _write_atomic(path: str, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique per thread too: fetch_many_from_s3 writes entries from a thread pool
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_cached_file(filepath: str, version: str):
+    """
+    Load an object from the cache.
+
+    Returns:
+        nib.Nifti1Image, np.ndarray or None: The cached object, backed by a read-only
+        memmap, or None on a cache miss.
+    """
+    npy_path, hdr_path = _entry_paths(file_cache_key(filepath, version))
+    try:
+        data = np.load(npy_path, mmap_mode='r')
+        # Mark as recently used for LRU eviction
+        os.utime(npy_path)
+        if not filepath.lower().endswith(('.nii', '.nii.gz')):
+            return data
+        # A NIfTI entry without its header was evicted while being read: a miss, not a bare array
+        with open(hdr_path, 'rb') as f:
+            header = nib.Nifti1Header.from_fileobj(BytesIO(f.read()))
+    except (FileNotFoundError, ValueError):
+        # Missing, evicted mid-read, or an object array that cannot be memory-mapped
+        return None
+    return nib.Nifti1Image(data, header.get_best_affine(), header=header)
+
+
+def put_cached_file(filepath: str, version: str, obj):
+    """
+    Store a NIfTI image or array in the cache.
+
+    Returns:
+        The object as it will be read back from the cache (memory-mapped), or obj
+        unchanged if it cannot be cached.
+    """
+    key = file_cache_key(filepath, version)
+    npy_path, hdr_path = _entry_paths(key)
+
+    if isinstance(obj, nib.Nifti1Image):
+        # Apply any scl_slope/scl_inter once so the cached array is used as-is
+        data = np.asanyarray(obj.dataobj)
+        header = obj.header.copy()
+        header.set_data_dtype(data.dtype)
+        header.set_slope_inter(None, None)
+        _write_atomic(hdr_path, lambda f: f.write(header.binaryblock))
+    elif isinstance(obj, np.ndarray) and obj.dtype != object:
+        data = obj
+    else:
+        return obj
+
+    # The .npy is written last: its presence marks a complete entry
+    _write_atomic(npy_path, lambda f: np.save(f, data, allow_pickle=False))
+
+    global _bytes_since_eviction_check
+    with _eviction_lock:
+        _bytes_since_eviction_check += data.nbytes
+        evict = _bytes_since_eviction_check >= FILE_CACHE_EVICT_CHECK_BYTES
+        if evict:
+            _bytes_since_eviction_check = 0
+    if evict:
+        evict_file_cache()
+
+    cached = get_cached_file(filepath, version)
+    return obj if cached is None else cached
+
+
+def file_cache_entries() -> list:
+    """
+    List cache entries as (last_used, size_in_bytes, npy_path), oldest first.
+    """
+    entries = []
+    if not os.path.isdir(FILE_CACHE_DIR):
+        return entries
+    for directory in os.scandir(FILE_CACHE_DIR):
+        if not directory.is_dir():
+            continue
+        for entry in os.scandir(directory.path):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            hdr_path = entry.path[:-len('.npy')] + '.hdr'
+            size = stat.st_size + (os.path.getsize(hdr_path) if os.path.exists(hdr_path) else 0)
+            entries.append((stat.st_mtime, size, entry.path))
+    entries.sort()
+    return entries
+
+
+def evict_file_cache(max_bytes: int = None):
+    """
+    Remove least recently used entries until the cache fits in max_bytes.
+
+    Only one process evicts at a time; others skip eviction rather than wait.
+    """
+    max_bytes = FILE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    os.makedirs(FILE_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(FILE_CACHE_DIR, '.evict.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        entries = file_cache_entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= max_bytes:
+            return
+
+        target = max_bytes * FILE_CACHE_EVICT_TO
+        for _, size, npy_path in entries:
+            if total <= target:
+                break
+            # Unlinking is safe for readers that already memory-mapped the entry
+            for path in (npy_path, npy_path[:-len('.npy')] + '.hdr'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
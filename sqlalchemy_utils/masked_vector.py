@@ -0,0 +1,190 @@
+# masked_vector.py
+
+"""
+Compact binary format for a single map restricted to the 2mm MNI152 mask.
+
+The decode path only uses the in-mask voxels, so a full 91x109x91 float64 volume
+(~7 MB) is reduced to the in-mask values in mask order as float32 or float16,
+optionally compressed:
+
+    offset  size  field
+    0       4     magic b'LBMV'
+    4       1     format version (1)
+    5       1     dtype code (1 = float32, 2 = float16)
+    6       1     codec code (0 = none, 1 = zlib, 2 = zstd)
+    7       1     reserved
+    8       8     mask version: first 8 bytes of sha256 of the mask's flat voxel indices
+    16      4     number of values (uint32, little-endian)
+    20      ...   values, little-endian, compressed with the codec
+
+The mask version guards against decoding a vector against a different mask than the
+one it was encoded with. zstd is used when the `zstandard` package is installed,
+zlib otherwise.
+"""
+
+import hashlib
+import struct
+import zlib
+
+import nibabel as nib
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from sqlalchemy_utils.db_utils import get_2mm_mni152_masker, mask_2mm_mni152, unmask_2mm_mni152
+
+MASKED_VECTOR_MAGIC = b'LBMV'
+MASKED_VECTOR_FORMAT_VERSION = 1
+MASKED_VECTOR_EXTENSION = '.lbmv'
+
+_HEADER = struct.Struct('<4sBBBx8sI')
+_DTYPES = {1: np.dtype('<f4'), 2: np.dtype('<f2')}
+_DTYPE_CODES = {'float32': 1, 'float16': 2}
+_CODECS = {'none': 0, 'zlib': 1, 'zstd': 2}
+
+_mask_version = None
+
+
+def get_mask_version() -> bytes:
+    """Identifier of the 2mm MNI152 mask in use, stored in every encoded vector."""
+    global _mask_version
+    if _mask_version is None:
+        flat_indices = np.ascontiguousarray(get_2mm_mni152_masker().flat_indices, dtype='<i8')
+        _mask_version = hashlib.sha256(flat_indices.tobytes()).digest()[:8]
+    return _mask_version
+
+
+def default_codec() -> str:
+    return 'zstd' if zstandard is not None else 'zlib'
+
+
+def is_masked_vector(data) -> bool:
+    """True if data (bytes) starts with the masked vector magic."""
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:4]) == MASKED_VECTOR_MAGIC
+
+
+def encode_masked_vector(values, dtype: str = 'float32', codec: str = None) -> bytes:
+    """
+    Encode the in-mask values of one map.
+
+    Args:
+        values (array-like): The n_mask_voxels values in mask order, e.g. from mask_2mm_mni152.
+        dtype (str): 'float32', or 'float16' for half the size at ~3 significant digits.
+        codec (str): 'none', 'zlib' or 'zstd'. Defaults to zstd if available, else zlib.
+
+    Returns:
+        bytes: The encoded vector.
+    """
+    if dtype not in _DTYPE_CODES:
+        raise ValueError(f"dtype must be one of: {', '.join(_DTYPE_CODES)}")
+    codec = codec or default_codec()
+    if codec not in _CODECS:
+        raise ValueError(f"codec must be one of: {', '.join(_CODECS)}")
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError("The zstd codec requires the zstandard package.")
+
+    values = np.ravel(values)
+    n_mask_voxels = len(get_2mm_mni152_masker().flat_indices)
+    if values.size != n_mask_voxels:
+        raise ValueError(f"Expected {n_mask_voxels} in-mask values, got {values.size}.")
+
+    out_dtype = _DTYPES[_DTYPE_CODES[dtype]]
+    if out_dtype == np.float16 and np.nanmax(np.abs(values), initial=0) > np.finfo(np.float16).max:
+        raise ValueError("Values are out of range for float16; use float32.")
+    payload = np.ascontiguousarray(values, dtype=out_dtype).tobytes()
+
+    if codec == 'zlib':
+        payload = zlib.compress(payload, 6)
+    elif codec == 'zstd':
+        payload = zstandard.ZstdCompressor(level=3).compress(payload)
+
+    header = _HEADER.pack(
+        MASKED_VECTOR_MAGIC, MASKED_VECTOR_FORMAT_VERSION, _DTYPE_CODES[dtype], _CODECS[codec],
+        get_mask_version(), values.size,
+    )
+    return header + payload
+
+
+def decode_masked_vector(data) -> np.ndarray:
+    """
+    Decode bytes produced by encode_masked_vector.
+
+    Returns:
+        np.ndarray: float32 array of shape (n_mask_voxels,).
+    """
+    data = bytes(data)
+    if len(data) < _HEADER.size:
+        raise ValueError("Masked vector is truncated.")
+    magic, version, dtype_code, codec_code, mask_version, n_values = _HEADER.unpack_from(data)
+    if magic != MASKED_VECTOR_MAGIC:
+        raise ValueError("Not a masked vector.")
+    if version != MASKED_VECTOR_FORMAT_VERSION:
+        raise ValueError(f"Unsupported masked vector format version: {version}")
+    if dtype_code not in _DTYPES or codec_code not in _CODECS.values():
+        raise ValueError("Masked vector has an unknown dtype or codec.")
+    if mask_version != get_mask_version():
+        raise ValueError("Masked vector was encoded with a different brain mask.")
+    n_mask_voxels = len(get_2mm_mni152_masker().flat_indices)
+    if n_values != n_mask_voxels:
+        raise ValueError(f"Masked vector holds {n_values} values, expected {n_mask_voxels}.")
+
+    dtype = _DTYPES[dtype_code]
+    expected_size = n_values * dtype.itemsize
+    payload = memoryview(data)[_HEADER.size:]
+    if codec_code == _CODECS['zstd'] and zstandard is None:
+        raise ValueError("Decoding this masked vector requires the zstandard package.")
+    # Uploaded vectors are untrusted: never decompress more than the header says to expect
+    try:
+        if codec_code == _CODECS['zlib']:
+            payload = _decompress_zlib_bounded(payload, expected_size)
+        elif codec_code == _CODECS['zstd']:
+            payload = _decompress_zstd_bounded(payload, expected_size)
+    except Exception as e:
+        raise ValueError(f"Masked vector payload is corrupt: {e}")
+
+    if len(payload) != expected_size:
+        raise ValueError("Masked vector payload does not match its length.")
+    return np.frombuffer(payload, dtype=dtype).astype(np.float32)
+
+
+def _decompress_zlib_bounded(payload, max_size: int) -> bytes:
+    """zlib-decompress at most max_size bytes, rejecting streams that decompress to more or carry trailing data."""
+    decompressor = zlib.decompressobj()
+    output = decompressor.decompress(payload, max_size)
+    if not decompressor.eof:
+        # Either truncated, or more output is waiting past max_size
+        if decompressor.decompress(decompressor.unconsumed_tail, 1) or not decompressor.eof:
+            raise ValueError(f"stream is truncated or larger than {max_size} bytes")
+    if decompressor.unused_data or decompressor.unconsumed_tail:
+        raise ValueError("trailing data after the compressed stream")
+    return output
+
+
+def _decompress_zstd_bounded(payload, max_size: int) -> bytes:
+    """zstd-decompress one frame of at most max_size bytes, rejecting larger frames or trailing data."""
+    content_size = zstandard.frame_content_size(payload)
+    if content_size not in (-1, max_size):
+        raise ValueError(f"frame holds {content_size} bytes, expected {max_size}")
+    # decompress() bounds the output but ignores anything after the first frame...
+    zstandard.ZstdDecompressor().decompress(payload, max_output_size=max_size)
+    # ...so, now that the frame is known to be small, decompress it again to see where it ends
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    output = decompressor.decompress(payload)
+    if not decompressor.eof:
+        raise ValueError("stream is truncated")
+    if decompressor.unused_data:
+        raise ValueError("trailing data after the compressed stream")
+    return output
+
+
+def encode_masked_image(img: nib.Nifti1Image, dtype: str = 'float32', codec: str = None) -> bytes:
+    """Mask a 3D image with the 2mm MNI152 mask and encode it."""
+    return encode_masked_vector(mask_2mm_mni152(img)[0], dtype=dtype, codec=codec)
+
+
+def decode_masked_image(data) -> nib.Nifti1Image:
+    """Decode a masked vector back to a float32 image on the 2mm MNI152 grid (zero outside the mask)."""
+    return unmask_2mm_mni152(decode_masked_vector(data))
@@ -0,0 +1,164 @@
+# migrations.py
+
+"""
+Schema migrations for databases created from models_sqlalchemy_orm.
+
+Base.metadata.create_all only creates missing tables, so indexes and constraints added to
+the models later are delivered here for existing databases. Each migration is a list of
+SQL statements, applied once and recorded in the schema_migrations table. Statements
+that cannot run in a transaction (CREATE INDEX CONCURRENTLY, which does not block writes)
+are run with autocommit and must be idempotent, since a failure can leave them half applied.
+
+Usage (from the repository root):
+    python -m sqlalchemy_utils.migrations           # apply pending migrations
+    python -m sqlalchemy_utils.migrations --list    # show applied and pending migrations
+"""
+
+import argparse
+import time
+
+from sqlalchemy import text
+
+from sqlalchemy_utils.db_session import get_engine
+
+
+def drop_invalid_index(name: str) -> str:
+    """
+    SQL dropping index name if an interrupted CREATE INDEX CONCURRENTLY left it invalid,
+    since an invalid index would still satisfy IF NOT EXISTS.
+    """
+    return f"""
+        DO $$ BEGIN
+            IF EXISTS (
+                SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+                WHERE pg_class.relname = '{name}' AND NOT pg_index.indisvalid
+            ) THEN
+                DROP INDEX {name};
+            END IF;
+        END $$
+    """
+
+
+def create_parcelwise_array_table(map_type: str) -> str:
+    """SQL creating the packed parcelwise_{map_type}_arrays table (see ParcelwiseConnectivityArray)."""
+    return f"""
+        CREATE TABLE IF NOT EXISTS parcelwise_{map_type}_arrays (
+            id SERIAL PRIMARY KEY,
+            packed_values REAL[] NOT NULL,
+            {map_type}_file_id INTEGER NOT NULL UNIQUE REFERENCES {map_type}_files (id) ON DELETE CASCADE,
+            parcellation_id INTEGER NOT NULL REFERENCES parcellations (id),
+            user_id INTEGER NOT NULL REFERENCES accounts_customuser (id),
+            insert_date TIMESTAMP NOT NULL DEFAULT now()
+        )
+    """
+
+
+MIGRATIONS = [
+    {
+        'name': '0001_voxelwise_values_xyz_index',
+        'transaction': False,
+        'statements': [
+            drop_invalid_index('ix_voxelwise_values_mni152_xyz'),
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_voxelwise_values_mni152_xyz "
+            "ON voxelwise_values (mni152_x, mni152_y, mni152_z) INCLUDE (parcel_id)",
+            "ANALYZE voxelwise_values",
+        ],
+    },
+    {
+        'name': '0002_voxelwise_values_unique_voxel',
+        'transaction': False,
+        'statements': [
+            # Keep the first row of any duplicated voxel so the unique index can be built
+            "DELETE FROM voxelwise_values duplicate USING voxelwise_values original "
+            "WHERE duplicate.id > original.id AND duplicate.parcel_id = original.parcel_id "
+            "AND duplicate.mni152_x = original.mni152_x AND duplicate.mni152_y = original.mni152_y "
+            "AND duplicate.mni152_z = original.mni152_z",
+            drop_invalid_index('uq_voxelwise_values_parcel_xyz'),
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_voxelwise_values_parcel_xyz "
+            "ON voxelwise_values (parcel_id, mni152_x, mni152_y, mni152_z)",
+        ],
+    },
+    {
+        'name': '0003_parcelwise_arrays',
+        'transaction': True,
+        'statements': [
+            create_parcelwise_array_table('connectivity'),
+            create_parcelwise_array_table('roi'),
+            create_parcelwise_array_table('group_level_map'),
+            """
+            CREATE TABLE IF NOT EXISTS parcel_subject_index (
+                map_type VARCHAR NOT NULL,
+                subject_ids INTEGER[] NOT NULL,
+                max_values REAL[] NOT NULL,
+                parcel_id INTEGER NOT NULL REFERENCES parcels (id) ON DELETE CASCADE,
+                insert_date TIMESTAMP NOT NULL DEFAULT now(),
+                PRIMARY KEY (map_type, parcel_id)
+            )
+            """,
+        ],
+    },
+]
+
+
+def _ensure_migrations_table(engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "name VARCHAR PRIMARY KEY, applied_at TIMESTAMP NOT NULL DEFAULT now())"
+        ))
+
+
+def get_applied_migrations(engine=None) -> set:
+    """Names of the migrations already applied."""
+    engine = engine or get_engine()
+    _ensure_migrations_table(engine)
+    with engine.connect() as connection:
+        return {row[0] for row in connection.execute(text("SELECT name FROM schema_migrations"))}
+
+
+def apply_migrations(engine=None) -> list:
+    """
+    Apply every pending migration in order.
+
+    Returns:
+        list: Names of the migrations applied.
+    """
+    engine = engine or get_engine()
+    applied = get_applied_migrations(engine)
+    newly_applied = []
+    for migration in MIGRATIONS:
+        if migration['name'] in applied:
+            continue
+        start = time.time()
+        record = text("INSERT INTO schema_migrations (name) VALUES (:name)")
+        if migration['transaction']:
+            with engine.begin() as connection:
+                for statement in migration['statements']:
+                    connection.execute(text(statement))
+                connection.execute(record, {'name': migration['name']})
+        else:
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                for statement in migration['statements']:
+                    connection.execute(text(statement))
+                connection.execute(record, {'name': migration['name']})
+        newly_applied.append(migration['name'])
+        print(f"Applied migration {migration['name']} in {time.time() - start:.1f}s.")
+    return newly_applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--list', action='store_true', help="List migrations instead of applying them.")
+    args = parser.parse_args()
+
+    if args.list:
+        applied = get_applied_migrations()
+        for migration in MIGRATIONS:
+            print(f"[{'x' if migration['name'] in applied else ' '}] {migration['name']}")
+        return
+    if not apply_migrations():
+        print("No pending migrations.")
+
+
+if __name__ == '__main__':
+    main()
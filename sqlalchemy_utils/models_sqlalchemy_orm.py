@@ -1,8 +1,9 @@
 from sqlalchemy import Integer, String, Float, Boolean, ForeignKey, func, DateTime
 from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship, declared_attr
+from sqlalchemy.dialects.postgresql import ARRAY, REAL
 from typing import List, Optional, Union
 from datetime import datetime
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import Index, UniqueConstraint
 from sqlalchemy.orm import validates
 from sqlalchemy.exc import IntegrityError
 
@@ -106,6 +107,8 @@ Tables in this section:
 - parcelwise_connectivity_values: Each row represents the parcel value of a parcellated connectivity map. Associated with a parcel in a parcellation, and a connectivity file.
 - parcelwise_group_level_map_values: Each row represents the parcel value of a parcellated group level map. Associated with a parcel in a parcellation, and a group level map file.
 - parcelwise_roi_values: Each row represents the parcel value of a parcellated ROI map. Associated with a parcel in a parcellation, and an ROI file.
+- parcelwise_connectivity_arrays, parcelwise_roi_arrays, parcelwise_group_level_map_arrays: Each row holds every parcel value of one parcellated file, packed into one array (see sqlalchemy_utils.parcelwise_arrays). Associated with a file and a parcellation.
+- parcel_subject_index: Each row holds the subjects with a nonzero value in one parcel, and their maximum value, for one map type. Associated with a parcel.
 - connectivity_files: Each row represents a connectivity file. Associated with a subject, connectome, and parcellation.
 - roi_files: Each row represents an ROI file. Associated with a subject, and parcellation.
 - group_level_map_files: Each row represents a group level map file. Associated with a research paper, and parcellation.
@@ -160,6 +163,13 @@ class VoxelwiseValue(Base):
     # Relationships
     parcel: Mapped["Parcel"] = relationship('Parcel', back_populates='voxelwise_values')
 
+    # Coordinate lookups (get_labels_at_xyz, get_files_at_xyz) and the conflict target of
+    # data_to_voxelwise_values_table; existing databases get them from sqlalchemy_utils.migrations
+    __table_args__ = (
+        Index('ix_voxelwise_values_mni152_xyz', 'mni152_x', 'mni152_y', 'mni152_z', postgresql_include=['parcel_id']),
+        Index('uq_voxelwise_values_parcel_xyz', 'parcel_id', 'mni152_x', 'mni152_y', 'mni152_z', unique=True),
+    )
+
 class Parcel(Base):
     __tablename__ = 'parcels'
     
@@ -239,6 +249,67 @@ class ParcelwiseROIValue(Base):
     parcel: Mapped["Parcel"] = relationship('Parcel', back_populates='parcelwise_roi_values')
     roi_file: Mapped["ROIFile"] = relationship('ROIFile', back_populates='parcelwise_roi_values')
 
+# Packed storage (PARCELWISE_STORAGE=arrays): packed_values[i] is the value of the i-th parcel of the
+# parcellation, parcels ordered by id, with zeros kept so positions line up
+class ParcelwiseConnectivityArray(Base):
+    __tablename__ = 'parcelwise_connectivity_arrays'
+
+    # Properties
+    id: Mapped[int] = mapped_column(primary_key=True)
+    packed_values: Mapped[List[float]] = mapped_column(ARRAY(REAL), nullable=False)
+
+    # Foreign keys
+    connectivity_file_id: Mapped[int] = mapped_column(ForeignKey('connectivity_files.id', ondelete='CASCADE'), unique=True)
+    parcellation_id: Mapped[int] = mapped_column(ForeignKey('parcellations.id'))
+
+    # Relationships
+    connectivity_file: Mapped["ConnectivityFile"] = relationship('ConnectivityFile', back_populates='parcelwise_connectivity_array')
+    parcellation: Mapped["Parcellation"] = relationship('Parcellation')
+
+class ParcelwiseGroupLevelMapArray(Base):
+    __tablename__ = 'parcelwise_group_level_map_arrays'
+
+    # Properties
+    id: Mapped[int] = mapped_column(primary_key=True)
+    packed_values: Mapped[List[float]] = mapped_column(ARRAY(REAL), nullable=False)
+
+    # Foreign keys
+    group_level_map_file_id: Mapped[int] = mapped_column(ForeignKey('group_level_map_files.id', ondelete='CASCADE'), unique=True)
+    parcellation_id: Mapped[int] = mapped_column(ForeignKey('parcellations.id'))
+
+    # Relationships
+    group_level_map_file: Mapped["GroupLevelMapFile"] = relationship('GroupLevelMapFile', back_populates='parcelwise_group_level_map_array')
+    parcellation: Mapped["Parcellation"] = relationship('Parcellation')
+
+class ParcelwiseROIArray(Base):
+    __tablename__ = 'parcelwise_roi_arrays'
+
+    # Properties
+    id: Mapped[int] = mapped_column(primary_key=True)
+    packed_values: Mapped[List[float]] = mapped_column(ARRAY(REAL), nullable=False)
+
+    # Foreign keys
+    roi_file_id: Mapped[int] = mapped_column(ForeignKey('roi_files.id', ondelete='CASCADE'), unique=True)
+    parcellation_id: Mapped[int] = mapped_column(ForeignKey('parcellations.id'))
+
+    # Relationships
+    roi_file: Mapped["ROIFile"] = relationship('ROIFile', back_populates='parcelwise_roi_array')
+    parcellation: Mapped["Parcellation"] = relationship('Parcellation')
+
+class ParcelSubjectIndex(BaseNoUser):
+    __tablename__ = 'parcel_subject_index'
+
+    # Properties; subject_ids is sorted and max_values[i] belongs to subject_ids[i]
+    map_type: Mapped[str] = mapped_column(String, primary_key=True)
+    subject_ids: Mapped[List[int]] = mapped_column(ARRAY(Integer), nullable=False)
+    max_values: Mapped[List[float]] = mapped_column(ARRAY(REAL), nullable=False)
+
+    # Foreign keys
+    parcel_id: Mapped[int] = mapped_column(ForeignKey('parcels.id', ondelete='CASCADE'), primary_key=True)
+
+    # Relationships
+    parcel: Mapped["Parcel"] = relationship('Parcel')
+
 class StatisticType(Base):
     __tablename__ = 'statistic_types'
 
@@ -276,6 +347,7 @@ class ConnectivityFile(Base):
     parcellation: Mapped["Parcellation"] = relationship('Parcellation', back_populates='connectivity_files')
     subject: Mapped["Subject"] = relationship('Subject', back_populates='connectivity_files')
     parcelwise_connectivity_values: Mapped[List["ParcelwiseConnectivityValue"]] = relationship('ParcelwiseConnectivityValue', back_populates='connectivity_file')
+    parcelwise_connectivity_array: Mapped[Optional["ParcelwiseConnectivityArray"]] = relationship('ParcelwiseConnectivityArray', back_populates='connectivity_file', uselist=False, passive_deletes=True)
     statistic_type: Mapped["StatisticType"] = relationship('StatisticType', back_populates='connectivity_files')
     coordinate_space: Mapped["CoordinateSpace"] = relationship('CoordinateSpace', back_populates='connectivity_files')
 
@@ -299,6 +371,7 @@ class ROIFile(Base):
     # Relationships
     parcellation: Mapped["Parcellation"] = relationship('Parcellation', back_populates='roi_files')
     parcelwise_roi_values: Mapped[List["ParcelwiseROIValue"]] = relationship('ParcelwiseROIValue', back_populates='roi_file')
+    parcelwise_roi_array: Mapped[Optional["ParcelwiseROIArray"]] = relationship('ParcelwiseROIArray', back_populates='roi_file', uselist=False, passive_deletes=True)
     subject: Mapped["Subject"] = relationship('Subject', back_populates='roi_files')
     dimension: Mapped["Dimension"] = relationship('Dimension', back_populates='roi_files')
     coordinate_space: Mapped["CoordinateSpace"] = relationship('CoordinateSpace', back_populates='roi_files')
@@ -355,6 +428,7 @@ class GroupLevelMapFile(Base):
     # Relationships
     parcellation: Mapped["Parcellation"] = relationship('Parcellation', back_populates='group_level_map_files')
     parcelwise_group_level_map_values: Mapped[List["ParcelwiseGroupLevelMapValue"]] = relationship('ParcelwiseGroupLevelMapValue', back_populates='group_level_map_file')
+    parcelwise_group_level_map_array: Mapped[Optional["ParcelwiseGroupLevelMapArray"]] = relationship('ParcelwiseGroupLevelMapArray', back_populates='group_level_map_file', uselist=False, passive_deletes=True)
     research_paper: Mapped["ResearchPaper"] = relationship('ResearchPaper', back_populates='group_level_map_files')
     statistic_type: Mapped["StatisticType"] = relationship('StatisticType', back_populates='group_level_map_files')
     coordinate_space: Mapped["CoordinateSpace"] = relationship('CoordinateSpace', back_populates='group_level_map_files')
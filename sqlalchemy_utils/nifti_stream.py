@@ -0,0 +1,107 @@
+# nifti_stream.py
+
+"""
+Streaming NIfTI-1 reader and writer.
+
+read_nifti_stream decompresses a (possibly gzipped) NIfTI byte stream, such as an S3
+response body, straight into a preallocated array, so the compressed and decompressed
+file never exist as whole in-memory copies. write_nifti_gz_stream does the reverse,
+gzipping an image in chunks into any writable file object.
+"""
+
+import gzip
+
+import nibabel as nib
+import numpy as np
+
+# Chunk size for reads and compressed writes
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class _CountingReader:
+    """Wraps a readable stream and counts the bytes consumed from it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        if hasattr(self.fileobj, 'readinto'):
+            n = self.fileobj.readinto(buffer)
+        else:
+            data = self.fileobj.read(len(buffer))
+            n = len(data)
+            buffer[:n] = data
+        self.position += n
+        return n
+
+    def tell(self):
+        return self.position
+
+
+def _read_exactly_into(reader, buffer: memoryview):
+    offset = 0
+    while offset < len(buffer):
+        n = reader.readinto(buffer[offset:offset + STREAM_CHUNK_SIZE])
+        if not n:
+            raise ValueError(f"NIfTI stream ended after {offset} of {len(buffer)} data bytes.")
+        offset += n
+
+
+def read_nifti_stream(fileobj, gzipped: bool, dtype=np.float32) -> nib.Nifti1Image:
+    """
+    Read a single-file NIfTI-1 image from a forward-only stream.
+
+    Args:
+        fileobj: Readable binary stream positioned at the start of the file.
+        gzipped (bool): Whether the stream is gzip-compressed (.nii.gz).
+        dtype: Data type of the returned array. scl_slope/scl_inter are applied.
+
+    Returns:
+        nib.Nifti1Image: Image whose data is an in-memory array of the given dtype.
+    """
+    reader = _CountingReader(gzip.GzipFile(fileobj=fileobj, mode='rb') if gzipped else fileobj)
+
+    header = nib.Nifti1Header.from_fileobj(reader)
+    # Skip anything between the header (and extensions) and the voxel data
+    skip = int(header.get_data_offset()) - reader.position
+    if skip > 0:
+        reader.read(skip)
+
+    shape = header.get_data_shape()
+    raw_dtype = header.get_data_dtype()
+    # NIfTI voxel data is stored in Fortran order; read it flat and reshape as a view
+    raw = np.empty(int(np.prod(shape)), dtype=raw_dtype)
+    _read_exactly_into(reader, memoryview(raw.view(np.uint8)))
+    raw = raw.reshape(shape, order='F')
+
+    slope, inter = header.get_slope_inter()
+    slope = 1.0 if slope is None else slope
+    inter = 0.0 if inter is None else inter
+    if raw.dtype == np.dtype(dtype) and slope == 1.0 and inter == 0.0:
+        data = raw
+    else:
+        data = np.empty(shape, dtype=dtype, order='F')
+        np.multiply(raw, slope, out=data, casting='unsafe')
+        if inter:
+            data += inter
+        del raw
+
+    header.set_data_dtype(data.dtype)
+    header.set_slope_inter(None, None)
+    return nib.Nifti1Image(data, header.get_best_affine(), header=header)
+
+
+def write_nifti_gz_stream(nifti_image: nib.Nifti1Image, fileobj, compresslevel: int = 6):
+    """
+    Write an image as .nii.gz into a writable stream, compressing as nibabel writes.
+
+    Only the compressor's internal buffers are held in memory, not the whole file.
+    """
+    with gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=compresslevel) as gz_file:
+        nifti_image.to_file_map({'image': nib.FileHolder(fileobj=gz_file)})
@@ -0,0 +1,361 @@
+# parcelwise_arrays.py
+
+"""
+Packed parcelwise storage: one row per file instead of one row per (file, parcel).
+
+With PARCELWISE_STORAGE=arrays, insert_parcelwise_file stores a parcellated map as one
+parcelwise_*_arrays row. Its packed_values (real[]) hold the value of every parcel of the
+file's parcellation in parcel id order, zeros included, so position i is always the i-th
+parcel; reloading a parcellation's parcels re-packs its arrays (repack_parcelwise_arrays).
+A 3209-parcel connectivity map becomes one ~13 kB row instead of ~3,209 rows,
+each with its own id, user_id, insert_date, tuple header and index entries.
+The default (PARCELWISE_STORAGE=rows) keeps writing the parcelwise_*_values tables, and
+both tables stay readable.
+
+Questions across files ("which subjects have a value in this parcel") are answered from
+parcel_subject_index: one row per (map_type, parcel_id) with the sorted ids of the
+subjects that have a nonzero value in the parcel and the maximum value of each. Every
+insert_parcelwise_file merges into it in the same transaction, whatever the storage.
+Merges cannot remove values, so deleting or reassigning files needs
+rebuild_parcel_subject_index, which recomputes it from both storages (see
+pages/tasks/parcel_subject_index.py); check_parcel_subject_index reports parcels whose
+row differs from a recomputation. Only connectivity and ROI files belong to subjects, so
+group-level maps are not indexed.
+
+Usage (from the repository root), to move existing rows into packed arrays:
+    python -m sqlalchemy_utils.parcelwise_arrays connectivity roi group_level_map
+Run VACUUM FULL (or pg_repack) on the parcelwise_*_values tables afterwards to return
+the space to the operating system.
+"""
+
+import argparse
+import time
+import warnings
+
+import environ
+import numpy as np
+from sqlalchemy import text
+
+from sqlalchemy_utils.db_session import get_session
+from sqlalchemy_utils.models_sqlalchemy_orm import (
+    ConnectivityFile,
+    GroupLevelMapFile,
+    Parcel,
+    ParcelSubjectIndex,
+    ParcelwiseConnectivityArray,
+    ParcelwiseConnectivityValue,
+    ParcelwiseGroupLevelMapArray,
+    ParcelwiseGroupLevelMapValue,
+    ParcelwiseROIArray,
+    ParcelwiseROIValue,
+    ROIFile,
+)
+
+env = environ.Env()
+
+PARCELWISE_STORAGE = env('PARCELWISE_STORAGE', default='rows')
+if PARCELWISE_STORAGE not in ('rows', 'arrays'):
+    raise ValueError(f"PARCELWISE_STORAGE must be 'rows' or 'arrays', not '{PARCELWISE_STORAGE}'.")
+
+# map_type -> (packed array table, per-row values table, file table)
+PARCELWISE_ARRAY_TABLES = {
+    'connectivity': (ParcelwiseConnectivityArray, ParcelwiseConnectivityValue, ConnectivityFile),
+    'roi': (ParcelwiseROIArray, ParcelwiseROIValue, ROIFile),
+    'group_level_map': (ParcelwiseGroupLevelMapArray, ParcelwiseGroupLevelMapValue, GroupLevelMapFile),
+}
+# Map types whose files have a subject_id, and so are kept in parcel_subject_index
+SUBJECT_MAP_TYPES = ('connectivity', 'roi')
+# Files packed per transaction by pack_parcelwise_rows
+PACK_BATCH_FILES = 500
+
+
+def pack_parcelwise_array(parcel_ids, values, parcellation_parcel_ids) -> np.ndarray:
+    """
+    Dense float32 array of values in the order of parcellation_parcel_ids.
+
+    Args:
+        parcel_ids (array): Parcel ids of the values, all in parcellation_parcel_ids.
+        values (array): The values.
+        parcellation_parcel_ids (array): Every parcel id of the parcellation, sorted.
+
+    Returns:
+        np.ndarray: One value per parcel of the parcellation; parcels without a value are 0.
+    """
+    packed = np.zeros(len(parcellation_parcel_ids), dtype=np.float32)
+    packed[np.searchsorted(parcellation_parcel_ids, parcel_ids)] = values
+    return packed
+
+
+def insert_parcelwise_array(session, map_type: str, file_id: int, parcellation_id: int, packed_values, user_id: int):
+    """Add the packed_values row of one file (see pack_parcelwise_array); the caller commits."""
+    ArrayTable = PARCELWISE_ARRAY_TABLES[map_type][0]
+    row = ArrayTable(**{
+        f'{map_type}_file_id': file_id,
+        'parcellation_id': parcellation_id,
+        'packed_values': np.asarray(packed_values, dtype=np.float32).tolist(),
+        'user_id': user_id,
+    })
+    session.add(row)
+    session.flush()
+    return row
+
+
+def repack_parcelwise_arrays(parcellation_id: int, old_parcel_ids, old_parcel_values, session) -> int:
+    """
+    Re-pack the arrays of a parcellation whose parcels were replaced, in the session's transaction.
+
+    Packed values are positional, so after a reload that adds, drops or reorders parcels every
+    value would otherwise land on the wrong parcel. Values are carried over by parcel value
+    (the atlas label) from the old parcels to the new ones; values of dropped parcels are lost.
+
+    Args:
+        parcellation_id (int): The parcellation, whose new parcels must already be inserted.
+        old_parcel_ids (array): Ids of the parcels the arrays were packed against.
+        old_parcel_values (array): Parcel value of each of old_parcel_ids.
+
+    Returns:
+        int: Number of arrays re-packed.
+    """
+    old_parcel_ids = np.asarray(old_parcel_ids, dtype=np.int64)
+    old_parcel_values = np.asarray(old_parcel_values, dtype=np.float64)[np.argsort(old_parcel_ids)]
+    new_parcels = session.query(Parcel.value).filter(Parcel.parcellation_id == parcellation_id).order_by(Parcel.id).all()
+    new_position = {float(value): position for position, (value,) in enumerate(new_parcels)}
+    positions = np.array([new_position.get(float(value), -1) for value in old_parcel_values], dtype=np.int64)
+
+    n_repacked, n_dropped = 0, 0
+    for ArrayTable, _, _ in PARCELWISE_ARRAY_TABLES.values():
+        for row in session.query(ArrayTable).filter(ArrayTable.parcellation_id == parcellation_id).yield_per(500):
+            old_values = np.asarray(row.packed_values, dtype=np.float32)[:len(positions)]
+            kept = positions[:len(old_values)] >= 0
+            packed = np.zeros(len(new_parcels), dtype=np.float32)
+            packed[positions[:len(old_values)][kept]] = old_values[kept]
+            n_dropped += int(np.count_nonzero(old_values[~kept]))
+            row.packed_values = packed.tolist()
+            n_repacked += 1
+    session.flush()
+    if n_dropped:
+        warnings.warn(f"{n_dropped} nonzero packed values belonged to parcels no longer in parcellation {parcellation_id} and were dropped.")
+    return n_repacked
+
+
+def _lock_parcel_subject_index(session, map_type: str):
+    # Serializes writers of one map type until the transaction ends; readers are not blocked
+    session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {'key': f'parcel_subject_index:{map_type}'})
+
+
+def _aggregate_into_index_sql(per_value_sql: str) -> str:
+    """
+    SQL turning (parcel_id, subject_id, value) rows into (parcel_id, subject_ids, max_values) rows
+    of parcel_subject_index, keeping the maximum nonzero value of each subject in each parcel.
+    """
+    return f"""
+        SELECT parcel_id, array_agg(subject_id ORDER BY subject_id) AS subject_ids,
+               array_agg(max_value ORDER BY subject_id) AS max_values
+        FROM (
+            SELECT parcel_id, subject_id, CAST(max(value) AS REAL) AS max_value
+            FROM ({per_value_sql}) per_value
+            WHERE value <> 0
+            GROUP BY parcel_id, subject_id
+        ) per_subject
+        GROUP BY parcel_id
+    """
+
+
+def merge_into_parcel_subject_index(session, map_type: str, subject_id, staging_table: str):
+    """
+    Merge one file's values into parcel_subject_index, in the session's transaction.
+
+    Args:
+        map_type (str): 'connectivity' or 'roi'; other map types are not indexed.
+        subject_id (int): Subject of the file; files without one are not indexed.
+        staging_table (str): Table of the file's (parcel_id, value) rows.
+    """
+    if map_type not in SUBJECT_MAP_TYPES or subject_id is None:
+        return
+    _lock_parcel_subject_index(session, map_type)
+    per_value_sql = f"""
+        SELECT parcel_id, CAST(:subject_id AS INTEGER) AS subject_id, value FROM {staging_table}
+        UNION ALL
+        SELECT entry.parcel_id, indexed.subject_id, indexed.max_value
+        FROM {ParcelSubjectIndex.__tablename__} entry
+        CROSS JOIN LATERAL unnest(entry.subject_ids, entry.max_values) AS indexed(subject_id, max_value)
+        WHERE entry.map_type = :map_type AND entry.parcel_id IN (SELECT parcel_id FROM {staging_table})
+    """
+    session.execute(text(
+        f"INSERT INTO {ParcelSubjectIndex.__tablename__} (map_type, parcel_id, subject_ids, max_values, insert_date) "
+        f"SELECT :map_type, parcel_id, subject_ids, max_values, now() FROM ({_aggregate_into_index_sql(per_value_sql)}) merged "
+        "ON CONFLICT (map_type, parcel_id) DO UPDATE SET "
+        "subject_ids = EXCLUDED.subject_ids, max_values = EXCLUDED.max_values, insert_date = EXCLUDED.insert_date"
+    ), {'map_type': map_type, 'subject_id': int(subject_id)})
+
+
+def parcelwise_source_sql(map_type: str) -> str:
+    """
+    SQL selecting (parcel_id, subject_id, value) for every parcel value of map_type files with a
+    subject, from the per-row values table and the packed arrays (unpacked by parcel position).
+    """
+    ArrayTable, ValueTable, FileTable = PARCELWISE_ARRAY_TABLES[map_type]
+    file_id_column = f'{map_type}_file_id'
+    return f"""
+        SELECT row_value.parcel_id, map_file.subject_id, row_value.value
+        FROM {ValueTable.__tablename__} row_value
+        JOIN {FileTable.__tablename__} map_file ON map_file.id = row_value.{file_id_column}
+        WHERE map_file.subject_id IS NOT NULL
+        UNION ALL
+        SELECT parcel.id, map_file.subject_id, packed.value
+        FROM {ArrayTable.__tablename__} packed_file
+        JOIN {FileTable.__tablename__} map_file ON map_file.id = packed_file.{file_id_column}
+        CROSS JOIN LATERAL unnest(packed_file.packed_values) WITH ORDINALITY AS packed(value, position)
+        JOIN (
+            SELECT id, parcellation_id, row_number() OVER (PARTITION BY parcellation_id ORDER BY id) AS position
+            FROM parcels
+        ) parcel ON parcel.parcellation_id = packed_file.parcellation_id AND parcel.position = packed.position
+        WHERE map_file.subject_id IS NOT NULL
+    """
+
+
+def rebuild_parcel_subject_index(map_type: str, session) -> int:
+    """
+    Recompute the parcel_subject_index rows of map_type from scratch, in the session's
+    transaction; readers keep seeing the previous rows until the caller commits.
+
+    Returns:
+        int: Number of parcels indexed.
+    """
+    if map_type not in SUBJECT_MAP_TYPES:
+        raise ValueError(f"Only {', '.join(SUBJECT_MAP_TYPES)} files have subjects to index, not {map_type}.")
+    _lock_parcel_subject_index(session, map_type)
+    session.execute(text(f"DELETE FROM {ParcelSubjectIndex.__tablename__} WHERE map_type = :map_type"), {'map_type': map_type})
+    result = session.execute(text(
+        f"INSERT INTO {ParcelSubjectIndex.__tablename__} (map_type, parcel_id, subject_ids, max_values, insert_date) "
+        f"SELECT :map_type, parcel_id, subject_ids, max_values, now() FROM ({_aggregate_into_index_sql(parcelwise_source_sql(map_type))}) rebuilt"
+    ), {'map_type': map_type})
+    return result.rowcount
+
+
+def check_parcel_subject_index(map_type: str, session) -> dict:
+    """
+    Compare the parcel_subject_index rows of map_type with a recomputation from the stored values.
+
+    Returns:
+        dict: `n_parcels`, the number of indexed parcels, and `mismatched_parcel_ids`, the parcels
+        whose row is missing, extra, or holds different subjects or values.
+    """
+    if map_type not in SUBJECT_MAP_TYPES:
+        raise ValueError(f"Only {', '.join(SUBJECT_MAP_TYPES)} files have subjects to index, not {map_type}.")
+    stored_sql = (
+        f"SELECT parcel_id, subject_ids, max_values FROM {ParcelSubjectIndex.__tablename__} WHERE map_type = :map_type"
+    )
+    expected_sql = _aggregate_into_index_sql(parcelwise_source_sql(map_type))
+    mismatched_parcel_ids = session.execute(text(f"""
+        WITH stored AS ({stored_sql}), expected AS ({expected_sql})
+        SELECT DISTINCT parcel_id FROM (
+            (SELECT * FROM stored EXCEPT SELECT * FROM expected)
+            UNION ALL
+            (SELECT * FROM expected EXCEPT SELECT * FROM stored)
+        ) difference
+        ORDER BY parcel_id
+    """), {'map_type': map_type}).scalars().all()
+    n_parcels = session.execute(text(f"SELECT count(*) FROM ({stored_sql}) stored"), {'map_type': map_type}).scalar()
+    return {'n_parcels': n_parcels, 'mismatched_parcel_ids': list(mismatched_parcel_ids)}
+
+
+def get_indexed_subject_values_at_xyz(x: int, y: int, z: int, map_type: str, session) -> list:
+    """
+    (subject_id, maximum value) pairs over the parcels containing an MNI152 coordinate, from parcel_subject_index.
+    """
+    return session.execute(text(
+        "SELECT indexed.subject_id, max(indexed.max_value) "
+        f"FROM {ParcelSubjectIndex.__tablename__} entry "
+        "JOIN voxelwise_values voxel ON voxel.parcel_id = entry.parcel_id "
+        "CROSS JOIN LATERAL unnest(entry.subject_ids, entry.max_values) AS indexed(subject_id, max_value) "
+        "WHERE entry.map_type = :map_type "
+        "AND voxel.mni152_x = :x AND voxel.mni152_y = :y AND voxel.mni152_z = :z "
+        "GROUP BY indexed.subject_id"
+    ), {'map_type': map_type, 'x': x, 'y': y, 'z': z}).all()
+
+
+def pack_parcelwise_rows(map_type: str, session, batch_files: int = PACK_BATCH_FILES) -> int:
+    """
+    Move the parcelwise_*_values rows of map_type files into packed arrays, batch_files files per
+    transaction. Rows of parcels outside the file's packed parcellation are left in place.
+
+    Returns:
+        int: Number of files packed.
+    """
+    ArrayTable, ValueTable, FileTable = PARCELWISE_ARRAY_TABLES[map_type]
+    file_id_column = f'{map_type}_file_id'
+    n_packed, last_file_id = 0, 0
+    while True:
+        file_ids = session.execute(text(
+            f"SELECT DISTINCT {file_id_column} FROM {ValueTable.__tablename__} "
+            f"WHERE {file_id_column} > :after ORDER BY {file_id_column} LIMIT :limit"
+        ), {'after': last_file_id, 'limit': batch_files}).scalars().all()
+        if not file_ids:
+            return n_packed
+        last_file_id = file_ids[-1]
+
+        # Each file is packed against the parcellation of its first stored parcel
+        result = session.execute(text(f"""
+            INSERT INTO {ArrayTable.__tablename__} ({file_id_column}, parcellation_id, packed_values, user_id, insert_date)
+            SELECT map_file.id, parcel.parcellation_id,
+                   array_agg(CAST(coalesce(file_value.value, 0) AS REAL) ORDER BY parcel.id), map_file.user_id, now()
+            FROM {FileTable.__tablename__} map_file
+            JOIN LATERAL (
+                SELECT parcels.parcellation_id FROM {ValueTable.__tablename__} row_value
+                JOIN parcels ON parcels.id = row_value.parcel_id
+                WHERE row_value.{file_id_column} = map_file.id LIMIT 1
+            ) file_parcellation ON true
+            JOIN parcels parcel ON parcel.parcellation_id = file_parcellation.parcellation_id
+            LEFT JOIN (
+                SELECT {file_id_column} AS file_id, parcel_id, max(value) AS value
+                FROM {ValueTable.__tablename__} WHERE {file_id_column} = ANY(:file_ids)
+                GROUP BY {file_id_column}, parcel_id
+            ) file_value ON file_value.file_id = map_file.id AND file_value.parcel_id = parcel.id
+            WHERE map_file.id = ANY(:file_ids)
+            GROUP BY map_file.id, parcel.parcellation_id, map_file.user_id
+            ON CONFLICT ({file_id_column}) DO NOTHING
+        """), {'file_ids': list(file_ids)})
+        session.execute(text(f"""
+            DELETE FROM {ValueTable.__tablename__} row_value
+            USING {ArrayTable.__tablename__} packed_file, parcels parcel
+            WHERE row_value.{file_id_column} = ANY(:file_ids)
+              AND packed_file.{file_id_column} = row_value.{file_id_column}
+              AND parcel.id = row_value.parcel_id AND parcel.parcellation_id = packed_file.parcellation_id
+        """), {'file_ids': list(file_ids)})
+        session.commit()
+        n_packed += result.rowcount
+        print(f"Packed {n_packed} {map_type} files (up to file {last_file_id}).")
+
+
+def _table_size(session, table_name: str) -> str:
+    return session.execute(text("SELECT pg_size_pretty(pg_total_relation_size(CAST(:table AS regclass)))"), {'table': table_name}).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('map_types', nargs='+', choices=list(PARCELWISE_ARRAY_TABLES))
+    parser.add_argument('--batch-files', type=int, default=PACK_BATCH_FILES, help="Files packed per transaction.")
+    args = parser.parse_args()
+
+    session = get_session()
+    try:
+        for map_type in args.map_types:
+            ArrayTable, ValueTable, _ = PARCELWISE_ARRAY_TABLES[map_type]
+            start = time.time()
+            n_packed = pack_parcelwise_rows(map_type, session, batch_files=args.batch_files)
+            if map_type in SUBJECT_MAP_TYPES:
+                n_parcels = rebuild_parcel_subject_index(map_type, session)
+                session.commit()
+                print(f"Indexed {n_parcels} parcels of {map_type} files.")
+            print(
+                f"Packed {n_packed} {map_type} files in {time.time() - start:.1f}s; "
+                f"{ValueTable.__tablename__} is {_table_size(session, ValueTable.__tablename__)} until vacuumed, "
+                f"{ArrayTable.__tablename__} is {_table_size(session, ArrayTable.__tablename__)}."
+            )
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# pg_copy.py
+
+"""
+Bulk loading into PostgreSQL with COPY ... FROM STDIN.
+
+Rows are built as NumPy column arrays and streamed to the server in chunks of
+COPY_CHUNK_ROWS, so loading a table costs one round trip per chunk and memory for
+one chunk, instead of one Python dict and one INSERT parameter set per row.
+
+COPY runs on the connection the session is already using, so it is part of the
+session's transaction. Works with psycopg2 and psycopg 3.
+"""
+
+import struct
+from io import BytesIO
+
+import numpy as np
+from sqlalchemy import text
+
+COPY_CHUNK_ROWS = 50_000
+# PostgreSQL binary COPY field types and their big-endian NumPy encodings
+BINARY_COPY_TYPES = {'int2': '>i2', 'int4': '>i4', 'int8': '>i8', 'float4': '>f4', 'float8': '>f8'}
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+BINARY_COPY_TRAILER = struct.pack('>h', -1)
+
+
+def iter_csv_chunks(columns, formats, chunk_rows: int = COPY_CHUNK_ROWS):
+    """
+    Format equal-length column arrays as CSV, chunk_rows rows at a time.
+
+    Args:
+        columns (list): One 1D array per column.
+        formats (list): printf-style format of each column, e.g. '%d' or '%.9g'.
+
+    Yields:
+        bytes: CSV text for up to chunk_rows rows.
+    """
+    n_rows = len(columns[0]) if columns else 0
+    for start in range(0, n_rows, chunk_rows):
+        stop = min(start + chunk_rows, n_rows)
+        buffer = BytesIO()
+        chunk = np.rec.fromarrays([np.asarray(column[start:stop]) for column in columns])
+        np.savetxt(buffer, chunk, fmt=formats, delimiter=',')
+        yield buffer.getvalue()
+
+
+def iter_binary_chunks(columns, pg_types, chunk_rows: int = COPY_CHUNK_ROWS):
+    """
+    Encode equal-length column arrays in PostgreSQL's binary COPY format, without NULLs.
+
+    Each row is a fixed-size record (field count, then length and value of every field),
+    so whole chunks are encoded by one structured NumPy assignment per column.
+
+    Args:
+        columns (list): One 1D array per column.
+        pg_types (list): Type of each column, a key of BINARY_COPY_TYPES.
+
+    Yields:
+        bytes: The header, then rows in chunks of chunk_rows, then the trailer.
+    """
+    fields = [('n_fields', '>i2')]
+    for i, pg_type in enumerate(pg_types):
+        fields += [(f'length_{i}', '>i4'), (f'value_{i}', BINARY_COPY_TYPES[pg_type])]
+    dtype = np.dtype(fields)
+
+    yield BINARY_COPY_HEADER
+    n_rows = len(columns[0]) if columns else 0
+    for start in range(0, n_rows, chunk_rows):
+        stop = min(start + chunk_rows, n_rows)
+        rows = np.empty(stop - start, dtype=dtype)
+        rows['n_fields'] = len(columns)
+        for i, column in enumerate(columns):
+            rows[f'length_{i}'] = dtype.fields[f'value_{i}'][0].itemsize
+            rows[f'value_{i}'] = column[start:stop]
+        yield rows.tobytes()
+    yield BINARY_COPY_TRAILER
+
+
+def copy_chunks(session, table: str, column_names, chunks, copy_format: str = 'csv') -> None:
+    """
+    Stream chunks of COPY data into table on the session's connection.
+
+    Args:
+        session (Session): The SQLAlchemy session; the COPY joins its transaction.
+        table (str): Target table, e.g. a temporary staging table.
+        column_names (list): Target columns, in the order of the data.
+        chunks (iterable): bytes in copy_format (see iter_csv_chunks and iter_binary_chunks).
+        copy_format (str): 'csv' or 'binary'.
+    """
+    statement = f"COPY {table} ({', '.join(column_names)}) FROM STDIN WITH (FORMAT {copy_format})"
+    driver_connection = session.connection().connection.driver_connection
+    cursor = driver_connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            # psycopg2 pulls from a file-like object
+            cursor.copy_expert(statement, _ChunkReader(chunks))
+        else:
+            with cursor.copy(statement) as copy:
+                for chunk in chunks:
+                    copy.write(chunk)
+    finally:
+        cursor.close()
+
+
+def create_staging_table(session, name: str, columns: str) -> None:
+    """
+    Create a temporary table that is dropped when the session's transaction ends.
+
+    Args:
+        name (str): Table name.
+        columns (str): Column definitions, e.g. "parcel_id integer, value real".
+    """
+    session.execute(text(f"CREATE TEMP TABLE {name} ({columns}) ON COMMIT DROP"))
+
+
+class _ChunkReader:
+    """Minimal read()-able file over an iterable of bytes chunks, for psycopg2's copy_expert."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
@@ -0,0 +1,232 @@
+# s3_client.py
+
+import os
+import threading
+import environ
+from pathlib import Path
+import boto3
+from botocore.config import Config
+
+# Initialize environ
+env = environ.Env()
+
+# Build paths inside the project like this: BASE_DIR / 'subdir'.
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Read .env file
+environ.Env.read_env(str(BASE_DIR / '.env'))
+
+DO_ACCESS_KEY_ID = env('DO_SPACES_ACCESS_KEY_ID')
+DO_SECRET_ACCESS_KEY = env('DO_SPACES_SECRET_ACCESS_KEY')
+DO_STORAGE_BUCKET_NAME = env('DO_SPACES_BUCKET_NAME')
+DO_S3_ENDPOINT_URL = env('DO_SPACES_ENDPOINT_URL')
+DO_SPACES_LOCATION = env('DO_SPACES_LOCATION', default='nyc3')
+DO_LOCATION = env('DO_LOCATION')
+
+# Connection pool and retry tuning, shared by every S3 client in the project
+S3_MAX_POOL_CONNECTIONS = env.int('S3_MAX_POOL_CONNECTIONS', default=32)
+S3_MAX_ATTEMPTS = env.int('S3_MAX_ATTEMPTS', default=5)
+S3_CONNECT_TIMEOUT = env.float('S3_CONNECT_TIMEOUT', default=10)
+S3_READ_TIMEOUT = env.float('S3_READ_TIMEOUT', default=60)
+# Multipart upload part size; S3 requires at least 5 MiB for every part but the last
+S3_MULTIPART_PART_SIZE = max(env.int('S3_MULTIPART_PART_SIZE', default=8 * 1024 * 1024), 5 * 1024 * 1024)
+
+# One client per process; botocore clients are thread-safe but must not cross a fork
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client_config():
+    """
+    Get the botocore Config used for DigitalOcean Spaces: virtual-host addressing,
+    a connection pool large enough for concurrent fetches, TCP keep-alive and
+    the standard retry mode.
+    """
+    return Config(
+        s3={'addressing_style': 'virtual'},
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=S3_CONNECT_TIMEOUT,
+        read_timeout=S3_READ_TIMEOUT,
+        retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'standard'},
+    )
+
+
+def get_s3_client():
+    """
+    Get the process-wide boto3 S3 client for DigitalOcean Spaces.
+
+    The client is created on first use and reused by every thread of the process,
+    so credentials are resolved and TLS connections are opened once rather than per
+    request. A forked child (e.g. a Celery prefork worker) builds its own client.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            session = boto3.session.Session()
+            _client = session.client(
+                's3',
+                config=get_s3_client_config(),
+                region_name=DO_SPACES_LOCATION,
+                endpoint_url=DO_S3_ENDPOINT_URL,
+                aws_access_key_id=DO_ACCESS_KEY_ID,
+                aws_secret_access_key=DO_SECRET_ACCESS_KEY,
+            )
+            _client_pid = pid
+    return _client
+
+
+def get_s3_object_bytes(filepath: str) -> bytes:
+    """
+    Download an object stored under DO_LOCATION with the shared client.
+    """
+    response = get_s3_client().get_object(Bucket=DO_STORAGE_BUCKET_NAME, Key=os.path.join(DO_LOCATION, filepath))
+    return response['Body'].read()
+
+
+def get_s3_object_stream(filepath: str):
+    """
+    Open an object stored under DO_LOCATION as a readable stream (botocore StreamingBody).
+    The caller must close it.
+    """
+    response = get_s3_client().get_object(Bucket=DO_STORAGE_BUCKET_NAME, Key=os.path.join(DO_LOCATION, filepath))
+    return response['Body']
+
+
+class S3MultipartWriter:
+    """
+    Writable file object that uploads to an object under DO_LOCATION in parts.
+
+    At most one part is buffered in memory. Objects smaller than one part are sent
+    with a single PutObject. On error the multipart upload is aborted.
+
+    Usage:
+        with S3MultipartWriter('generated_content/map.nii.gz', content_type='application/gzip') as f:
+            f.write(chunk)
+    """
+
+    def __init__(self, filepath: str, content_type: str = 'application/octet-stream', acl: str = 'public-read',
+                 part_size: int = None):
+        self.filepath = filepath
+        self.key = os.path.join(DO_LOCATION, filepath)
+        self.object_parameters = {'ContentType': content_type}
+        if acl:
+            self.object_parameters['ACL'] = acl
+        self.part_size = part_size or S3_MULTIPART_PART_SIZE
+        self.client = get_s3_client()
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, body: bytes):
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(
+                Bucket=DO_STORAGE_BUCKET_NAME, Key=self.key, **self.object_parameters
+            )
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=DO_STORAGE_BUCKET_NAME, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=body,
+        )
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=DO_STORAGE_BUCKET_NAME, Key=self.key, Body=bytes(self.buffer), **self.object_parameters
+            )
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            self.client.complete_multipart_upload(
+                Bucket=DO_STORAGE_BUCKET_NAME, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts},
+            )
+        self.buffer = bytearray()
+
+    def abort(self):
+        self.closed = True
+        self.buffer = bytearray()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=DO_STORAGE_BUCKET_NAME, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def get_s3_object_etag(filepath: str) -> str:
+    """
+    Get the ETag of an object stored under DO_LOCATION without downloading it.
+    """
+    response = get_s3_client().head_object(Bucket=DO_STORAGE_BUCKET_NAME, Key=os.path.join(DO_LOCATION, filepath))
+    return response['ETag'].strip('"')
+
+
+def get_s3_connection_stats() -> dict:
+    """
+    Count the HTTP connections opened by the shared client against the requests sent.
+
+    Best effort, for logging only: the counts come from botocore and urllib3 internals,
+    so an empty dict is returned if they are not where this expects them.
+
+    Returns:
+        dict: `connections_created`, `requests` and `connections_reused`
+        (requests served on an already open connection) for this process,
+        or an empty dict if they cannot be read.
+    """
+    if _client is None or _client_pid != os.getpid():
+        return {'connections_created': 0, 'requests': 0, 'connections_reused': 0}
+
+    # botocore keeps one urllib3 connection pool per endpoint host
+    http_session = getattr(getattr(_client, '_endpoint', None), 'http_session', None)
+    manager = getattr(http_session, '_manager', None)
+    proxy_managers = getattr(http_session, '_proxy_managers', None) or {}
+    if manager is None:
+        return {}
+
+    stats = {'connections_created': 0, 'requests': 0}
+    try:
+        for pool_manager in [manager, *proxy_managers.values()]:
+            pools = getattr(pool_manager, 'pools', None)
+            if pools is None:
+                return {}
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                stats['connections_created'] += getattr(pool, 'num_connections', 0)
+                stats['requests'] += getattr(pool, 'num_requests', 0)
+    except Exception:
+        return {}
+    stats['connections_reused'] = max(stats['requests'] - stats['connections_created'], 0)
+    return stats
@@ -415,7 +415,7 @@
             })
             .catch(error => {
                 console.error('Error analyzing voxels:', error);
-                alert('An error occurred while analyzing the lesion.');
+                alert(error.error || 'An error occurred while analyzing the lesion.');
             });
         },
         